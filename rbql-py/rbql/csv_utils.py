@@ -1,11 +1,17 @@
 import re
+import csv
 
 
 newline_rgx = re.compile('(?:\r\n)|\r|\n')
 
+# Matches the beginning of a quoted_rfc record up to the line separator that ends it: newlines inside double-quoted parts don't end the record.
+rfc_record_rgx = re.compile('[^"\r\n]*(?:"[^"]*"[^"\r\n]*)*')
+trailing_newline_rgx = re.compile('(?:\r\n|\r|\n)\Z')
+
 field_regular_expression = '"((?:[^"]*"")*[^"]*)"'
 field_rgx = re.compile(field_regular_expression)
 field_rgx_external_whitespaces = re.compile(' *' + field_regular_expression + ' *')
+whitespace_field_bytes_rgx = re.compile(b'[^ ]+')
 
 
 def extract_next_field(src, dlm, preserve_quotes_and_whitespaces, allow_external_whitespaces, cidx, result):
@@ -50,6 +56,37 @@ def split_quoted_str(src, dlm, preserve_quotes_and_whitespaces=False):
     return (result, warning)
 
 
+class CSVModuleSplitter(object):
+    # Splits records with the C `csv` module, which is much faster than `split_quoted_str`.
+    # `csv` is used only for records which both splitters interpret identically: each field is either enclosed in double quotes with "" escaping, or has no double quotes and no line separators.
+    # All other records, including defective ones which produce warnings, are split by `split_quoted_str`.
+    def __init__(self, dlm):
+        assert len(dlm) == 1 and dlm not in '"\r\n'
+        self.dlm = dlm
+        field_regular_expression = '(?:"(?:[^"]|"")*"|[^"{0}\r\n]*)'.format(re.escape(dlm))
+        self.canonical_record_rgx = re.compile('{0}(?:{1}{0})*\\Z'.format(field_regular_expression, re.escape(dlm)))
+        self.current_record = None
+        # The reader pulls records one by one from this object, see `__next__`
+        self.reader = csv.reader(self, delimiter=dlm, quotechar='"', doublequote=True, strict=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.current_record
+
+    def split(self, src):
+        if src.find('"') == -1: # Optimization for most common case
+            return (src.split(self.dlm), False)
+        if self.canonical_record_rgx.match(src) is not None:
+            self.current_record = src
+            try:
+                return (next(self.reader), False)
+            except csv.Error:
+                pass # E.g. NUL characters in older python versions
+        return split_quoted_str(src, self.dlm)
+
+
 def split_whitespace_separated_str(src, preserve_whitespaces=False):
     rgxp = re.compile(" *[^ ]+ *") if preserve_whitespaces else re.compile("[^ ]+")
     result = []
@@ -71,10 +108,34 @@ def get_polymorphic_split_function(dlm, policy, preserve_quotes_and_whitespaces)
     elif policy == 'monocolumn':
         return lambda src: ([src], False)
     elif policy == 'quoted' or policy == 'quoted_rfc':
+        if not preserve_quotes_and_whitespaces and len(dlm) == 1 and dlm not in '"\r\n':
+            return CSVModuleSplitter(dlm).split
         return lambda src: split_quoted_str(src, dlm, preserve_quotes_and_whitespaces)
     else:
         raise ValueError('Unsupported splitting policy: {}'.format(policy))
 
+def get_polymorphic_bytes_split_function(dlm, policy):
+    # Splits undecoded lines into `bytes` fields. The delimiter must be an ascii string.
+    bytes_dlm = dlm.encode('latin-1')
+    if policy == 'simple':
+        return lambda src: (src.split(bytes_dlm), False)
+    elif policy == 'whitespace':
+        return lambda src: (whitespace_field_bytes_rgx.findall(src), False)
+    elif policy == 'monocolumn':
+        return lambda src: ([src], False)
+    elif policy == 'quoted':
+        split_str = get_polymorphic_split_function(dlm, policy, preserve_quotes_and_whitespaces=False)
+        def split_quoted_bytes(src):
+            if src.find(b'"') == -1: # Optimization for most common case
+                return (src.split(bytes_dlm), False)
+            # latin-1 decoding is lossless, so lines with double quotes can be split as strings
+            fields, warning = split_str(src.decode('latin-1'))
+            return ([field.encode('latin-1') for field in fields], warning)
+        return split_quoted_bytes
+    else:
+        raise ValueError('Unsupported splitting policy for bytes: {}'.format(policy))
+
+
 def smart_split(src, dlm, policy, preserve_quotes_and_whitespaces):
     # Prefer to use get_polymorphic_split_function function for better performance if you need to split many strings with the same policy.
     return get_polymorphic_split_function(dlm, policy, preserve_quotes_and_whitespaces)(src)
@@ -107,6 +168,14 @@ def rfc_quote_field(src, delim):
     return src
 
 
+def quote_bytes_field(src, delim, rfc):
+    if src.find(b'"') != -1:
+        return b'"' + src.replace(b'"', b'""') + b'"'
+    if src.find(delim) != -1 or (rfc and (src.find(b'\n') != -1 or src.find(b'\r') != -1)):
+        return b'"' + src + b'"'
+    return src
+
+
 def unquote_field(field):
     field_rgx_external_whitespaces_full = re.compile('^ *'+ field_regular_expression + ' *$')
     match_obj = field_rgx_external_whitespaces_full.match(field)
@@ -1,7 +1,14 @@
 import sys
 import os
 import io
+import codecs
+import mmap
 import re
+import pickle
+import hashlib
+import hmac
+import tempfile
+import concurrent.futures
 from errno import EPIPE
 from collections import namedtuple
 
@@ -14,6 +21,26 @@ ansi_reset_color_code = '\u001b[0m'
 
 debug_mode = False
 
+# Input files are not split into partitions smaller than this in parallel mode.
+parallel_min_partition_size = 4 * 1024 * 1024
+
+binary_newline_rgx = re.compile(b'\r\n|\r|\n')
+
+# Number of characters that CSVRecordIterator reads from the input stream at once, each block is split into lines in one pass.
+input_block_size = 4 * 1024 * 1024
+
+# Number of output lines that BytesCSVWriter collects before writing them to the output stream at once.
+output_batch_size = 1000
+
+# Approximate max total size of the join cache directory, least recently used join maps are removed when it is exceeded.
+join_cache_max_size = 2 * 1024 * 1024 * 1024
+join_cache_file_suffix = '.rbql_join_cache'
+# Cache files are signed with a random key from this file in the cache dir, so that only the cache files written by RBQL of the same user are unpickled.
+join_cache_key_file_name = 'rbql_join_cache.key'
+join_cache_key_size = 32
+# Increment to invalidate the existing join caches when the format of the cached join map state changes.
+join_cache_format_version = 2
+
 
 def is_ascii(s):
     return all(ord(c) < 128 for c in s)
@@ -49,11 +76,40 @@ def encode_input_stream(stream, encoding):
         return stream
     # Reference: https://stackoverflow.com/a/16549381/2898283
     # typical stream (e.g. sys.stdin) in Python 3 is actually a io.TextIOWrapper but with some unknown encoding
+    # Line separators are not translated, record iterators handle "\r\n", "\r" and "\n" separators themselves and keep them inside multiline fields.
     try:
-        return io.TextIOWrapper(stream.buffer, encoding=encoding)
+        return io.TextIOWrapper(stream.buffer, encoding=encoding, newline='')
     except AttributeError:
         # BytesIO doesn't have "buffer"
-        return io.TextIOWrapper(stream, encoding=encoding)
+        return io.TextIOWrapper(stream, encoding=encoding, newline='')
+
+
+class PipeReader(object):
+    # Reads pipes and terminals: `read` returns the data which is already available instead of waiting until the whole block is filled, so that e.g. `tail -f data.csv | rbql ...` outputs records as soon as the lines arrive
+    def __init__(self, binary_stream, encoding):
+        self.binary_stream = binary_stream
+        self.decoder = codecs.getincrementaldecoder(encoding)() if encoding is not None else None
+
+    def read(self, size):
+        while True:
+            data = self.binary_stream.read1(size)
+            if self.decoder is None:
+                return data
+            chunk = self.decoder.decode(data, final=not data)
+            if chunk or not data: # The chunk is empty if the data ends in the middle of a multibyte character
+                return chunk
+
+
+def make_input_reader(stream, encoding):
+    # Regular files are read in full blocks, pipes are read with `read1` which doesn't block once some data is available
+    binary_stream = stream if encoding is None else getattr(stream, 'buffer', stream)
+    try:
+        is_pipe = hasattr(binary_stream, 'read1') and not binary_stream.seekable()
+    except ValueError:
+        is_pipe = False
+    if is_pipe:
+        return PipeReader(binary_stream, encoding)
+    return encode_input_stream(stream, encoding)
 
 
 def encode_output_stream(stream, encoding):
@@ -69,6 +125,8 @@ def encode_output_stream(stream, encoding):
 def remove_utf8_bom(line, assumed_source_encoding):
     if assumed_source_encoding == 'latin-1' and len(line) >= 3 and line[:3] == '\xef\xbb\xbf':
         return line[3:]
+    if assumed_source_encoding == 'bytes' and line[:3] == b'\xef\xbb\xbf':
+        return line[3:]
     # TODO consider replacing "utf-8" with "utf-8-sig" to automatically remove BOM, see https://stackoverflow.com/a/44573867/2898283
     if assumed_source_encoding == 'utf-8' and len(line) >= 1 and line[0] == u'\ufeff':
         return line[1:]
@@ -221,6 +279,10 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         if self.check_separators_after_join:
             self.check_separator_in_fields_after_join(out_line, len(fields))
 
+        return self.write_line(out_line)
+
+
+    def write_line(self, out_line):
         try:
             self.stream.write(out_line)
             if self.colors is not None:
@@ -315,11 +377,75 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         return result
 
 
+class BytesCSVWriter(CSVWriter):
+    # Writer for the bytes mode: `bytes` fields are written as is without encoding, other values are converted to strings and encoded as latin-1.
+    def __init__(self, stream, close_stream_on_finish, delim, policy, line_separator='\n'):
+        CSVWriter.__init__(self, stream, close_stream_on_finish, None, delim, policy, line_separator)
+        self.stream = stream.buffer if hasattr(stream, 'buffer') else stream
+        self.line_separator = line_separator.encode('latin-1')
+        self.delim = delim.encode('latin-1')
+        self.sub_array_delim = self.sub_array_delim.encode('latin-1')
+        # Output lines are joined and written in batches, because a write to the stream costs much more than appending a line to a list
+        self.output_lines = []
+
+
+    def write_line(self, out_line):
+        self.output_lines.append(out_line)
+        if len(self.output_lines) >= output_batch_size:
+            return self.write_output_lines()
+        return True
+
+
+    def write_output_lines(self):
+        self.output_lines.append(b'') # For the line separator after the last line
+        output_block = self.line_separator.join(self.output_lines)
+        self.output_lines = []
+        try:
+            self.stream.write(output_block)
+            return True
+        except BrokenPipeError:
+            self.broken_pipe = True
+            return False
+
+
+    def finish(self):
+        if self.output_lines and not self.broken_pipe:
+            self.write_output_lines()
+        CSVWriter.finish(self)
+
+
+    def quote_fields(self, fields):
+        for i in range(len(fields)):
+            fields[i] = csv_utils.quote_bytes_field(fields[i], self.delim, rfc=False)
+
+
+    def quote_fields_rfc(self, fields):
+        for i in range(len(fields)):
+            fields[i] = csv_utils.quote_bytes_field(fields[i], self.delim, rfc=True)
+
+
+    def normalize_fields(self, fields):
+        for i in range(len(fields)):
+            if isinstance(fields[i], bytes):
+                continue
+            elif fields[i] is None:
+                fields[i] = b''
+                self.none_in_output = True
+            elif isinstance(fields[i], list):
+                self.normalize_fields(fields[i])
+                fields[i] = self.sub_array_delim.join(fields[i])
+            else:
+                try:
+                    fields[i] = str(fields[i]).encode('latin-1')
+                except UnicodeEncodeError:
+                    raise rbql_engine.RbqlIOHandlingError('Unable to write non-latin-1 characters in bytes mode, use bytes values or disable bytes mode instead')
+
+
 class CSVRecordIterator(rbql_engine.RBQLInputIterator):
-    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False, strip_whitespaces=False, comment_regex=None):
+    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=None, line_mode=False, strip_whitespaces=False, comment_regex=None):
         assert encoding in ['utf-8', 'latin-1', None]
         self.encoding = encoding
-        self.stream = encode_input_stream(stream, encoding)
+        self.stream = make_input_reader(stream, encoding) if stream is not None else None # Subclasses can read the input themselves
         self.delim = delim
         self.policy = policy
         self.table_name = table_name
@@ -328,16 +454,23 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         self.strip_whitespaces = strip_whitespaces
         self.comment_regex = comment_regex if (comment_regex is not None and len(comment_regex)) else None
 
-        self.buffer = ''
+        # Lines of the current block are served from the `line_pos` cursor, the last incomplete line of the block is carried over to the next block
+        self.block_lines = []
+        self.line_pos = 0
+        self.partial_line = ''
+        # With quoted_rfc policy records are extracted directly from the `block_data` starting at `block_pos` instead
+        self.block_data = ''
+        self.block_pos = 0
         self.detected_line_separator = '\n'
         self.exhausted = False
         self.NR = 0 # Record number
         self.NL = 0 # Line number (NL != NR when the CSV file has comments or multiline fields)
-        self.chunk_size = chunk_size
+        self.chunk_size = chunk_size if chunk_size is not None else input_block_size
         self.fields_info = dict()
 
         self.utf8_bom_removed = False
         self.first_defective_line = None
+        self.first_defective_offset = None
         self.polymorphic_get_row = self.get_row_rfc if policy == 'quoted_rfc' else self.get_row_simple
         self.has_header = has_header
         self.first_record_should_be_emitted = False
@@ -364,48 +497,39 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         return self.first_record if self.has_header else None
 
 
-    def _get_row_from_buffer(self):
-        str_before, separator, str_after = csv_utils.extract_line_from_data(self.buffer)
-        if separator is None:
-            return None
-        if separator == '\r' and str_after == '':
-            one_more = self.stream.read(1)
-            if one_more == '\n':
-                separator = '\r\n'
-            else:
-                str_after = one_more
-        self.detected_line_separator = separator
-        self.buffer = str_after
-        return str_before
-
-
-    def _read_until_found(self):
-        if self.exhausted:
-            return
-        chunks = []
-        while True:
+    def _read_lines_block(self):
+        # Reads blocks until at least one complete line is found, or until the end of the stream
+        self.block_lines = []
+        self.line_pos = 0
+        while not self.block_lines:
             chunk = self.stream.read(self.chunk_size)
             if not chunk:
                 self.exhausted = True
-                break
-            chunks.append(chunk)
-            if csv_utils.newline_rgx.search(chunk) is not None:
-                break
-        self.buffer += ''.join(chunks)
+                if self.partial_line:
+                    # A trailing "\r" was held back because it could be the first half of "\r\n"
+                    self.block_lines = [self.partial_line[:-1] if self.partial_line.endswith('\r') else self.partial_line]
+                    self.partial_line = ''
+                return
+            data = self.partial_line + chunk
+            held_back = ''
+            if data.endswith('\r'):
+                data, held_back = data[:-1], '\r'
+            self.block_lines = csv_utils.newline_rgx.split(data)
+            self.partial_line = self.block_lines.pop() + held_back
+            if self.block_lines:
+                self.detected_line_separator = csv_utils.newline_rgx.search(data).group(0)
 
 
     def get_row_simple(self):
         try:
-            row = self._get_row_from_buffer()
-            if row is None:
-                self._read_until_found()
-                row = self._get_row_from_buffer()
-                if row is None:
-                    assert self.exhausted
-                    if not len(self.buffer):
-                        return None
-                    row = self.buffer
-                    self.buffer = ''
+            if self.line_pos >= len(self.block_lines):
+                if self.exhausted:
+                    return None
+                self._read_lines_block()
+                if not self.block_lines:
+                    return None
+            row = self.block_lines[self.line_pos]
+            self.line_pos += 1
             self.NL += 1
             if self.NL == 1:
                 clean_line = remove_utf8_bom(row, self.encoding)
@@ -417,26 +541,80 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
             raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
 
 
+    def _read_rfc_block(self):
+        # At least as much data as the unprocessed part of the block is read, so that records longer than a block are rescanned only a logarithmic number of times
+        chunk = self.stream.read(max(self.chunk_size, len(self.block_data) - self.block_pos))
+        if not chunk:
+            self.exhausted = True
+            return
+        self.block_data = self.block_data[self.block_pos:] + chunk
+        self.block_pos = 0
+
+
+    def _is_comment_line(self, line):
+        if self.comment_prefix is not None and line.startswith(self.comment_prefix):
+            return True
+        return self.comment_regex is not None and re.search(self.comment_regex, line) is not None
+
+
+    def _find_rfc_row_end(self):
+        # Returns (row_end, separator_end) or None if more data is needed to find the end of the row
+        data = self.block_data
+        pos = self.block_pos
+        if pos >= len(data):
+            return None
+        if self.comment_prefix is not None or self.comment_regex is not None:
+            # Comment lines are skipped even if they have unbalanced double quotes, so they always end at the first line separator
+            match = csv_utils.newline_rgx.search(data, pos)
+            line_end = match.start() if match is not None else len(data)
+            if self._is_comment_line(data[pos:line_end]):
+                return self._find_separator_end(line_end)
+        row_end = csv_utils.rfc_record_rgx.match(data, pos).end()
+        if row_end < len(data) and data[row_end] == '"':
+            # Unbalanced double quote: the rest of the input is a single row
+            if not self.exhausted:
+                return None
+            match = csv_utils.trailing_newline_rgx.search(data, row_end)
+            return (match.start() if match is not None else len(data), len(data))
+        return self._find_separator_end(row_end)
+
+
+    def _find_separator_end(self, row_end):
+        data = self.block_data
+        if row_end == len(data):
+            return (row_end, row_end) if self.exhausted else None
+        if data[row_end] == '\n':
+            return (row_end, row_end + 1)
+        if row_end + 1 == len(data):
+            # "\r" at the end of the block can be the first half of "\r\n"
+            return (row_end, row_end + 1) if self.exhausted else None
+        return (row_end, row_end + 2) if data[row_end + 1] == '\n' else (row_end, row_end + 1)
+
+
     def get_row_rfc(self):
-        first_row = self.get_row_simple()
-        if first_row is None:
+        # Multiline records are extracted in a single scan of the block and keep their original line separators
+        try:
+            while True:
+                row_span = self._find_rfc_row_end()
+                if row_span is not None or self.exhausted:
+                    break
+                self._read_rfc_block()
+        except UnicodeDecodeError:
+            raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
+        if row_span is None:
             return None
-        # If the line is a comment - return it right away, even though it is a comment it is still a "full row", so we don't have to search where the logical row ends.
-        if self.comment_prefix is not None and first_row.startswith(self.comment_prefix):
-            return first_row
-        if self.comment_regex is not None and re.search(self.comment_regex, first_row) is not None:
-            return first_row
-
-        if first_row.count('"') % 2 == 0:
-            return first_row
-        rows_buffer = [first_row]
-        while True:
-            row = self.get_row_simple()
-            if row is None:
-                return '\n'.join(rows_buffer)
-            rows_buffer.append(row)
-            if row.count('"') % 2 == 1:
-                return '\n'.join(rows_buffer)
+        row_end, separator_end = row_span
+        row = self.block_data[self.block_pos:row_end]
+        self.block_pos = separator_end
+        if self.NL == 0:
+            clean_line = remove_utf8_bom(row, self.encoding)
+            if clean_line != row:
+                row = clean_line
+                self.utf8_bom_removed = True
+        self.NL += 1
+        if row.find('"') != -1:
+            self.NL += row.count('\n') + row.count('\r') - row.count('\r\n')
+        return row
 
 
     def get_record(self):
@@ -463,6 +641,7 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         if warning:
             if self.first_defective_line is None:
                 self.first_defective_line = self.NL
+                self.first_defective_offset = self.get_current_line_offset()
                 if self.policy == 'quoted_rfc':
                     raise rbql_engine.RbqlIOHandlingError('Inconsistent double quote escaping in {} table at record {}, line {}'.format(self.table_name, self.NR, self.NL))
         num_fields = len(record)
@@ -471,6 +650,10 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         return record
 
 
+    def get_current_line_offset(self):
+        return None # Byte offsets are not known for decoded input streams
+
+
     def _get_all_rows(self):
         result = []
         while True:
@@ -498,15 +681,297 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         if self.utf8_bom_removed:
             result.append('UTF-8 Byte Order Mark (BOM) was found and skipped in {} table'.format(self.table_name))
         if self.first_defective_line is not None:
-            result.append('Inconsistent double quote escaping in {} table. E.g. at line {}'.format(self.table_name, self.first_defective_line))
+            offset_info = '' if self.first_defective_offset is None else ' (byte offset {})'.format(self.first_defective_offset)
+            result.append('Inconsistent double quote escaping in {} table. E.g. at line {}{}'.format(self.table_name, self.first_defective_line, offset_info))
         if len(self.fields_info) > 1:
             result.append(make_inconsistent_num_fields_warning(self.table_name, self.fields_info))
         return result
 
+
+class BytesCSVRecordIterator(CSVRecordIterator):
+    # Iterator for the bytes mode: input lines are not decoded, so record fields are `bytes`. Header fields are decoded as latin-1 to be used as column names.
+    # Records spanning multiple lines are not supported, so "quoted_rfc" policy is not allowed.
+    def __init__(self, stream, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=None, strip_whitespaces=False, comment_regex=None):
+        if policy == 'quoted_rfc':
+            raise rbql_engine.RbqlIOHandlingError('"quoted_rfc" policy is not supported in bytes mode')
+        CSVRecordIterator.__init__(self, None, 'latin-1', delim, policy, has_header, comment_prefix, table_name, variable_prefix, chunk_size, line_mode=True, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        self.stream = make_input_reader(stream.buffer if hasattr(stream, 'buffer') else stream, None)
+        self.encoding = 'bytes'
+        self.partial_line = b''
+        if self.comment_prefix is not None:
+            self.comment_prefix = self.comment_prefix.encode('latin-1')
+        if self.comment_regex is not None:
+            self.comment_regex = re.compile(self.comment_regex.encode('latin-1'))
+        self.polymorphic_split = csv_utils.get_polymorphic_bytes_split_function(delim, policy)
+        self.first_record = self.get_record()
+        self.first_record_should_be_emitted = not has_header
+
+
+    def get_header(self):
+        if not self.has_header or self.first_record is None:
+            return None
+        return [field.decode('latin-1') for field in self.first_record]
+
+
+    def get_field_type(self):
+        return bytes
+
+
+    def _read_lines_block(self):
+        self.block_lines = []
+        self.line_pos = 0
+        while not self.block_lines:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                self.exhausted = True
+                if self.partial_line:
+                    # A trailing "\r" was held back because it could be the first half of "\r\n"
+                    self.block_lines = [self.partial_line[:-1] if self.partial_line.endswith(b'\r') else self.partial_line]
+                    self.partial_line = b''
+                return
+            data = self.partial_line + chunk
+            held_back = b''
+            if data.endswith(b'\r'):
+                data, held_back = data[:-1], b'\r'
+            self.block_lines = binary_newline_rgx.split(data)
+            self.partial_line = self.block_lines.pop() + held_back
+
+
+def make_record_iterator(stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', strip_whitespaces=False, comment_regex=None):
+    # "bytes" encoding enables the bytes mode in which input is not decoded
+    if encoding == 'bytes':
+        return BytesCSVRecordIterator(stream, delim, policy, has_header, comment_prefix=comment_prefix, table_name=table_name, variable_prefix=variable_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+    return CSVRecordIterator(stream, encoding, delim, policy, has_header, comment_prefix=comment_prefix, table_name=table_name, variable_prefix=variable_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+
+
 ActiveJoinFile = namedtuple('ActiveJoinFile', ['table_path', 'input_stream', 'record_iterator'])
 
+
+def map_input_file(input_stream):
+    # Returns a read-only memory map of a regular file or None if the file can't be mapped e.g. if it is a pipe or an empty file
+    try:
+        if not os.path.isfile(input_stream.name):
+            return None
+        mapping = mmap.mmap(input_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+        return None
+    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL) # Let the kernel read ahead aggressively
+    return mapping
+
+
+class MappedCSVRecordIterator(CSVRecordIterator):
+    # Reads input from a memory mapped file in blocks that end at line boundaries, without copying it through a decoding stream.
+    # If comment prefix is set, lines are decoded one by one only when they are processed, so comment lines are skipped without decoding. Otherwise each block is decoded at once which is faster.
+    # Records spanning multiple lines are not supported, so "quoted_rfc" policy is not allowed.
+    def __init__(self, mapping, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=None, strip_whitespaces=False, comment_regex=None):
+        assert policy != 'quoted_rfc' and encoding is not None
+        self.mapping = mapping
+        self.mapping_pos = 0
+        self.block_offset = 0
+        self.binary_comment_prefix = comment_prefix.encode(encoding) if comment_prefix else None
+        if self.binary_comment_prefix is not None:
+            self.get_row_simple = self.get_lazily_decoded_row
+        CSVRecordIterator.__init__(self, None, encoding, delim, policy, has_header, comment_prefix, table_name, variable_prefix, chunk_size, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+
+
+    def _get_mapped_block(self):
+        # Returns the next block of the mapping which ends at a line boundary or None at the end of the mapping
+        size = len(self.mapping)
+        block_size = self.chunk_size
+        while self.mapping_pos < size:
+            block_end = min(self.mapping_pos + block_size, size)
+            if block_end < size:
+                # "\r" at the end of the block can be the first half of "\r\n"
+                search_end = block_end - 1 if self.mapping[block_end - 1:block_end] == b'\r' else block_end
+                last_separator_pos = max(self.mapping.rfind(b'\n', self.mapping_pos, search_end), self.mapping.rfind(b'\r', self.mapping_pos, search_end))
+                if last_separator_pos == -1:
+                    block_size *= 2 # The line is longer than the block
+                    continue
+                block_end = last_separator_pos + 1
+            block = self.mapping[self.mapping_pos:block_end]
+            self.block_offset = self.mapping_pos
+            self.mapping_pos = block_end
+            return block
+        return None
+
+
+    def _split_mapped_block(self, block, line_separator_rgx):
+        self.block_lines = line_separator_rgx.split(block)
+        if not self.block_lines[-1]:
+            self.block_lines.pop() # Line separator at the end of the block doesn't start a new line
+        self.line_pos = 0
+
+
+    def _read_lines_block(self):
+        block = self._get_mapped_block()
+        if block is None:
+            self.exhausted = True
+            self.block_lines = []
+            self.line_pos = 0
+            return
+        self._split_mapped_block(block.decode(self.encoding), csv_utils.newline_rgx)
+
+
+    def get_lazily_decoded_row(self):
+        try:
+            while True:
+                if self.line_pos >= len(self.block_lines):
+                    block = self._get_mapped_block()
+                    if block is None:
+                        return None
+                    self._split_mapped_block(block, binary_newline_rgx)
+                    continue
+                line = self.block_lines[self.line_pos]
+                self.line_pos += 1
+                self.NL += 1
+                if line.startswith(self.binary_comment_prefix):
+                    continue
+                row = line.decode(self.encoding)
+                if self.NL == 1:
+                    clean_line = remove_utf8_bom(row, self.encoding)
+                    if clean_line != row:
+                        row = clean_line
+                        self.utf8_bom_removed = True
+                return row
+        except UnicodeDecodeError:
+            raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
+
+
+    def get_current_line_offset(self):
+        # Byte offset of the last returned line, it is computed from the lengths of the preceding lines of the block and their separators
+        offset = self.block_offset
+        for line in self.block_lines[:self.line_pos - 1]:
+            offset += len(line) if isinstance(line, bytes) else len(line.encode(self.encoding))
+            offset += 2 if self.mapping[offset:offset + 2] == b'\r\n' else 1
+        return offset
+
+
+def get_join_cache_path(join_cache_dir, table_path, record_iterator, key_indices, projection):
+    # The table size and modification time are parts of the cache key, so the outdated cache files are never used and eventually get evicted.
+    table_stat = os.stat(table_path)
+    cache_key = repr((join_cache_format_version, sys.version_info[:2], os.path.abspath(table_path), table_stat.st_size, table_stat.st_mtime, record_iterator.delim, record_iterator.policy, record_iterator.encoding, record_iterator.has_header, record_iterator.comment_prefix, record_iterator.comment_regex, record_iterator.strip_whitespaces, key_indices, projection))
+    return os.path.join(join_cache_dir, hashlib.sha1(cache_key.encode('utf-8')).hexdigest() + join_cache_file_suffix)
+
+
+def is_private_file(file_stat, check_permissions):
+    if not hasattr(os, 'getuid'):
+        return True # No file ownership on Windows, only the signature of cache files can be checked.
+    if file_stat.st_uid != os.getuid():
+        return False
+    return not check_permissions or (file_stat.st_mode & 0o077) == 0
+
+
+def get_join_cache_key(join_cache_dir, create):
+    # Returns None if the key is unavailable or can be known to other users, then the cache is not used at all.
+    key_path = os.path.join(join_cache_dir, join_cache_key_file_name)
+    if create and not os.path.exists(key_path):
+        try:
+            key_fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(key_fd, 'wb') as dst:
+                dst.write(os.urandom(join_cache_key_size))
+        except OSError:
+            pass # E.g. the key file was just created by a concurrent query
+    try:
+        with open(key_path, 'rb') as src:
+            if not is_private_file(os.fstat(src.fileno()), check_permissions=True):
+                return None
+            key = src.read()
+    except OSError:
+        return None
+    return key if len(key) == join_cache_key_size else None
+
+
+class SigningWriter(object):
+    def __init__(self, stream, signature):
+        self.stream = stream
+        self.signature = signature
+
+    def write(self, data):
+        self.signature.update(data)
+        return self.stream.write(data)
+
+
+def load_join_cache(join_cache_dir, cache_path):
+    # Unpickling can execute arbitrary code, so the cache file must be owned by the current user and signed with the key of the cache dir.
+    if not os.path.exists(cache_path):
+        return None
+    key = get_join_cache_key(join_cache_dir, create=False)
+    if key is None:
+        return None
+    try:
+        with open(cache_path, 'rb') as src:
+            if not is_private_file(os.fstat(src.fileno()), check_permissions=False):
+                return None
+            expected_signature = src.read(hashlib.sha256().digest_size)
+            signature = hmac.new(key, digestmod=hashlib.sha256)
+            while True:
+                data = src.read(input_block_size)
+                if not data:
+                    break
+                signature.update(data)
+            if not hmac.compare_digest(expected_signature, signature.digest()):
+                return None
+            src.seek(len(expected_signature))
+            state = pickle.load(src)
+        os.utime(cache_path, None) # Mark as recently used
+    except Exception:
+        return None # Corrupted or concurrently evicted cache file, the join map will be built from the table.
+    return state
+
+
+def evict_join_cache(join_cache_dir, max_size):
+    cache_files = []
+    for file_name in os.listdir(join_cache_dir):
+        if not file_name.endswith(join_cache_file_suffix):
+            continue
+        cache_path = os.path.join(join_cache_dir, file_name)
+        try:
+            file_stat = os.stat(cache_path)
+        except OSError:
+            continue
+        cache_files.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+    cache_files.sort()
+    total_size = sum(size for _mtime, size, _path in cache_files)
+    for _mtime, size, cache_path in cache_files:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def save_join_cache(join_cache_dir, cache_path, state):
+    # The cache file is written under a temporary name and then renamed, so that concurrent queries never read a partially written cache.
+    try:
+        if not os.path.isdir(join_cache_dir):
+            os.makedirs(join_cache_dir)
+        key = get_join_cache_key(join_cache_dir, create=True)
+        if key is None:
+            return
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=join_cache_dir, prefix='rbql_join_cache_', suffix='.tmp')
+    except OSError:
+        return # Caching is an optimization, the query shouldn't fail because of it.
+    try:
+        with os.fdopen(tmp_fd, 'wb') as dst:
+            # The signature of the pickled state is written before it, when the state is already written
+            signature = hmac.new(key, digestmod=hashlib.sha256)
+            dst.write(b'\0' * signature.digest_size)
+            pickle.dump(state, SigningWriter(dst, signature), protocol=pickle.HIGHEST_PROTOCOL)
+            dst.seek(0)
+            dst.write(signature.digest())
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    evict_join_cache(join_cache_dir, join_cache_max_size)
+
+
 class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
-    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex):
+    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir=None):
         self.input_file_dir = input_file_dir
         self.delim = delim
         self.policy = policy
@@ -515,6 +980,7 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         self.comment_prefix = comment_prefix
         self.strip_whitespaces = strip_whitespaces
         self.comment_regex = comment_regex
+        self.join_cache_dir = join_cache_dir
 
         self.active_join_files = []
 
@@ -524,10 +990,26 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         if table_path is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to find join table "{}"'.format(table_id))
         input_stream = open(table_path, 'rb')
-        record_iterator = CSVRecordIterator(input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
+        record_iterator = make_record_iterator(input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
         self.active_join_files.append(ActiveJoinFile(table_path, input_stream, record_iterator))
         return record_iterator
 
+    def build_join_map(self, join_map):
+        # Only hash join maps are cached: other join maps e.g. MergeJoinMap stream the join table instead of building a map in memory.
+        if self.join_cache_dir is None or type(join_map) is not rbql_engine.HashJoinMap:
+            join_map.build()
+            return
+        table_path = [active_join_file.table_path for active_join_file in self.active_join_files if active_join_file.record_iterator is join_map.record_iterator][0]
+        cache_path = get_join_cache_path(self.join_cache_dir, table_path, join_map.record_iterator, join_map.get_key_indices(), join_map.projection)
+        state = load_join_cache(self.join_cache_dir, cache_path)
+        if state is not None:
+            join_map.set_state(state)
+            return
+        join_map.key_filter = None # Build the full join map, so that it can be reused by other queries
+        join_map.build()
+        if not join_map.spill_files: # Join tables that don't fit into memory are not cached
+            save_join_cache(self.join_cache_dir, cache_path, join_map.get_state())
+
     def finish(self):
         for active_join_file in self.active_join_files:
             active_join_file.input_stream.close()
@@ -540,10 +1022,264 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         return result
 
 
-def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, strip_whitespaces=False, comment_regex=None):
+def find_next_line_start(stream, offset):
+    # Returns the offset of the first line that starts at or after `offset`, or the file size if there is no such line.
+    if offset == 0:
+        return 0
+    pos = offset - 1
+    stream.seek(pos)
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            return pos
+        match = binary_newline_rgx.search(chunk)
+        if match is None:
+            pos += len(chunk)
+            continue
+        line_start = pos + match.end()
+        if match.group(0) == b'\r' and match.end() == len(chunk):
+            stream.seek(line_start)
+            if stream.read(1) == b'\n':
+                line_start += 1
+        return line_start
+
+
+def find_data_start(stream, encoding, comment_prefix, comment_regex):
+    # Returns the offset right after the header line i.e. after the first line which is not a comment, and the number of lines before that offset.
+    offset = 0
+    num_lines = 0
+    while True:
+        next_offset = find_next_line_start(stream, offset + 1)
+        if next_offset == offset:
+            return (offset, num_lines)
+        stream.seek(offset)
+        try:
+            line = stream.read(next_offset - offset).decode(encoding).rstrip('\r\n')
+        except UnicodeDecodeError:
+            raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
+        if num_lines == 0:
+            line = remove_utf8_bom(line, encoding)
+        num_lines += 1
+        offset = next_offset
+        if comment_prefix is not None and len(comment_prefix) and line.startswith(comment_prefix):
+            continue
+        if comment_regex is not None and len(comment_regex) and re.search(comment_regex, line) is not None:
+            continue
+        return (offset, num_lines)
+
+
+def split_to_line_aligned_ranges(stream, data_start, data_end, num_ranges):
+    boundaries = [data_start]
+    for i in range(1, num_ranges):
+        boundary = find_next_line_start(stream, data_start + (data_end - data_start) * i // num_ranges)
+        if boundary > boundaries[-1] and boundary < data_end:
+            boundaries.append(boundary)
+    boundaries.append(data_end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class FileRangeReader(io.RawIOBase):
+    # Reads [start, end) byte range of a file as if it was preceded by `prefix` bytes.
+    def __init__(self, path, start, end, prefix):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+        self.prefix = prefix
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if len(self.prefix):
+            data = self.prefix[:len(buf)]
+            self.prefix = self.prefix[len(data):]
+        else:
+            data = self.file.read(min(len(buf), self.remaining))
+            self.remaining -= len(data)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super(FileRangeReader, self).close()
+
+
+class PickledRecordsWriter(rbql_engine.RBQLOutputWriter):
+    # Passes results of a query partition from a worker process to the parent process through a temporary file.
+    def __init__(self, stream):
+        self.stream = stream
+        self.header = None
+        self.batch = []
+
+    def set_header(self, header):
+        self.header = header
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= rbql_engine.default_input_batch_size:
+            self.flush_batch()
+        return True
+
+    def flush_batch(self):
+        try:
+            pickle.dump(self.batch, self.stream, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise rbql_engine.RbqlRuntimeError('Unable to pass query results between worker processes in parallel mode: {}'.format(e))
+        self.batch = []
+
+    def finish(self):
+        self.flush_batch()
+
+
+def iterate_pickled_records(records_path):
+    with open(records_path, 'rb') as src:
+        while True:
+            try:
+                batch = pickle.load(src)
+            except EOFError:
+                return
+            for record in batch:
+                yield record
+
+
+PartitionTask = namedtuple('PartitionTask', ['query_text', 'partition_plan', 'input_path', 'start', 'end', 'prefix', 'input_delim', 'input_policy', 'csv_encoding', 'with_headers', 'comment_prefix', 'user_init_code', 'strip_whitespaces', 'comment_regex', 'debug_mode', 'memory_limit', 'join_cache_dir', 'join_sqlite_db_path'])
+PartitionResult = namedtuple('PartitionResult', ['records_path', 'header', 'aggregate_state', 'NR', 'NL', 'fields_info', 'first_defective_line', 'utf8_bom_removed', 'join_warnings', 'registry_warnings'])
+
+
+def make_join_tables_registry(input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir, join_sqlite_db_path):
+    # Returns the registry and the sqlite connection which should be closed by the caller
+    if join_sqlite_db_path is None:
+        return (FileSystemCSVRegistry(input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir), None)
+    import sqlite3
+    from . import rbql_sqlite
+    if not os.path.isfile(join_sqlite_db_path):
+        raise rbql_engine.RbqlIOHandlingError('Unable to find sqlite database "{}"'.format(join_sqlite_db_path))
+    db_connection = sqlite3.connect(join_sqlite_db_path)
+    return (rbql_sqlite.SqliteDbRegistry(db_connection, lookup_joins=True), db_connection)
+
+
+def run_query_partition(task):
+    # Entry point of a worker process in parallel mode
+    if task.debug_mode:
+        rbql_engine.set_debug_mode()
+    rbql_engine.set_memory_limit(task.memory_limit)
+    input_stream = io.BufferedReader(FileRangeReader(task.input_path, task.start, task.end, task.prefix))
+    join_tables_registry, join_db_connection = make_join_tables_registry(os.path.dirname(task.input_path), task.input_delim, task.input_policy, task.csv_encoding, task.with_headers, task.comment_prefix, task.strip_whitespaces, task.comment_regex, task.join_cache_dir, task.join_sqlite_db_path)
+    records_fd, records_path = tempfile.mkstemp(prefix='rbql_partition_', suffix='.pickle')
+    join_warnings = []
+    try:
+        with os.fdopen(records_fd, 'wb') as records_stream:
+            input_iterator = make_record_iterator(input_stream, task.csv_encoding, task.input_delim, task.input_policy, task.with_headers, comment_prefix=task.comment_prefix, strip_whitespaces=task.strip_whitespaces, comment_regex=task.comment_regex)
+            output_writer = PickledRecordsWriter(records_stream)
+            aggregate_state = rbql_engine.query_partition(task.query_text, task.partition_plan, input_iterator, output_writer, join_warnings, join_tables_registry, task.user_init_code)
+    except Exception:
+        os.remove(records_path)
+        raise
+    finally:
+        input_stream.close()
+        join_tables_registry.finish()
+        if join_db_connection is not None:
+            join_db_connection.close()
+    return PartitionResult(records_path, output_writer.header, aggregate_state, input_iterator.NR, input_iterator.NL, input_iterator.fields_info, input_iterator.first_defective_line, input_iterator.utf8_bom_removed, join_warnings, join_tables_registry.get_warnings())
+
+
+def make_partitioned_input_warnings(partition_results, num_prefix_records, num_prefix_lines):
+    # Converts partition-local record and line numbers to the input table numbers, so that the warnings are the same as in the single process mode.
+    result = []
+    if partition_results[0].utf8_bom_removed:
+        result.append('UTF-8 Byte Order Mark (BOM) was found and skipped in input table')
+    fields_info = dict()
+    first_defective_line = None
+    nr_offset = 0
+    nl_offset = 0
+    for i, partition_result in enumerate(partition_results):
+        skipped_records = num_prefix_records if i > 0 else 0
+        skipped_lines = num_prefix_lines if i > 0 else 0
+        if first_defective_line is None and partition_result.first_defective_line is not None:
+            first_defective_line = nl_offset + partition_result.first_defective_line - skipped_lines
+        for num_fields, record_num in partition_result.fields_info.items():
+            if record_num > skipped_records and num_fields not in fields_info:
+                fields_info[num_fields] = nr_offset + record_num - skipped_records
+        nr_offset += partition_result.NR - skipped_records
+        nl_offset += partition_result.NL - skipped_lines
+    if first_defective_line is not None:
+        result.append('Inconsistent double quote escaping in input table. E.g. at line {}'.format(first_defective_line))
+    if len(fields_info) > 1:
+        result.append(make_inconsistent_num_fields_warning('input', fields_info))
+    return result
+
+
+def add_unique_warnings(output_warnings, new_warnings):
+    for warning in new_warnings:
+        if warning not in output_warnings:
+            output_warnings.append(warning)
+
+
+def query_csv_parallel(query_text, partition_plan, num_workers, input_path, input_delim, input_policy, output_writer, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, strip_whitespaces, comment_regex, join_cache_dir=None, join_sqlite_db_path=None):
+    # Returns False if the input table is too small to be split into multiple partitions.
+    has_header = with_headers
+    if 'header' in partition_plan.query_modifiers or 'headers' in partition_plan.query_modifiers:
+        has_header = True
+    if 'noheader' in partition_plan.query_modifiers or 'noheaders' in partition_plan.query_modifiers:
+        has_header = False
+    with open(input_path, 'rb') as input_stream:
+        # In bytes mode comment prefix and regex are applied to latin-1 decoded lines which is equivalent
+        data_start, num_prefix_lines = find_data_start(input_stream, 'latin-1' if csv_encoding == 'bytes' else csv_encoding, comment_prefix, comment_regex) if has_header else (0, 0)
+        data_end = os.path.getsize(input_path)
+        num_partitions = min(num_workers, (data_end - data_start) // parallel_min_partition_size)
+        if num_partitions < 2:
+            return False
+        ranges = split_to_line_aligned_ranges(input_stream, data_start, data_end, num_partitions)
+        if len(ranges) < 2:
+            return False
+        input_stream.seek(0)
+        prefix = input_stream.read(data_start)
+
+    tasks = []
+    for i, (start, end) in enumerate(ranges):
+        if i == 0:
+            tasks.append(PartitionTask(query_text, partition_plan, input_path, 0, end, b'', input_delim, input_policy, csv_encoding, with_headers, comment_prefix, user_init_code, strip_whitespaces, comment_regex, debug_mode, rbql_engine.memory_limit, join_cache_dir, join_sqlite_db_path))
+        else:
+            tasks.append(PartitionTask(query_text, partition_plan, input_path, start, end, prefix, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, user_init_code, strip_whitespaces, comment_regex, debug_mode, rbql_engine.memory_limit, join_cache_dir, join_sqlite_db_path))
+
+    partition_results = [None] * len(tasks)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_query_partition, task) for task in tasks]
+            first_error = None
+            for i, future in enumerate(futures):
+                try:
+                    partition_results[i] = future.result()
+                except Exception as e:
+                    if first_error is None:
+                        first_error = e
+            if first_error is not None:
+                raise first_error
+        output_writer.set_header(partition_results[0].header)
+        partition_record_streams = [iterate_pickled_records(r.records_path) for r in partition_results]
+        partition_aggregate_states = [r.aggregate_state for r in partition_results]
+        rbql_engine.merge_partitioned_results(partition_plan, partition_record_streams, partition_aggregate_states, output_writer)
+    finally:
+        for partition_result in partition_results:
+            if partition_result is not None:
+                os.remove(partition_result.records_path)
+
+    output_warnings.extend(make_partitioned_input_warnings(partition_results, 1 if has_header else 0, num_prefix_lines))
+    for partition_result in partition_results:
+        add_unique_warnings(output_warnings, partition_result.join_warnings)
+    output_warnings.extend(output_writer.get_warnings())
+    for partition_result in partition_results:
+        add_unique_warnings(output_warnings, partition_result.registry_warnings)
+    return True
+
+
+def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, strip_whitespaces=False, comment_regex=None, parallel=None, join_cache_dir=None, join_sqlite_db_path=None):
+    # With `join_sqlite_db_path` JOIN tables are read from the sqlite database and matching records are looked up by key, which is fast if the join key column is indexed
+    # With "bytes" `csv_encoding` input and output are neither decoded nor encoded and fields of the input records are `bytes`
     output_stream, close_output_on_finish = (None, False)
     input_stream, close_input_on_finish = (None, False)
-    join_tables_registry = None
+    input_mapping = None
+    join_tables_registry, join_db_connection = (None, None)
     try:
         output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
         input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
@@ -553,24 +1289,49 @@ def query_csv(query_text, input_path, input_delim, input_policy, output_path, ou
         if input_delim != ' ' and input_policy == 'whitespace':
             raise rbql_engine.RbqlIOHandlingError('Only whitespace " " delim is supported with "whitespace" policy')
 
-        if not is_ascii(query_text) and csv_encoding == 'latin-1':
+        if not is_ascii(query_text) and csv_encoding in ['latin-1', 'bytes']:
             raise rbql_engine.RbqlIOHandlingError('To use non-ascii characters in query enable UTF-8 encoding instead of latin-1/binary')
 
-        if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding == 'latin-1':
+        if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding in ['latin-1', 'bytes']:
             raise rbql_engine.RbqlIOHandlingError('To use non-ascii separators enable UTF-8 encoding instead of latin-1/binary')
 
+        if csv_encoding == 'bytes' and join_sqlite_db_path is not None:
+            raise rbql_engine.RbqlIOHandlingError('Sqlite JOIN tables are not supported in bytes mode')
+
         default_init_source_path = os.path.join(os.path.expanduser('~'), '.rbql_init_source.py')
         if user_init_code == '' and os.path.exists(default_init_source_path):
             user_init_code = read_user_init_code(default_init_source_path)
 
         input_file_dir = None if not input_path else os.path.dirname(input_path)
-        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, strip_whitespaces, comment_regex)
-        input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
-        output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
+        join_tables_registry, join_db_connection = make_join_tables_registry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir, join_sqlite_db_path)
+        if csv_encoding == 'bytes':
+            output_writer = BytesCSVWriter(output_stream, close_output_on_finish, output_delim, output_policy)
+        else:
+            output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
         if debug_mode:
             rbql_engine.set_debug_mode()
+        if parallel is not None and parallel > 1:
+            partition_plan, fallback_reason = rbql_engine.plan_partitioned_query(query_text)
+            if input_path is None:
+                fallback_reason = 'input is read from stdin'
+            elif input_policy == 'quoted_rfc':
+                fallback_reason = 'records can span multiple lines with "quoted_rfc" policy'
+            if fallback_reason is not None:
+                output_warnings.append('Parallel mode was disabled: {}'.format(fallback_reason))
+            elif query_csv_parallel(query_text, partition_plan, parallel, input_path, input_delim, input_policy, output_writer, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, strip_whitespaces, comment_regex, join_cache_dir, join_sqlite_db_path):
+                return
+        if input_path is not None and input_policy != 'quoted_rfc' and comment_prefix is not None and csv_encoding != 'bytes':
+            # Mapped input is only faster when comment lines can be skipped without decoding: without a comment prefix page faults make full scans of a mapping as slow as or slower than buffered reads.
+            # Lines matched by comment regex are decoded anyway, since the regex is applied to decoded lines.
+            input_mapping = map_input_file(input_stream)
+        if input_mapping is not None:
+            input_iterator = MappedCSVRecordIterator(input_mapping, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        else:
+            input_iterator = make_record_iterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
         rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code)
     finally:
+        if input_mapping is not None:
+            input_mapping.close()
         if close_input_on_finish:
             input_stream.close()
         if close_output_on_finish:
@@ -578,6 +1339,8 @@ def query_csv(query_text, input_path, input_delim, input_policy, output_path, ou
         if join_tables_registry:
             join_tables_registry.finish()
             output_warnings += join_tables_registry.get_warnings()
+        if join_db_connection is not None:
+            join_db_connection.close()
 
 
 def set_debug_mode():
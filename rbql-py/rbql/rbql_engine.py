@@ -1,12 +1,22 @@
 import sys
 import re
 import ast
-from collections import OrderedDict, defaultdict, namedtuple
+import heapq
+import bisect
+import hashlib
+import itertools
+import math
+import operator
+import pickle
+import struct
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, defaultdict, namedtuple, deque
 
 import random # For usage inside user queries only.
 import datetime # For usage inside user queries only.
 import os # For usage inside user queries only.
-import math # For usage inside user queries only.
 import time # For usage inside user queries only.
 
 from ._version import __version__
@@ -39,6 +49,12 @@ EXCEPT = 'EXCEPT'
 WITH = 'WITH'
 FROM = 'FROM'
 
+# Query modifier for GROUP BY queries with input table sorted by the grouping key.
+SORTED_INPUT_MODIFIER = 'sorted'
+
+# Query modifier for JOIN queries with both tables sorted by the join key.
+MERGE_JOIN_MODIFIER = 'mergejoin'
+
 default_statement_groups = [[STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, JOIN], [SELECT], [ORDER_BY], [WHERE], [UPDATE], [GROUP_BY], [LIMIT], [EXCEPT], [FROM]]
 
 ambiguous_error_msg = 'Ambiguous variable name: "{}" is present both in input and in join tables'
@@ -50,6 +66,52 @@ RBQL_VERSION = __version__
 
 debug_mode = False
 
+# Approximate memory limit in bytes for the data that RBQL buffers in memory e.g. for ORDER BY. When exceeded, the data is spilled to temporary files.
+memory_limit = None
+
+# Number of entries per pickled chunk in spill files.
+spill_chunk_size = 1000
+
+# Max number of sorted runs (i.e. temporary files) of ORDER BY queries that exceed the memory limit which are merged at once. More runs are merged in several passes.
+spill_merge_fan_in = 64
+
+# Number of hash partitions (i.e. temporary files) for GROUP BY queries that exceed the memory limit.
+aggregation_spill_partitions = 32
+
+# Number of hash partitions (i.e. temporary files) for JOIN tables that exceed the memory limit.
+join_spill_partitions = 32
+
+# Size of Bloom filters of spilled join keys, which allow to skip partitioning of input records without matches. Set to 0 to disable the filters.
+join_bloom_filter_bits_per_key = 10
+
+# If the input table of a JOIN query has at most this many records, only the join table records with keys from the input table are kept in the join map.
+join_input_prefetch_size = 10000
+
+# Key sets of `IN TABLE` operators with more keys are stored as sorted arrays, which use less memory than hash sets.
+in_table_max_hashed_keys = 1000000
+
+# Number of input records whose join keys are looked up at once by join maps which query the join table directly e.g. an indexed database table.
+join_lookup_batch_size = 1000
+
+# Number of HyperLogLog registers is 2 ** hll_precision, standard error is about 1.04 / sqrt(2 ** hll_precision).
+hll_precision = 12
+
+# HyperLogLog sketches keep exact hashes (and give exact counts) until the number of distinct values exceeds this limit.
+hll_sparse_limit = 128
+
+# Higher t-digest compression gives more accurate percentiles at the cost of more centroids per group.
+tdigest_compression = 100
+
+# Use vectorized numpy execution for simple numeric GROUP BY queries if numpy is installed, see rbql_numpy.py
+numpy_aggregation_enabled = True
+
+# Records are passed between stages of a query pipeline in chunks of this size, the number of chunks buffered in each pipe is limited by pipe_max_buffered_chunks.
+pipe_chunk_size = 1000
+pipe_max_buffered_chunks = 16
+
+# Number of records to pull from the input iterator at once in the main loop. Batching is disabled for queries that can stop early e.g. with TOP/LIMIT.
+default_input_batch_size = 1000
+
 class RbqlRuntimeError(Exception):
     pass
 
@@ -70,14 +132,26 @@ class InternalBadKeyError(Exception):
         self.bad_key = bad_key
 
 
+class InternalPipeAbortedError(Exception):
+    # The stage which writes to the pipe has failed, the error of that stage is reported instead.
+    pass
+
+
 VariableInfo = namedtuple('VariableInfo', ['initialize', 'index'])
 
+# Join table columns (and record number/number of fields) which are referenced by the query, only these are stored in the join map.
+JoinProjection = namedtuple('JoinProjection', ['column_indices', 'store_nr', 'store_nf'])
+
 
 class RBQLContext:
     def __init__(self, input_iterator, output_writer, user_init_code):
         self.input_iterator = input_iterator
         self.writer = output_writer
         self.user_init_code = user_init_code
+        # Type of the input record fields: `str` or `bytes` for iterators that don't decode input
+        self.field_type = input_iterator.get_field_type() if input_iterator is not None else str
+
+        self.input_batch_size = None
 
         self.unnest_list = None
         self.top_count = None
@@ -89,18 +163,28 @@ class RBQLContext:
         self.aggregation_stage = 0
         self.aggregation_key_expression = None
         self.functional_aggregators = []
+        self.aggregation_memory_limit = memory_limit
+        self.aggregation_input_sorted = False
+        self.vectorized_aggregation = None
 
         self.join_map_impl = None
         self.join_map = None
         self.lhs_join_var_expression = None
+        self.join_star_fields_expression = 'record_a + record_b'
 
         self.where_expression = None
+        # Sets of keys of `IN TABLE` and `NOT IN TABLE` operators and iterators of the corresponding tables
+        self.in_table_key_sets = []
+        self.in_table_iterators = []
+        # Leading WHERE conjuncts that reference only input table variables, in JOIN queries they are evaluated once per input record instead of once per join match.
+        self.input_where_expression = None
 
         self.select_expression = None
 
         self.update_expressions = None
 
         self.variables_init_code = None
+        self.join_variables_init_code = None
 
 
 QueryColumnInfo = namedtuple('QueryColumnInfo', ['table_name', 'column_index', 'column_name', 'is_star', 'alias_name'])
@@ -265,6 +349,9 @@ def safe_set(record, idx, value):
 
 
 def like_to_regex(pattern):
+    if isinstance(pattern, bytes):
+        # latin-1 maps each byte to the code point with the same value, so the conversion is lossless
+        return like_to_regex(pattern.decode('latin-1')).encode('latin-1')
     p = 0
     i = 0
     converted = ''
@@ -299,7 +386,7 @@ class NumHandler:
     def parse(self, val):
         if not self.string_detection_done:
             self.string_detection_done = True
-            if isinstance(val, str):
+            if isinstance(val, (str, bytes)):
                 self.is_str = True
         if not self.is_str:
             return val
@@ -313,8 +400,47 @@ class NumHandler:
         except ValueError:
             raise RbqlRuntimeError(numeric_conversion_error.format(val)) # UT JSON
 
+    def get_partial_state(self):
+        return (self.string_detection_done, self.is_str, self.is_int)
+
+    def merge_partial_state(self, state):
+        # Returns True if int values parsed by the other handler must be converted to float i.e. if this handler has already switched to float before.
+        # Partial states must be merged in the input order for this to work.
+        other_string_detection_done, other_is_str, other_is_int = state
+        if not self.string_detection_done:
+            self.string_detection_done = other_string_detection_done
+            self.is_str = other_is_str
+        convert_to_float = self.is_str and not self.is_int
+        self.is_int = self.is_int and other_is_int
+        return convert_to_float
+
+
+class Aggregator(object):
+    # Aggregators can export their partial state as plain picklable data and merge partial states of other aggregators of the same type.
+    # This allows to aggregate input partitions independently e.g. in different processes and to combine the results afterwards.
+    # Partial states must be merged in the input order to get exactly the same result as if all records were processed by a single aggregator.
+    # Per-key data is always stored in the `stats` dict.
+    def get_partial_state(self):
+        return dict(self.stats)
+
+    def merge_partial_state(self, state):
+        self.merge_stats(state)
+
+    def merge_stats(self, stats, convert_to_float=False):
+        # Merges per-key stats which were collected by an aggregator of the same type.
+        raise NotImplementedError('Unable to call the interface method')
+
+    def merge(self, other):
+        self.merge_partial_state(other.get_partial_state())
+
+    @classmethod
+    def from_partial_state(cls, state):
+        result = cls()
+        result.merge_partial_state(state)
+        return result
+
 
-class AnyValueAggregator:
+class AnyValueAggregator(Aggregator):
     def __init__(self):
         self.stats = dict()
 
@@ -325,8 +451,12 @@ class AnyValueAggregator:
     def get_final(self, key):
         return self.stats[key]
 
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, val in stats.items():
+            self.increment(key, val)
 
-class MinAggregator:
+
+class MinAggregator(Aggregator):
     def __init__(self):
         self.stats = dict()
         self.num_handler = NumHandler(True)
@@ -342,8 +472,22 @@ class MinAggregator:
     def get_final(self, key):
         return self.stats[key]
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
+
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, val in stats.items():
+            if convert_to_float and isinstance(val, int):
+                val = float(val)
+            cur_aggr = self.stats.get(key)
+            self.stats[key] = val if cur_aggr is None else min(cur_aggr, val)
+
 
-class MaxAggregator:
+class MaxAggregator(Aggregator):
     def __init__(self):
         self.stats = dict()
         self.num_handler = NumHandler(True)
@@ -359,8 +503,22 @@ class MaxAggregator:
     def get_final(self, key):
         return self.stats[key]
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
+
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, val in stats.items():
+            if convert_to_float and isinstance(val, int):
+                val = float(val)
+            cur_aggr = self.stats.get(key)
+            self.stats[key] = val if cur_aggr is None else max(cur_aggr, val)
+
 
-class SumAggregator:
+class SumAggregator(Aggregator):
     def __init__(self):
         self.stats = defaultdict(int)
         self.num_handler = NumHandler(True)
@@ -372,8 +530,19 @@ class SumAggregator:
     def get_final(self, key):
         return self.stats[key]
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
 
-class AvgAggregator:
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, val in stats.items():
+            self.stats[key] += float(val) if convert_to_float and isinstance(val, int) else val
+
+
+class AvgAggregator(Aggregator):
     def __init__(self):
         self.stats = dict()
         self.num_handler = NumHandler(False)
@@ -391,8 +560,25 @@ class AvgAggregator:
         final_sum, final_cnt = self.stats[key]
         return float(final_sum) / final_cnt
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
+
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        # Values are always parsed as float here, so there is nothing to convert.
+        for key, (other_sum, other_cnt) in stats.items():
+            cur_aggr = self.stats.get(key)
+            if cur_aggr is None:
+                self.stats[key] = (other_sum, other_cnt)
+            else:
+                cur_sum, cur_cnt = cur_aggr
+                self.stats[key] = (cur_sum + other_sum, cur_cnt + other_cnt)
+
 
-class VarianceAggregator:
+class VarianceAggregator(Aggregator):
     def __init__(self):
         self.stats = dict()
         self.num_handler = NumHandler(False)
@@ -410,29 +596,191 @@ class VarianceAggregator:
         final_sum, final_sum_of_squares, final_cnt = self.stats[key]
         return float(final_sum_of_squares) / final_cnt - (float(final_sum) / final_cnt) ** 2
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
 
-class MedianAggregator:
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        # Values are always parsed as float here, so there is nothing to convert.
+        for key, (other_sum, other_sum_of_squares, other_cnt) in stats.items():
+            cur_aggr = self.stats.get(key)
+            if cur_aggr is None:
+                self.stats[key] = (other_sum, other_sum_of_squares, other_cnt)
+            else:
+                cur_sum, cur_sum_of_squares, cur_cnt = cur_aggr
+                self.stats[key] = (cur_sum + other_sum, cur_sum_of_squares + other_sum_of_squares, cur_cnt + other_cnt)
+
+
+class NumericValues(object):
+    # Compact storage for numeric values: 8 bytes per int or float value instead of 30+ bytes for a Python object in a list.
+    # The input order is kept with one byte per value, so that e.g. MEDIAN of equal int and float values returns the same element as a stable sort.
     def __init__(self):
-        self.stats = defaultdict(list)
+        self.ints = array('q')
+        self.floats = array('d')
+        self.others = [] # Integers which don't fit into 64 bits and other numeric types e.g. Decimal
+        self.kinds = array('b') # Index of the storage of each value in the input order: 0 - ints, 1 - floats, 2 - others
+
+    def append(self, val):
+        if type(val) is float:
+            self.floats.append(val)
+            self.kinds.append(1)
+        elif type(val) is int:
+            try:
+                self.ints.append(val)
+                self.kinds.append(0)
+            except OverflowError:
+                self.others.append(val)
+                self.kinds.append(2)
+        else:
+            self.others.append(val)
+            self.kinds.append(2)
+
+    def extend(self, other, convert_to_float=False):
+        if convert_to_float:
+            self.floats.extend(float(v) for v in other.ints)
+            self.others.extend(float(v) if isinstance(v, int) else v for v in other.others)
+            self.kinds.extend(1 if kind == 0 else kind for kind in other.kinds)
+        else:
+            self.ints.extend(other.ints)
+            self.others.extend(other.others)
+            self.kinds.extend(other.kinds)
+        self.floats.extend(other.floats)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def to_list(self):
+        # Returns the values in the input order
+        if len(self.floats) == len(self.kinds):
+            return list(self.floats)
+        if len(self.ints) == len(self.kinds):
+            return list(self.ints)
+        storages = [iter(self.ints), iter(self.floats), iter(self.others)]
+        return [next(storages[kind]) for kind in self.kinds]
+
+
+def select_kth_smallest(values, k):
+    # Quickselect with expected O(n) time. Partitioning is done with list comprehensions which are much faster than element swaps in Python code.
+    # Partitions keep the relative order of values, so the result is the same element as `sorted(values)[k]` even for equal values of different types e.g. 1 and 1.0
+    while len(values) > 16:
+        pivot = sorted([values[0], values[len(values) // 2], values[-1]])[1]
+        lows = [v for v in values if v < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        highs = [v for v in values if v > pivot]
+        num_pivots = len(values) - len(lows) - len(highs)
+        if k < len(lows) + num_pivots:
+            return [v for v in values if not (v < pivot or v > pivot)][k - len(lows)]
+        k -= len(lows) + num_pivots
+        values = highs
+    return sorted(values)[k]
+
+
+def parse_percentile(function_name, percentile):
+    try:
+        percentile = float(percentile)
+    except (TypeError, ValueError):
+        percentile = None
+    if percentile is None or not 0 <= percentile <= 100:
+        raise RbqlRuntimeError('{} percentile must be a number between 0 and 100'.format(function_name)) # UT JSON
+    return percentile
+
+
+def get_exact_percentile(values, percentile, is_sorted=False):
+    # Linear interpolation between the closest ranks, same as the default method in numpy.percentile()
+    rank = percentile / 100.0 * (len(values) - 1)
+    lower_rank = int(math.floor(rank))
+    fraction = rank - lower_rank
+    a = values[lower_rank] if is_sorted else select_kth_smallest(values, lower_rank)
+    if fraction == 0:
+        return a
+    b = values[lower_rank + 1] if is_sorted else select_kth_smallest(values, lower_rank + 1)
+    return a if a == b else a + (b - a) * fraction
+
+
+class MedianAggregator(Aggregator):
+    def __init__(self):
+        self.stats = defaultdict(NumericValues)
         self.num_handler = NumHandler(True)
 
     def increment(self, key, val):
         val = self.num_handler.parse(val)
         self.stats[key].append(val)
 
+    def get_partial_state(self):
+        return (self.num_handler.get_partial_state(), dict(self.stats))
+
+    def merge_partial_state(self, state):
+        num_handler_state, stats = state
+        self.merge_stats(stats, self.num_handler.merge_partial_state(num_handler_state))
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, vals in stats.items():
+            self.stats[key].extend(vals, convert_to_float)
+
     def get_final(self, key):
-        sorted_vals = sorted(self.stats[key])
-        assert len(sorted_vals)
-        m = int(len(sorted_vals) / 2)
-        if len(sorted_vals) % 2:
-            return sorted_vals[m]
+        vals = self.stats[key].to_list()
+        assert len(vals)
+        m = int(len(vals) / 2)
+        if len(vals) % 2:
+            return select_kth_smallest(vals, m)
         else:
-            a = sorted_vals[m - 1]
-            b = sorted_vals[m]
+            a = select_kth_smallest(vals, m - 1)
+            b = select_kth_smallest(vals, m)
             return a if a == b else (a + b) / 2.0
 
 
-class CountAggregator:
+class PercentileAggregator(MedianAggregator):
+    def __init__(self, percentile):
+        super(PercentileAggregator, self).__init__()
+        self.percentile = parse_percentile('PERCENTILE', percentile)
+
+    def get_final(self, key):
+        return get_exact_percentile(self.stats[key].to_list(), self.percentile)
+
+    def get_partial_state(self):
+        return (self.percentile, super(PercentileAggregator, self).get_partial_state())
+
+    def merge_partial_state(self, state):
+        super(PercentileAggregator, self).merge_partial_state(state[1])
+
+    @classmethod
+    def from_partial_state(cls, state):
+        result = cls(state[0])
+        result.merge_partial_state(state)
+        return result
+
+
+class QuantilesAggregator(MedianAggregator):
+    def __init__(self, num_quantiles):
+        super(QuantilesAggregator, self).__init__()
+        if not isinstance(num_quantiles, int) or isinstance(num_quantiles, bool) or num_quantiles < 1:
+            raise RbqlRuntimeError('QUANTILES number of quantiles must be a positive integer') # UT JSON
+        self.num_quantiles = num_quantiles
+
+    def get_final(self, key):
+        # All quantile boundaries are needed, so a single sort is cheaper than multiple selections.
+        sorted_vals = sorted(self.stats[key].to_list())
+        return [get_exact_percentile(sorted_vals, i * 100.0 / self.num_quantiles, is_sorted=True) for i in range(self.num_quantiles + 1)]
+
+    def get_partial_state(self):
+        return (self.num_quantiles, super(QuantilesAggregator, self).get_partial_state())
+
+    def merge_partial_state(self, state):
+        super(QuantilesAggregator, self).merge_partial_state(state[1])
+
+    @classmethod
+    def from_partial_state(cls, state):
+        result = cls(state[0])
+        result.merge_partial_state(state)
+        return result
+
+
+class CountAggregator(Aggregator):
     def __init__(self):
         self.stats = defaultdict(int)
 
@@ -442,8 +790,12 @@ class CountAggregator:
     def get_final(self, key):
         return self.stats[key]
 
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, cnt in stats.items():
+            self.stats[key] += cnt
 
-class ArrayAggAggregator:
+
+class ArrayAggAggregator(Aggregator):
     def __init__(self, post_proc=None):
         self.stats = defaultdict(list)
         self.post_proc = post_proc
@@ -457,21 +809,212 @@ class ArrayAggAggregator:
             return self.post_proc(res)
         return res
 
+    # post_proc is not a part of the partial state, it stays with the aggregator that produces the final values.
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, vals in stats.items():
+            self.stats[key].extend(vals)
+
+
+def hash_value_64(value):
+    # Python's built-in hash() is randomized per process, so it can't be used for sketches which are merged across processes.
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return struct.unpack('>Q', hashlib.sha1(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    def __init__(self):
+        self.hashes = set()
+        self.registers = None
+
+    def add_hash(self, value_hash):
+        if self.registers is not None:
+            self.update_register(value_hash)
+            return
+        self.hashes.add(value_hash)
+        if len(self.hashes) > hll_sparse_limit:
+            self.convert_to_registers()
+
+    def update_register(self, value_hash):
+        register_index = value_hash >> (64 - hll_precision)
+        remaining_bits = (value_hash << hll_precision) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - remaining_bits.bit_length(), 64 - hll_precision) + 1
+        if rank > self.registers[register_index]:
+            self.registers[register_index] = rank
+
+    def convert_to_registers(self):
+        self.registers = bytearray(1 << hll_precision)
+        for value_hash in self.hashes:
+            self.update_register(value_hash)
+        self.hashes = None
+
+    def merge(self, other):
+        if other.registers is None:
+            for value_hash in other.hashes:
+                self.add_hash(value_hash)
+            return
+        if self.registers is None:
+            self.convert_to_registers()
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def estimate(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        num_zero_registers = self.registers.count(0)
+        if estimate <= 2.5 * m and num_zero_registers > 0:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(float(m) / num_zero_registers)
+        return int(round(estimate))
+
+
+class TDigest(object):
+    # Merging t-digest with k1 scale function, see "Computing Extremely Accurate Quantiles Using t-Digests" by T. Dunning and O. Ertl
+    def __init__(self):
+        self.centroids = [] # (mean, weight) pairs sorted by mean
+        self.buffer = []
+        self.min_value = None
+        self.max_value = None
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= 5 * tdigest_compression:
+            self.compress()
+
+    def merge(self, other):
+        self.compress(other.centroids + [(v, 1) for v in other.buffer])
+
+    def max_merged_quantile(self, quantile):
+        k = tdigest_compression / (2 * math.pi) * math.asin(2 * min(quantile, 1.0) - 1) + 1
+        if k >= tdigest_compression / 4.0:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / tdigest_compression) + 1) / 2
+
+    def compress(self, other_centroids=()):
+        points = self.centroids + [(v, 1) for v in self.buffer] + list(other_centroids)
+        self.buffer = []
+        if not points:
+            return
+        points.sort(key=lambda c: c[0])
+        self.min_value = points[0][0] if self.min_value is None else min(self.min_value, points[0][0])
+        self.max_value = points[-1][0] if self.max_value is None else max(self.max_value, points[-1][0])
+        total_weight = float(sum(w for _, w in points))
+        result = []
+        cur_mean, cur_weight = points[0]
+        weight_so_far = 0
+        quantile_limit = self.max_merged_quantile(0.0)
+        for mean, weight in points[1:]:
+            if (weight_so_far + cur_weight + weight) / total_weight <= quantile_limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                result.append((cur_mean, cur_weight))
+                weight_so_far += cur_weight
+                quantile_limit = self.max_merged_quantile(weight_so_far / total_weight)
+                cur_mean, cur_weight = mean, weight
+        result.append((cur_mean, cur_weight))
+        self.centroids = result
+
+    def quantile(self, quantile):
+        # Values are linearly interpolated between centroids, which gives the same result as the exact linear interpolation between ranks when all centroids are singletons.
+        self.compress()
+        total_weight = sum(w for _, w in self.centroids)
+        target_rank = quantile * (total_weight - 1)
+        prev_rank = 0
+        prev_value = self.min_value
+        cumulative_weight = 0
+        for mean, weight in self.centroids:
+            rank = cumulative_weight + (weight - 1) / 2.0
+            if target_rank <= rank:
+                if rank == prev_rank:
+                    return mean
+                return prev_value + (mean - prev_value) * (target_rank - prev_rank) / (rank - prev_rank)
+            prev_rank = rank
+            prev_value = mean
+            cumulative_weight += weight
+        max_rank = total_weight - 1
+        if max_rank == prev_rank:
+            return self.max_value
+        return prev_value + (self.max_value - prev_value) * (target_rank - prev_rank) / (max_rank - prev_rank)
+
+
+class ApproxCountDistinctAggregator(Aggregator):
+    def __init__(self):
+        self.stats = defaultdict(HyperLogLog)
+
+    def increment(self, key, val):
+        self.stats[key].add_hash(hash_value_64(val))
+
+    def get_final(self, key):
+        return self.stats[key].estimate()
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, sketch in stats.items():
+            self.stats[key].merge(sketch)
+
+
+class ApproxPercentileAggregator(Aggregator):
+    def __init__(self, percentile):
+        self.percentile = parse_percentile('APPROX_PERCENTILE', percentile)
+        self.stats = defaultdict(TDigest)
+        self.num_handler = NumHandler(False)
+
+    def increment(self, key, val):
+        self.stats[key].add(float(self.num_handler.parse(val)))
+
+    def get_final(self, key):
+        return self.stats[key].quantile(self.percentile / 100.0)
+
+    def get_partial_state(self):
+        # Values are always converted to float, so there is no need to export the num handler state.
+        return (self.percentile, dict(self.stats))
+
+    def merge_partial_state(self, state):
+        self.merge_stats(state[1])
 
-class ConstGroupVerifier:
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, digest in stats.items():
+            self.stats[key].merge(digest)
+
+    @classmethod
+    def from_partial_state(cls, state):
+        result = cls(state[0])
+        result.merge_partial_state(state)
+        return result
+
+
+class ConstGroupVerifier(Aggregator):
     def __init__(self, output_index):
-        self.const_values = dict()
+        self.stats = dict()
         self.output_index = output_index
 
     def increment(self, key, value):
-        old_value = self.const_values.get(key)
+        old_value = self.stats.get(key)
         if old_value is None:
-            self.const_values[key] = value
+            self.stats[key] = value
         elif old_value != value:
             raise RbqlRuntimeError('Invalid aggregate expression: non-constant values in output column {}. E.g. "{}" and "{}"'.format(self.output_index + 1, old_value, value)) # UT JSON
 
     def get_final(self, key):
-        return self.const_values[key]
+        return self.stats[key]
+
+    def get_partial_state(self):
+        return (self.output_index, dict(self.stats))
+
+    def merge_partial_state(self, state):
+        self.merge_stats(state[1])
+
+    def merge_stats(self, stats, convert_to_float=False):
+        for key, value in stats.items():
+            self.increment(key, value)
+
+    @classmethod
+    def from_partial_state(cls, state):
+        result = cls(state[0])
+        result.merge_partial_state(state)
+        return result
 
 
 def add_to_set(dst_set, value):
@@ -537,33 +1080,311 @@ class UniqCountWriter(object):
         self.subwriter.finish()
 
 
+def estimate_memory_usage(value):
+    # This is a rough estimate: nested containers are not traversed deeper than one level.
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def dump_spill_chunk(spill_file, chunk):
+    try:
+        pickle.dump(chunk, spill_file, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise RbqlRuntimeError('Unable to spill intermediate results to a temporary file: {}'.format(e))
+
+
+def write_spill_file(entries):
+    # `entries` can be any iterable e.g. a merge of other spill files
+    spill_file = tempfile.TemporaryFile(prefix='rbql_spill_')
+    entries = iter(entries)
+    try:
+        while True:
+            chunk = list(itertools.islice(entries, spill_chunk_size))
+            if not chunk:
+                break
+            dump_spill_chunk(spill_file, chunk)
+    except RbqlRuntimeError:
+        spill_file.close()
+        raise
+    spill_file.seek(0)
+    return spill_file
+
+
+def iterate_spill_chunks(spill_file):
+    while True:
+        try:
+            yield pickle.load(spill_file)
+        except EOFError:
+            return
+
+
+def iterate_spill_file(spill_file):
+    for entries in iterate_spill_chunks(spill_file):
+        for e in entries:
+            yield e
+
+
+class BloomFilter(object):
+    # Compact set of keys which can have false positives: `contains` is always True for added keys but can also be True for some other keys
+    def __init__(self, num_keys, bits_per_key):
+        self.num_bits = max(1024, num_keys * bits_per_key)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.num_hashes = max(1, int(round(bits_per_key * 0.693)))
+
+    def get_bit_positions(self, key):
+        # Double hashing: the second hash is derived from the first one by multiplicative hashing
+        h1 = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h2 = (((h1 * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self.get_bit_positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def contains(self, key):
+        for pos in self.get_bit_positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
 class SortedWriter(object):
     def __init__(self, subwriter, reverse_sort):
         self.subwriter = subwriter
         self.reverse_sort = reverse_sort
         self.unsorted_entries = list()
+        self.memory_usage = 0
+        self.sorted_runs = list()
+        # Each run has a merge level: runs of level 0 are spilled directly, runs of level N + 1 are merged from `spill_merge_fan_in` runs of level N.
+        self.sorted_run_levels = list()
 
     def write(self, sort_key_value, record):
         self.unsorted_entries.append((sort_key_value, record))
+        if memory_limit is not None:
+            self.memory_usage += estimate_memory_usage(sort_key_value) + estimate_memory_usage(record)
+            if self.memory_usage > memory_limit:
+                self.add_sorted_run(write_spill_file(self.sort_unsorted_entries()))
+                self.memory_usage = 0
         return True
 
-    def finish(self):
+    def add_sorted_run(self, spill_file):
+        self.sorted_runs.append(spill_file)
+        self.sorted_run_levels.append(0)
+        # Merging runs of the same level keeps the number of open temporary files logarithmic in the input size and each entry is rewritten only once per level.
+        while len(self.sorted_runs) >= spill_merge_fan_in and len(set(self.sorted_run_levels[-spill_merge_fan_in:])) == 1:
+            self.merge_last_sorted_runs()
+
+    def merge_last_sorted_runs(self):
+        # Only adjacent runs are merged, so that entries with equal keys keep their order.
+        num_runs = min(spill_merge_fan_in, len(self.sorted_runs))
+        runs = self.sorted_runs[-num_runs:]
+        merged_run = write_spill_file(self.merge_sorted_runs([iterate_spill_file(f) for f in runs]))
+        merged_level = max(self.sorted_run_levels[-num_runs:]) + 1
+        for spill_file in runs:
+            spill_file.close()
+        del self.sorted_runs[-num_runs:]
+        del self.sorted_run_levels[-num_runs:]
+        self.sorted_runs.append(merged_run)
+        self.sorted_run_levels.append(merged_level)
+
+    def merge_sorted_runs(self, sorted_runs):
+        if self.reverse_sort:
+            # Runs are in DESC order, so in case of equal keys entries from the later runs must go first, see also merge_partitioned_results().
+            sorted_runs = sorted_runs[::-1]
+        return heapq.merge(*sorted_runs, key=lambda x: x[0], reverse=self.reverse_sort)
+
+    def sort_unsorted_entries(self):
         sorted_entries = sorted(self.unsorted_entries, key=lambda x: x[0])
         if self.reverse_sort:
             sorted_entries.reverse()
+        self.unsorted_entries = list()
+        return sorted_entries
+
+    def iterate_sorted_entries(self):
+        last_run = self.sort_unsorted_entries()
+        if not len(self.sorted_runs):
+            return last_run
+        while len(self.sorted_runs) >= spill_merge_fan_in:
+            self.merge_last_sorted_runs()
+        return self.merge_sorted_runs([iterate_spill_file(f) for f in self.sorted_runs] + [last_run])
+
+    def write_sorted_entry(self, entry):
+        return self.subwriter.write(entry[1])
+
+    def finish(self):
+        try:
+            for e in self.iterate_sorted_entries():
+                if not self.write_sorted_entry(e):
+                    break
+        finally:
+            for spill_file in self.sorted_runs:
+                spill_file.close()
+        self.subwriter.finish()
+
+
+class InvertedSortKey(object):
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class TopKSortedWriter(object):
+    # Equivalent of SortedWriter followed by TopWriter which keeps only top_count entries in memory.
+    # Sorting in SortedWriter is stable, so entries are ordered by (sort_key, NW) and in DESC order later entries with equal keys go first.
+    # The heap root is the worst of the kept entries, so that it can be replaced by a better one.
+    def __init__(self, subwriter, reverse_sort, top_count, emit_sort_keys=False):
+        self.subwriter = subwriter
+        self.reverse_sort = reverse_sort
+        self.top_count = top_count
+        self.emit_sort_keys = emit_sort_keys
+        self.NW = 0
+        self.heap = []
+
+    def write(self, sort_key_value, record):
+        self.NW += 1
+        if self.reverse_sort:
+            entry = (sort_key_value, self.NW, record)
+        else:
+            entry = (InvertedSortKey(sort_key_value), -self.NW, record)
+        if len(self.heap) < self.top_count:
+            heapq.heappush(self.heap, entry)
+        elif self.top_count > 0 and self.heap[0][:2] < entry[:2]:
+            heapq.heapreplace(self.heap, entry)
+        return True
+
+    def finish(self):
+        sorted_entries = sorted(self.heap, key=lambda x: x[:2], reverse=True)
         for e in sorted_entries:
-            if not self.subwriter.write(e[1]):
+            sort_key_value = e[0] if self.reverse_sort else e[0].value
+            output = (sort_key_value, e[2]) if self.emit_sort_keys else e[2]
+            if not self.subwriter.write(output):
                 break
         self.subwriter.finish()
 
 
+class PartitionSortedWriter(SortedWriter):
+    # Sorts results of a single input partition and emits (sort_key, record) pairs, so that results of all partitions can be k-way merged afterwards
+    def write_sorted_entry(self, entry):
+        return self.subwriter.write(entry)
+
+
+class UniqCountMergeWriter(UniqCountWriter):
+    # Combines outputs of multiple UniqCountWriter instances i.e. records with counts in the first field
+    def write(self, record):
+        cnt = record[0]
+        record = tuple(record[1:])
+        if record in self.records:
+            self.records[record] += cnt
+        else:
+            self.records[record] = cnt
+        return True
+
+
 class AggregateWriter(object):
-    def __init__(self, subwriter):
+    def __init__(self, subwriter, memory_limit=None):
         self.subwriter = subwriter
         self.aggregators = []
         self.aggregation_keys = set()
+        self.memory_limit = memory_limit
+        self.memory_usage = 0
+        self.accumulates_values = None
+        # When the memory limit is exceeded the groups are hash-partitioned by key and spilled, so that each partition can be aggregated separately in the end.
+        self.spill_files = []
+
+    def add_key(self, key, transparent_values):
+        # Returns False if no more input records are needed
+        if self.memory_limit is None:
+            self.aggregation_keys.add(key)
+            return True
+        if self.accumulates_values is None:
+            self.accumulates_values = any(isinstance(ag, (MedianAggregator, ArrayAggAggregator)) for ag in self.aggregators)
+        if key not in self.aggregation_keys:
+            self.aggregation_keys.add(key)
+            self.memory_usage += estimate_memory_usage(key) + estimate_memory_usage(transparent_values)
+        elif self.accumulates_values:
+            self.memory_usage += estimate_memory_usage(transparent_values)
+        if self.memory_usage > self.memory_limit:
+            self.spill()
+        return True
+
+    def spill(self):
+        if not self.spill_files:
+            self.spill_files = [tempfile.TemporaryFile(prefix='rbql_spill_') for _ in range(aggregation_spill_partitions)]
+        partition_keys = [list() for _ in self.spill_files]
+        for key in self.aggregation_keys:
+            partition_keys[hash(key) % len(partition_keys)].append(key)
+        for spill_file, keys in zip(self.spill_files, partition_keys):
+            if keys:
+                dump_spill_chunk(spill_file, (keys, [{key: ag.stats[key] for key in keys} for ag in self.aggregators]))
+        for ag in self.aggregators:
+            ag.stats.clear()
+        self.aggregation_keys = set()
+        self.memory_usage = 0
+
+    def aggregate_spilled_partition(self, spill_file):
+        # All chunks were produced by the same aggregators which have seen the values in the input order, so there is no need to convert numeric stats.
+        spill_file.seek(0)
+        keys = set()
+        for chunk_keys, chunk_stats in iterate_spill_chunks(spill_file):
+            keys.update(chunk_keys)
+            for ag, stats in zip(self.aggregators, chunk_stats):
+                ag.merge_stats(stats)
+        result = [(key, [ag.get_final(key) for ag in self.aggregators]) for key in sorted(list(keys))]
+        for ag in self.aggregators:
+            ag.stats.clear()
+        return write_spill_file(result)
+
+    def finish_spilled(self):
+        self.spill()
+        sorted_runs = []
+        try:
+            for spill_file in self.spill_files:
+                sorted_runs.append(self.aggregate_spilled_partition(spill_file))
+                spill_file.close()
+            # Keys of different partitions never intersect, so merging the sorted partition results gives all groups in the sorted order.
+            for _key, out_fields in heapq.merge(*[iterate_spill_file(run) for run in sorted_runs], key=lambda x: x[0]):
+                if not self.subwriter.write(out_fields):
+                    break
+        finally:
+            for spill_file in self.spill_files + sorted_runs:
+                spill_file.close()
+
+    def get_partial_state(self):
+        assert not self.spill_files
+        aggregator_states = [(type(ag), ag.get_partial_state()) for ag in self.aggregators]
+        return (aggregator_states, list(self.aggregation_keys))
+
+    def merge_partial_state(self, state):
+        aggregator_states, aggregation_keys = state
+        assert len(aggregator_states) == len(self.aggregators)
+        for ag, (_aggregator_type, aggregator_state) in zip(self.aggregators, aggregator_states):
+            ag.merge_partial_state(aggregator_state)
+        self.aggregation_keys.update(aggregation_keys)
+
+    def merge(self, other):
+        self.merge_partial_state(other.get_partial_state())
+
+    @classmethod
+    def from_partial_state(cls, subwriter, state):
+        result = cls(subwriter)
+        aggregator_states, aggregation_keys = state
+        result.aggregators = [aggregator_type.from_partial_state(aggregator_state) for aggregator_type, aggregator_state in aggregator_states]
+        result.aggregation_keys.update(aggregation_keys)
+        return result
 
     def finish(self):
+        if self.spill_files:
+            self.finish_spilled()
+            self.subwriter.finish()
+            return
         all_keys = sorted(list(self.aggregation_keys))
         for key in all_keys:
             out_fields = [ag.get_final(key) for ag in self.aggregators]
@@ -572,6 +1393,51 @@ class AggregateWriter(object):
         self.subwriter.finish()
 
 
+def format_key_for_error(key):
+    # GROUP BY and multi-column JOIN keys are tuples, show them as comma separated values instead of python tuple repr
+    if isinstance(key, tuple):
+        return ', '.join(format_key_for_error(v) for v in key)
+    if isinstance(key, bytes):
+        return key.decode('latin-1')
+    return str(key)
+
+
+class SortedInputAggregateWriter(AggregateWriter):
+    # Input records must be sorted by the GROUP BY key: each group is written out as soon as the key changes, so only the current group is kept in memory.
+    def __init__(self, subwriter):
+        super(SortedInputAggregateWriter, self).__init__(subwriter)
+        self.current_key = None
+        self.has_current_key = False
+        self.writer_stopped = False
+
+    def add_key(self, key, transparent_values):
+        if self.has_current_key and key != self.current_key:
+            if key < self.current_key:
+                raise RbqlRuntimeError('Input table is not sorted by the "GROUP BY" key which is required by "WITH ({})" query modifier. E.g. key "{}" goes after "{}"'.format(SORTED_INPUT_MODIFIER, format_key_for_error(key), format_key_for_error(self.current_key)))
+            if not self.write_current_group():
+                return False
+        self.current_key = key
+        self.has_current_key = True
+        return True
+
+    def write_current_group(self):
+        out_fields = [ag.get_final(self.current_key) for ag in self.aggregators]
+        for ag in self.aggregators:
+            del ag.stats[self.current_key]
+        self.has_current_key = False
+        if not self.subwriter.write(out_fields):
+            self.writer_stopped = True
+        return not self.writer_stopped
+
+    def get_partial_state(self):
+        raise RbqlRuntimeError('Partial aggregation state is not available for "WITH ({})" queries'.format(SORTED_INPUT_MODIFIER))
+
+    def finish(self):
+        if self.has_current_key and not self.writer_stopped:
+            self.write_current_group()
+        self.subwriter.finish()
+
+
 class InnerJoiner(object):
     def __init__(self, join_map):
         self.join_map = join_map
@@ -583,11 +1449,15 @@ class InnerJoiner(object):
 class LeftJoiner(object):
     def __init__(self, join_map):
         self.join_map = join_map
-        self.null_record = [(None, join_map.max_record_len, [None] * join_map.max_record_len)]
+        self.null_record = None
 
     def get_rhs(self, lhs_key):
         result = self.join_map.get_join_records(lhs_key)
         if len(result) == 0:
+            # The null record is created lazily because the join map can be built on the first read from the input table.
+            if self.null_record is None:
+                null_record_len = self.join_map.get_null_record_len()
+                self.null_record = [(None, null_record_len, [None] * null_record_len)]
             return self.null_record
         return result
 
@@ -623,9 +1493,12 @@ def select_simple(query_context, sort_key, out_fields):
 
 def select_aggregated(query_context, key, transparent_values):
     if query_context.aggregation_stage == 1:
-        if type(query_context.writer) is SortedWriter or type(query_context.writer) is UniqWriter or type(query_context.writer) is UniqCountWriter:
+        if isinstance(query_context.writer, (SortedWriter, TopKSortedWriter, UniqWriter, UniqCountWriter)):
             raise RbqlParsingError(invalid_keyword_in_aggregate_query_error_msg) # UT JSON
-        query_context.writer = AggregateWriter(query_context.writer)
+        if query_context.aggregation_input_sorted:
+            query_context.writer = SortedInputAggregateWriter(query_context.writer)
+        else:
+            query_context.writer = AggregateWriter(query_context.writer, query_context.aggregation_memory_limit)
         num_aggregators_found = 0
         for i, trans_value in enumerate(transparent_values):
             if isinstance(trans_value, RBQLAggregationToken):
@@ -641,7 +1514,7 @@ def select_aggregated(query_context, key, transparent_values):
     else:
         for i, trans_value in enumerate(transparent_values):
             query_context.writer.aggregators[i].increment(key, trans_value)
-    query_context.writer.aggregation_keys.add(key)
+    return query_context.writer.add_key(key, transparent_values)
 
 
 PROCESS_SELECT_COMMON = '''
@@ -650,7 +1523,8 @@ if __RBQLMP__where_expression:
     out_fields = __RBQLMP__select_expression
     if query_context.aggregation_stage > 0:
         key = __RBQLMP__aggregation_key_expression
-        select_aggregated(query_context, key, out_fields)
+        if not select_aggregated(query_context, key, out_fields):
+            stop_flag = True
     else:
         sort_key = __RBQLMP__sort_key_expression
         if query_context.unnest_list is not None:
@@ -670,12 +1544,15 @@ __CODE__
 
 PROCESS_SELECT_JOIN = '''
 join_matches = query_context.join_map.get_rhs(__RBQLMP__lhs_join_var_expression)
-for join_match in join_matches:
-    bNR, bNF, record_b = join_match
-    star_fields = record_a + record_b
-    __CODE__
-    if stop_flag:
-        break
+if join_matches:
+    __RBQLMP__input_variables_init_code
+    if __RBQLMP__input_where_expression:
+        for join_match in join_matches:
+            bNR, bNF, record_b = join_match
+            star_fields = __RBQLMP__join_star_fields_expression
+            __CODE__
+            if stop_flag:
+                break
 '''
 
 
@@ -689,6 +1566,7 @@ else:
     bNR, bNF, record_b = None, None, None
 up_fields = record_a[:]
 __RBQLMP__variables_init_code
+__RBQLMP__join_variables_init_code
 if len(join_matches) == 1 and (__RBQLMP__where_expression):
     NU += 1
     __RBQLMP__update_expressions
@@ -707,9 +1585,53 @@ if not query_context.writer.write(up_fields):
     stop_flag = True
 '''
 
+
+RECORDS_LOOP_SIMPLE = '''
+while not stop_flag:
+    record_a = query_context.input_iterator.get_record()
+    if record_a is None:
+        break
+    __PROCESS_RECORD__
+'''
+
+
+# Batched loop pulls records in lists to avoid paying the per-record method dispatch of the input iterator.
+RECORDS_LOOP_BATCHED = '''
+while not stop_flag:
+    records_batch = query_context.input_iterator.get_records(__RBQLMP__input_batch_size)
+    if not records_batch:
+        break
+    for record_a in records_batch:
+        __PROCESS_RECORD__
+        if stop_flag:
+            break
+'''
+
+
+PROCESS_RECORD = '''
+NR += 1
+NF = len(record_a)
+query_context.unnest_list = None # TODO optimize, don't need to set this every iteration
+try:
+    __CODE__
+except InternalBadKeyError as e:
+    raise RbqlRuntimeError('No "{}" field at record {}'.format(e.bad_key, NR)) # UT JSON
+except InternalBadFieldError as e:
+    raise RbqlRuntimeError('No "a{}" field at record {}'.format(e.bad_idx + 1, NR)) # UT JSON
+except RbqlParsingError:
+    raise
+except Exception as e:
+    if debug_mode:
+        raise
+    if str(e).find('RBQLAggregationToken') != -1:
+        raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
+    raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
+'''
+
+
 # We need dummy_wrapper_for_exec function because otherwise "import" statements won't work as expected if used inside user-defined functions, see: https://github.com/mechatroner/sublime_rainbow_csv/issues/22
 MAIN_LOOP_BODY = '''
-def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested):
+def dummy_wrapper_for_exec(query_context, user_namespace, FIELD_TYPE, AS_FIELD, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, PERCENTILE, QUANTILES, ARRAY_AGG, APPROX_COUNT_DISTINCT, APPROX_PERCENTILE, mad_max, mad_min, mad_sum, select_unnested):
 
     try:
         pass
@@ -717,6 +1639,7 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
     except Exception as e:
         raise RuntimeError('Exception while executing user-provided init code: {}'.format(e))
 
+    as_field = AS_FIELD
     like = LIKE
     unnest = UNNEST
     Unnest = UNNEST
@@ -733,7 +1656,15 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
     Variance = VARIANCE
     median = MEDIAN
     Median = MEDIAN
+    percentile = PERCENTILE
+    Percentile = PERCENTILE
+    quantiles = QUANTILES
+    Quantiles = QUANTILES
     array_agg = ARRAY_AGG
+    approx_count_distinct = APPROX_COUNT_DISTINCT
+    Approx_count_distinct = APPROX_COUNT_DISTINCT
+    approx_percentile = APPROX_PERCENTILE
+    Approx_percentile = APPROX_PERCENTILE
     max = mad_max
     min = mad_min
     sum = mad_sum
@@ -744,29 +1675,9 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
     NU = 0
     stop_flag = False
 
-    while not stop_flag:
-        record_a = query_context.input_iterator.get_record()
-        if record_a is None:
-            break
-        NR += 1
-        NF = len(record_a)
-        query_context.unnest_list = None # TODO optimize, don't need to set this every iteration
-        try:
-            __CODE__
-        except InternalBadKeyError as e:
-            raise RbqlRuntimeError('No "{}" field at record {}'.format(e.bad_key, NR)) # UT JSON
-        except InternalBadFieldError as e:
-            raise RbqlRuntimeError('No "a{}" field at record {}'.format(e.bad_idx + 1, NR)) # UT JSON
-        except RbqlParsingError:
-            raise
-        except Exception as e:
-            if debug_mode:
-                raise
-            if str(e).find('RBQLAggregationToken') != -1:
-                raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
-            raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
-
-dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
+    __RECORDS_LOOP__
+
+dummy_wrapper_for_exec(query_context, user_namespace, FIELD_TYPE, AS_FIELD, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, PERCENTILE, QUANTILES, ARRAY_AGG, APPROX_COUNT_DISTINCT, APPROX_PERCENTILE, mad_max, mad_min, mad_sum, select_unnested)
 '''
 
 
@@ -800,13 +1711,24 @@ def generate_main_loop_code(query_context):
     aggregation_key_expression = 'None' if query_context.aggregation_key_expression is None else query_context.aggregation_key_expression
     sort_key_expression = 'None' if query_context.sort_key_expression is None else query_context.sort_key_expression
     python_code = embed_code(MAIN_LOOP_BODY, '__USER_INIT_CODE__', query_context.user_init_code)
+    if query_context.input_batch_size is not None:
+        python_code = embed_code(python_code, '__RECORDS_LOOP__', RECORDS_LOOP_BATCHED)
+        python_code = embed_expression(python_code, '__RBQLMP__input_batch_size', str(query_context.input_batch_size))
+    else:
+        python_code = embed_code(python_code, '__RECORDS_LOOP__', RECORDS_LOOP_SIMPLE)
+    python_code = embed_code(python_code, '__PROCESS_RECORD__', PROCESS_RECORD)
     if is_select_query:
         if is_join_query:
+            input_where_expression = 'True' if query_context.input_where_expression is None else query_context.input_where_expression
             python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN), '__CODE__', PROCESS_SELECT_COMMON)
             python_code = embed_expression(python_code, '__RBQLMP__lhs_join_var_expression', query_context.lhs_join_var_expression)
+            python_code = embed_expression(python_code, '__RBQLMP__join_star_fields_expression', query_context.join_star_fields_expression)
+            python_code = embed_code(python_code, '__RBQLMP__input_variables_init_code', query_context.variables_init_code)
+            python_code = embed_expression(python_code, '__RBQLMP__input_where_expression', input_where_expression)
+            python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.join_variables_init_code)
         else:
             python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_SIMPLE), '__CODE__', PROCESS_SELECT_COMMON)
-        python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
+            python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
         python_code = embed_expression(python_code, '__RBQLMP__select_expression', query_context.select_expression)
         python_code = embed_expression(python_code, '__RBQLMP__where_expression', where_expression)
         python_code = embed_expression(python_code, '__RBQLMP__aggregation_key_expression', aggregation_key_expression)
@@ -815,6 +1737,7 @@ def generate_main_loop_code(query_context):
         if is_join_query:
             python_code = embed_code(python_code, '__CODE__', PROCESS_UPDATE_JOIN)
             python_code = embed_expression(python_code, '__RBQLMP__lhs_join_var_expression', query_context.lhs_join_var_expression)
+            python_code = embed_code(python_code, '__RBQLMP__join_variables_init_code', query_context.join_variables_init_code)
         else:
             python_code = embed_code(python_code, '__CODE__', PROCESS_UPDATE_SIMPLE)
         python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
@@ -830,12 +1753,25 @@ builtin_sum = sum
 
 def compile_and_run(query_context, user_namespace, unit_test_mode=False):
     def LIKE(text, pattern):
+        if isinstance(text, bytes) and isinstance(pattern, str):
+            pattern = pattern.encode('latin-1')
         matcher = query_context.like_regex_cache.get(pattern, None)
         if matcher is None:
             matcher = re.compile(like_to_regex(pattern))
             query_context.like_regex_cache[pattern] = matcher
         return matcher.match(text) is not None
 
+    def AS_FIELD(value):
+        # Converts a value to the type of the input fields e.g. to compare fields with string literals in bytes mode: `a1 == AS_FIELD('ERROR')`
+        if isinstance(value, query_context.field_type):
+            return value
+        if isinstance(value, bytes):
+            return value.decode('latin-1')
+        value = str(value)
+        return value.encode('latin-1') if query_context.field_type is bytes else value
+
+    FIELD_TYPE = query_context.field_type
+
     class UNNEST:
         def __init__(self, vals):
             if query_context.unnest_list is not None:
@@ -860,13 +1796,10 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
                 return False
         return True
 
-    def init_aggregator(generator_name, val, post_proc=None):
+    def init_aggregator(generator_name, val, *params):
         query_context.aggregation_stage = 1
         res = RBQLAggregationToken(len(query_context.functional_aggregators), val)
-        if post_proc is not None:
-            query_context.functional_aggregators.append(generator_name(post_proc))
-        else:
-            query_context.functional_aggregators.append(generator_name())
+        query_context.functional_aggregators.append(generator_name(*params))
         return res
 
 
@@ -898,12 +1831,24 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
         # TODO consider passing array to output writer
         return init_aggregator(ArrayAggAggregator, val, post_proc) if query_context.aggregation_stage < 2 else val
 
+    def PERCENTILE(val, percentile):
+        return init_aggregator(PercentileAggregator, val, percentile) if query_context.aggregation_stage < 2 else val
+
+    def QUANTILES(val, num_quantiles):
+        return init_aggregator(QuantilesAggregator, val, num_quantiles) if query_context.aggregation_stage < 2 else val
+
+    def APPROX_COUNT_DISTINCT(val):
+        return init_aggregator(ApproxCountDistinctAggregator, val) if query_context.aggregation_stage < 2 else val
+
+    def APPROX_PERCENTILE(val, percentile):
+        return init_aggregator(ApproxPercentileAggregator, val, percentile) if query_context.aggregation_stage < 2 else val
+
 
     # We use `mad_` prefix with the function names to avoid ovewriting global min/max/sum just yet - this might interfere with logic inside user-defined functions in the init code.
     def mad_max(*args, **kwargs):
         single_arg = len(args) == 1 and not kwargs
         if single_arg:
-            if isinstance(args[0], str):
+            if isinstance(args[0], (str, bytes)):
                 return MAX(args[0])
             if isinstance(args[0], int) or isinstance(args[0], float):
                 return MAX(args[0])
@@ -918,7 +1863,7 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
     def mad_min(*args, **kwargs):
         single_arg = len(args) == 1 and not kwargs
         if single_arg:
-            if isinstance(args[0], str):
+            if isinstance(args[0], (str, bytes)):
                 return MIN(args[0])
             if isinstance(args[0], int) or isinstance(args[0], float):
                 return MIN(args[0])
@@ -942,6 +1887,11 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
         # Return these 3 functions to be able to unit test them from outside
         return (mad_max, mad_min, mad_sum)
 
+    if query_context.vectorized_aggregation is not None:
+        from . import rbql_numpy
+        rbql_numpy.run_vectorized_aggregation(query_context.vectorized_aggregation, query_context.input_iterator, query_context.writer)
+        return
+
     main_loop_body = generate_main_loop_code(query_context)
     compiled_main_loop = compile(main_loop_body, '<main loop>', 'exec')
     exec(compiled_main_loop, globals(), locals())
@@ -1128,19 +2078,144 @@ def generate_common_init_code(query_text, variable_prefix):
     return result
 
 
-def generate_init_statements(query_text, variables_map, join_variables_map):
+def plan_join_projection(format_expression, rb_actions, join_variables_map):
+    # Returns None if the query needs whole join records e.g. for `SELECT *` or `SELECT b.*`
+    if format_expression.find('record_b') != -1 or format_expression.find('star_fields') != -1:
+        return None
+    if SELECT in rb_actions and re.search(r'(?:^|,) *(\*|b\.\*) *(?=$|,)', rb_actions[SELECT]['text']) is not None:
+        return None
+    column_indices = sorted(set(var_info.index for var_info in join_variables_map.values()))
+    store_nr = format_expression.find('bNR') != -1 or format_expression.find('b.NR') != -1
+    store_nf = format_expression.find('bNF') != -1 or format_expression.find('b.NF') != -1
+    return JoinProjection(column_indices, store_nr, store_nf)
+
+
+def project_join_variables(join_variables_map, projection):
+    projected_positions = {column_index: i for i, column_index in enumerate(projection.column_indices)}
+    return {var_name: VariableInfo(initialize=var_info.initialize, index=projected_positions[var_info.index]) for var_name, var_info in join_variables_map.items()}
+
+
+def generate_init_statements(query_text, variables_map):
     code_lines = generate_common_init_code(query_text, 'a')
     for var_name, var_info in variables_map.items():
         if var_info.initialize:
             code_lines.append('{} = safe_get(record_a, {})'.format(var_name, var_info.index))
-    if join_variables_map:
-        code_lines += generate_common_init_code(query_text, 'b')
-        for var_name, var_info in join_variables_map.items():
-            if var_info.initialize:
-                code_lines.append('{} = safe_get(record_b, {}) if record_b is not None else None'.format(var_name, var_info.index))
     return '\n'.join(code_lines)
 
 
+def generate_join_init_statements(query_text, join_variables_map):
+    code_lines = generate_common_init_code(query_text, 'b')
+    for var_name, var_info in join_variables_map.items():
+        if var_info.initialize:
+            code_lines.append('{} = safe_get(record_b, {}) if record_b is not None else None'.format(var_name, var_info.index))
+    return '\n'.join(code_lines)
+
+
+class SortedKeySet(object):
+    def __init__(self, sorted_keys):
+        self.sorted_keys = sorted_keys
+
+    def __contains__(self, key):
+        try:
+            i = bisect.bisect_left(self.sorted_keys, key)
+        except TypeError:
+            return False # Keys of incomparable types are not equal either, same as with hash sets
+        return i < len(self.sorted_keys) and self.sorted_keys[i] == key
+
+
+def build_in_table_key_set(record_iterator):
+    # Only the first column of the table is kept, so duplicate keys never multiply input records unlike in JOIN
+    keys = []
+    nr = 0
+    while True:
+        records = record_iterator.get_records(default_input_batch_size)
+        if not records:
+            break
+        for fields in records:
+            nr += 1
+            if not len(fields):
+                raise RbqlRuntimeError('No key field at record {} in "B" table of IN TABLE operator: the key is the first column of the table'.format(nr))
+            keys.append(fields[0])
+    if len(keys) <= in_table_max_hashed_keys:
+        return set(keys)
+    try:
+        keys.sort()
+    except TypeError:
+        return set(keys)
+    return SortedKeySet([key for i, key in enumerate(keys) if i == 0 or key != keys[i - 1]])
+
+
+def resolve_in_table_operators(expression, tables_registry, query_modifiers, query_context):
+    # Replaces `IN TABLE <table_id>` and `NOT IN TABLE <table_id>` operators with python `in` and `not in` checks against the key sets of the tables.
+    # The operators are case-sensitive, so that python expressions like `a1 in table` with a python variable `table` are left intact.
+    def replace_operator(match):
+        table_id = match.group(2)
+        if tables_registry is None:
+            raise RbqlParsingError('IN TABLE operations are not supported by the application')
+        record_iterator = tables_registry.get_iterator_by_table_id(table_id, 'b')
+        if record_iterator is None:
+            raise RbqlParsingError('Unable to find table: "{}"'.format(table_id))
+        for modifier in query_modifiers:
+            record_iterator.handle_query_modifier(modifier)
+        query_context.in_table_iterators.append(record_iterator)
+        query_context.in_table_key_sets.append(build_in_table_key_set(record_iterator))
+        operator_text = 'not in' if match.group(1) is not None else 'in'
+        return '{} query_context.in_table_key_sets[{}]'.format(operator_text, len(query_context.in_table_key_sets) - 1)
+    return re.sub(r'(?<![_a-zA-Z0-9])(NOT +)?IN +TABLE +([^ (),]+)', replace_operator, expression)
+
+
+def split_top_level_conjuncts(expression):
+    result = []
+    depth = 0
+    conjunct_start = 0
+    for match in re.finditer(r'[(\[{]|[)\]}]|(?<![_a-zA-Z0-9])and(?![_a-zA-Z0-9])', expression):
+        token = match.group(0)
+        if token in '([{':
+            depth += 1
+        elif token in ')]}':
+            depth -= 1
+        elif depth == 0:
+            result.append(expression[conjunct_start:match.start()].strip())
+            conjunct_start = match.end()
+    result.append(expression[conjunct_start:].strip())
+    return result
+
+
+def references_join_variables(expression):
+    try:
+        root = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return True
+    for node in ast.walk(root):
+        if isinstance(node, ast.Name):
+            name = get_field(node, 'id')
+            if name in ['b', 'bNR', 'bNF', 'record_b', 'star_fields'] or re.match('^b[0-9]+$', name) is not None:
+                return True
+    return False
+
+
+def split_join_where_expression(where_expression):
+    # Returns (input_where_expression, join_where_expression), either can be None.
+    # Only the leading conjuncts are moved to the input where expression to preserve the evaluation order and short-circuiting of the original expression.
+    try:
+        root = ast.parse(where_expression.strip(), mode='eval')
+    except SyntaxError:
+        return (None, where_expression)
+    body = get_field(root, 'body')
+    if isinstance(body, ast.BoolOp) and isinstance(get_field(body, 'op'), ast.And):
+        conjuncts = split_top_level_conjuncts(where_expression)
+        if len(conjuncts) != len(get_field(body, 'values')):
+            return (None, where_expression)
+    else:
+        conjuncts = [where_expression.strip()]
+    num_input_conjuncts = 0
+    while num_input_conjuncts < len(conjuncts) and not references_join_variables(conjuncts[num_input_conjuncts]):
+        num_input_conjuncts += 1
+    input_where_expression = ' and '.join(conjuncts[:num_input_conjuncts]) if num_input_conjuncts > 0 else None
+    join_where_expression = ' and '.join(conjuncts[num_input_conjuncts:]) if num_input_conjuncts < len(conjuncts) else None
+    return (input_where_expression, join_where_expression)
+
+
 def replace_star_count(aggregate_expression):
     return re.sub(r'(?:(?<=^)|(?<=,)) *COUNT\( *\* *\)', ' COUNT(1)', aggregate_expression, flags=re.IGNORECASE).lstrip(' ')
 
@@ -1260,11 +2335,11 @@ def separate_actions(statement_groups, rbql_expression):
     # make sure all rbql_expression was separated and SELECT or UPDATE is at the beginning
     rbql_expression = rbql_expression.strip(' ')
     result = dict()
-    # For now support no more than one query modifier per query
-    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20})\) *$', rbql_expression)
+    # Multiple query modifiers can be separated by commas e.g. `WITH (header, sorted)`
+    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20}(?: *, *[a-z]{4,20})*)\) *$', rbql_expression)
     if mobj is not None:
         rbql_expression = mobj.group(1)
-        result[WITH] = mobj.group(2)
+        result[WITH] = [modifier.strip() for modifier in mobj.group(2).split(',')]
     ordered_statements = locate_statements(statement_groups, rbql_expression)
     for i in range(len(ordered_statements)):
         statement_start = ordered_statements[i][0]
@@ -1343,11 +2418,10 @@ def translate_except_expression(except_expression, input_variables_map, string_l
     return (output_header, 'select_except(record_a, [{}])'.format(','.join(skip_indices)))
 
 
-class HashJoinMap:
-    # Other possible flavors: BinarySearchJoinMap, MergeJoinMap
-    def __init__(self, record_iterator, key_indices):
+class JoinMapBase:
+    # Key extraction and projection of join records shared by all join maps
+    def __init__(self, record_iterator, key_indices, projection=None):
         self.max_record_len = 0
-        self.hash_map = defaultdict(list)
         self.record_iterator = record_iterator
         self.key_indices = None
         self.key_index = None
@@ -1357,6 +2431,31 @@ class HashJoinMap:
         else:
             self.key_indices = key_indices
             self.polymorphic_get_key = self.get_multi_key
+        self.projection = projection
+        if projection is None:
+            self.polymorphic_make_join_record = self.make_full_join_record
+        else:
+            column_indices = projection.column_indices
+            self.max_projected_index = max(column_indices) if column_indices else -1
+            if len(column_indices) == 0:
+                self.get_projected_fields = lambda fields: ()
+            elif len(column_indices) == 1:
+                self.get_projected_fields = lambda fields: (fields[column_indices[0]],)
+            else:
+                self.get_projected_fields = operator.itemgetter(*column_indices)
+            self.polymorphic_make_join_record = self.make_projected_join_record
+
+
+    def make_full_join_record(self, nr, nf, fields):
+        return (nr, nf, fields)
+
+
+    def make_projected_join_record(self, nr, nf, fields):
+        if nf > self.max_projected_index:
+            projected_fields = self.get_projected_fields(fields)
+        else:
+            projected_fields = tuple(fields[i] if i < nf else None for i in self.projection.column_indices)
+        return (nr if self.projection.store_nr else None, nf if self.projection.store_nf else None, projected_fields)
 
 
     def get_single_key(self, nr, fields):
@@ -1374,25 +2473,317 @@ class HashJoinMap:
         return tuple(result)
 
 
+    def get_key_indices(self):
+        return [self.key_index] if self.key_indices is None else self.key_indices
+
+
+    def get_null_record_len(self):
+        # Number of fields in the null join record of LEFT JOIN for input records without matches
+        return self.max_record_len
+
+
+    def finish(self):
+        pass
+
+
+    def get_warnings(self):
+        return self.record_iterator.get_warnings()
+
+
+class HashJoinMap(JoinMapBase):
+    # Other possible flavors: BinarySearchJoinMap
+    def __init__(self, record_iterator, key_indices, projection=None):
+        JoinMapBase.__init__(self, record_iterator, key_indices, projection)
+        self.hash_map = defaultdict(list)
+        self.build_warnings = None
+        self.memory_usage = 0
+        # When the memory limit is exceeded the join records are hash-partitioned by key and spilled, see `join_spilled_partitions`
+        self.spill_files = []
+        self.spilled_matches = None
+        self.spilled_matches_files = []
+        # One Bloom filter for keys of each spill, input records which keys are not in any of them don't have matches
+        self.bloom_filters = []
+        self.num_join_records = 0
+        self.num_input_records = 0
+        self.num_bloom_filter_rejects = 0
+        # Max number of input records which are partitioned at once by `join_spilled_partitions`, doubled after each batch. None means the whole input table
+        self.spilled_input_batch_size = None
+        self.spilled_input_exhausted = False
+        # Set of keys to keep in the map, other join records are skipped during build. Used for small input tables, see `JoinInputPrefetchIterator`
+        self.key_filter = None
+
+
     def build(self):
         nr = 0
         while True:
-            fields = self.record_iterator.get_record()
-            if fields is None:
+            records = self.record_iterator.get_records(default_input_batch_size)
+            if not records:
                 break
-            nr += 1
-            nf = len(fields)
-            self.max_record_len = max(self.max_record_len, nf)
-            key = self.polymorphic_get_key(nr, fields)
-            self.hash_map[key].append((nr, nf, fields))
+            for fields in records:
+                nr += 1
+                nf = len(fields)
+                self.max_record_len = max(self.max_record_len, nf)
+                key = self.polymorphic_get_key(nr, fields)
+                if self.key_filter is not None and key not in self.key_filter:
+                    continue
+                join_record = self.polymorphic_make_join_record(nr, nf, fields)
+                self.hash_map[key].append(join_record)
+                if memory_limit is not None:
+                    self.memory_usage += estimate_memory_usage(key) + estimate_memory_usage(join_record[2])
+                    if self.memory_usage > memory_limit:
+                        self.spill()
+        self.num_join_records = nr
+        if self.spill_files:
+            self.spill()
+
+
+    def spill(self):
+        if not self.spill_files:
+            self.spill_files = [tempfile.TemporaryFile(prefix='rbql_spill_') for _ in range(join_spill_partitions)]
+        partition_entries = [list() for _ in self.spill_files]
+        bloom_filter = BloomFilter(len(self.hash_map), join_bloom_filter_bits_per_key) if join_bloom_filter_bits_per_key > 0 and self.hash_map else None
+        for key, join_records in self.hash_map.items():
+            partition_entries[hash(key) % len(partition_entries)].append((key, join_records))
+            if bloom_filter is not None:
+                bloom_filter.add(key)
+        if bloom_filter is not None:
+            self.bloom_filters.append(bloom_filter)
+        for spill_file, entries in zip(self.spill_files, partition_entries):
+            for i in range(0, len(entries), spill_chunk_size):
+                dump_spill_chunk(spill_file, entries[i:i + spill_chunk_size])
+        self.hash_map = defaultdict(list)
+        self.memory_usage = 0
+
+
+    def join_spilled_partitions(self, input_iterator, lhs_key_function):
+        # Grace hash join: input records are partitioned by the join key the same way as the join records, and each pair of partitions is joined in memory.
+        # The matches are then merged back in the input order, so the query results are exactly the same as with the in-memory join map.
+        # Input records which keys are rejected by the Bloom filters don't have matches, so they are not partitioned at all.
+        # With `spilled_input_batch_size` the input is joined in batches of growing size, so that queries which can stop early e.g. with LIMIT don't read the whole input table.
+        # Returns a temporary file with the next batch of input records which should be processed by the main loop instead of the original input, or None if there are no more input records.
+        # Matches of the previous batch are discarded, so all of its records must be processed before calling this again.
+        if self.spilled_input_exhausted:
+            return None
+        for spill_file in self.spilled_matches_files:
+            spill_file.close()
+        self.spilled_matches_files = []
+        self.spilled_matches = None
+        max_batch_records = self.spilled_input_batch_size
+        if self.spilled_input_batch_size is not None:
+            self.spilled_input_batch_size *= 2
+        input_records_file = tempfile.TemporaryFile(prefix='rbql_spill_')
+        self.spilled_matches_files.append(input_records_file)
+        input_partition_files = [tempfile.TemporaryFile(prefix='rbql_spill_') for _ in self.spill_files]
+        partition_entries = [list() for _ in self.spill_files]
+        nr = self.num_input_records
+        while max_batch_records is None or nr - self.num_input_records < max_batch_records:
+            records = input_iterator.get_records(spill_chunk_size if max_batch_records is None else min(spill_chunk_size, max_batch_records - (nr - self.num_input_records)))
+            if not records:
+                self.spilled_input_exhausted = True
+                break
+            dump_spill_chunk(input_records_file, records)
+            for record_a in records:
+                nr += 1
+                try:
+                    key = lhs_key_function(nr, record_a)
+                    partition = hash(key) % len(partition_entries)
+                except (InternalBadFieldError, TypeError):
+                    # The main loop would fail with a proper error message on this record, so it doesn't need any matches.
+                    continue
+                if not self.may_contain_key(key):
+                    self.num_bloom_filter_rejects += 1
+                    continue
+                partition_entries[partition].append((nr, key))
+                if len(partition_entries[partition]) >= spill_chunk_size:
+                    dump_spill_chunk(input_partition_files[partition], partition_entries[partition])
+                    partition_entries[partition] = list()
+        if nr == self.num_input_records:
+            for input_partition_file in input_partition_files:
+                input_partition_file.close()
+            return None
+        self.num_input_records = nr
+        matches_files = []
+        for spill_file, input_partition_file, entries in zip(self.spill_files, input_partition_files, partition_entries):
+            if entries:
+                dump_spill_chunk(input_partition_file, entries)
+            if input_partition_file.tell() == 0:
+                # No input records in this partition, so its join records don't need to be read
+                input_partition_file.close()
+                continue
+            # Join partitions are kept until `finish`, because they can be read again for the next input batch
+            spill_file.seek(0)
+            partition_map = defaultdict(list)
+            for key, join_records in iterate_spill_file(spill_file):
+                partition_map[key].extend(join_records)
+            input_partition_file.seek(0)
+            matches_file = tempfile.TemporaryFile(prefix='rbql_spill_')
+            self.spilled_matches_files.append(matches_file)
+            for input_entries in iterate_spill_chunks(input_partition_file):
+                dump_spill_chunk(matches_file, [(nr, key, partition_map.get(key, [])) for nr, key in input_entries])
+            input_partition_file.close()
+            matches_file.seek(0)
+            matches_files.append(matches_file)
+        # Record numbers are unique, so the entries are never compared by the key.
+        self.spilled_matches = heapq.merge(*[iterate_spill_file(matches_file) for matches_file in matches_files])
+        input_records_file.seek(0)
+        return input_records_file
+
+
+    def finish(self):
+        for spill_file in self.spill_files + self.spilled_matches_files:
+            spill_file.close()
+
+
+    def may_contain_key(self, key):
+        if not self.bloom_filters:
+            return True
+        for bloom_filter in self.bloom_filters:
+            if bloom_filter.contains(key):
+                return True
+        return False
+
+
+    def get_spilled_join_records(self, key):
+        # Some input records can be skipped by the main loop e.g. by LIMIT, but records with the same key always have the same matches.
+        # Records rejected by the Bloom filters don't have entries in the merged matches.
+        if not self.may_contain_key(key):
+            return []
+        for _nr, entry_key, join_records in self.spilled_matches:
+            if entry_key == key:
+                return join_records
+        return []
+
+
+    def get_state(self):
+        # The state of the built map which can be saved and then restored with `set_state` instead of calling `build` e.g. to cache the map of a large join table
+        assert not self.spill_files and self.key_filter is None
+        return (self.max_record_len, dict(self.hash_map), self.record_iterator.get_warnings())
+
+
+    def set_state(self, state):
+        self.max_record_len, hash_map, self.build_warnings = state
+        self.hash_map = defaultdict(list, hash_map)
 
 
     def get_join_records(self, key):
+        if self.spilled_matches is not None:
+            return self.get_spilled_join_records(key)
         return self.hash_map[key]
 
 
+    def get_statistics_warning(self):
+        if not self.spill_files:
+            return None
+        return 'Join table exceeded the memory limit and was joined in {} partitions on disk: {} join records, {} of {} input records without matches were skipped by Bloom filter'.format(join_spill_partitions, self.num_join_records, self.num_bloom_filter_rejects, self.num_input_records)
+
+
     def get_warnings(self):
-        return self.record_iterator.get_warnings()
+        warnings = self.build_warnings if self.build_warnings is not None else self.record_iterator.get_warnings()
+        statistics_warning = self.get_statistics_warning()
+        if statistics_warning is not None:
+            warnings = warnings + [statistics_warning]
+        return warnings
+
+
+class LookupJoinMap(HashJoinMap):
+    # Base class for join maps that look up join records of a batch of input keys directly in the join table, e.g. with an index of a database table, instead of loading the whole table into memory.
+    # Returned join records must be the same as with HashJoinMap: all join records which keys are equal to the input key, in the join table order.
+    def __init__(self, record_iterator, key_indices, projection=None):
+        HashJoinMap.__init__(self, record_iterator, key_indices, projection)
+        self.batch_matches = dict()
+
+
+    def lookup_keys(self, keys):
+        # Reimplement: must return a dict that maps each key with matches to a list of join records which can be created with `polymorphic_make_join_record`
+        raise NotImplementedError('Unable to call the interface method')
+
+
+    def prepare_batch(self, keys):
+        self.batch_matches = self.lookup_keys(keys)
+
+
+    def build(self):
+        pass
+
+
+    def get_join_records(self, key):
+        return self.batch_matches.get(key, [])
+
+
+class MergeJoinMap(JoinMapBase):
+    # Both input and join tables must be sorted by the join key: the join table is streamed along with the input table and only the records with the current key are kept in memory.
+    def __init__(self, record_iterator, key_indices, projection=None):
+        JoinMapBase.__init__(self, record_iterator, key_indices, projection)
+        # The null record length is fixed on the first LEFT JOIN input record without matches, so that all such records have the same number of fields
+        self.null_record_len = None
+        self.has_wider_records_after_null_record = False
+        self.nr = 0
+        self.records_batch = []
+        self.batch_pos = 0
+        self.next_entry = None
+        self.has_last_rhs_key = False
+        self.last_rhs_key = None
+        self.has_last_lhs_key = False
+        self.last_lhs_key = None
+        self.current_records = []
+
+
+    def read_entry(self):
+        # Returns (key, join_record) for the next record of the join table or None
+        if self.batch_pos >= len(self.records_batch):
+            self.records_batch = self.record_iterator.get_records(default_input_batch_size)
+            self.batch_pos = 0
+            if not self.records_batch:
+                return None
+        fields = self.records_batch[self.batch_pos]
+        self.batch_pos += 1
+        self.nr += 1
+        nf = len(fields)
+        self.max_record_len = max(self.max_record_len, nf)
+        # Projected join fields are None in the null record regardless of its length, only `b.*` and `bNF` expose it
+        if self.null_record_len is not None and nf > self.null_record_len and (self.projection is None or self.projection.store_nf):
+            self.has_wider_records_after_null_record = True
+        key = self.polymorphic_get_key(self.nr, fields)
+        if self.has_last_rhs_key and key < self.last_rhs_key:
+            raise RbqlRuntimeError('Join table "B" is not sorted by the join key which is required by "WITH ({})" query modifier. E.g. key "{}" at record {} goes after "{}"'.format(MERGE_JOIN_MODIFIER, format_key_for_error(key), self.nr, format_key_for_error(self.last_rhs_key))) # UT JSON
+        self.has_last_rhs_key = True
+        self.last_rhs_key = key
+        return (key, self.polymorphic_make_join_record(self.nr, nf, fields))
+
+
+    def build(self):
+        # Read only the first record to know the length of join records for LEFT JOIN as early as possible.
+        self.next_entry = self.read_entry()
+
+
+    def get_join_records(self, key):
+        if self.has_last_lhs_key:
+            if key == self.last_lhs_key:
+                return self.current_records
+            if key < self.last_lhs_key:
+                raise RbqlRuntimeError('Input table "A" is not sorted by the join key which is required by "WITH ({})" query modifier. E.g. key "{}" goes after "{}"'.format(MERGE_JOIN_MODIFIER, format_key_for_error(key), format_key_for_error(self.last_lhs_key))) # UT JSON
+        self.has_last_lhs_key = True
+        self.last_lhs_key = key
+        while self.next_entry is not None and self.next_entry[0] < key:
+            self.next_entry = self.read_entry()
+        self.current_records = []
+        while self.next_entry is not None and self.next_entry[0] == key:
+            self.current_records.append(self.next_entry[1])
+            self.next_entry = self.read_entry()
+        return self.current_records
+
+
+    def get_null_record_len(self):
+        if self.null_record_len is None:
+            self.null_record_len = self.max_record_len
+        return self.null_record_len
+
+
+    def get_warnings(self):
+        warnings = self.record_iterator.get_warnings()
+        if self.has_wider_records_after_null_record:
+            warnings = warnings + ['Join table "B" has records with more than {0} fields after the first input record without matches, but all input records without matches were joined with {0} null "B" fields. Remove "WITH ({1})" to join them with the max number of fields in "B"'.format(self.null_record_len, MERGE_JOIN_MODIFIER)]
+        return warnings
 
 
 def cleanup_query(query_text):
@@ -1409,8 +2800,8 @@ def remove_redundant_input_table_name(query_text):
 
 
 def select_output_header(input_header, join_header, query_column_infos):
-    if input_header is None:
-        assert join_header is None
+    if input_header is None and join_header is not None:
+        raise RbqlIOHandlingError('Join table has a header, so the input table must also have a header') # E.g. sqlite join tables always have column names
     query_has_star = False
     query_has_column_alias = False
     for qci in query_column_infos:
@@ -1477,8 +2868,9 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
     if input_iterator is None:
         raise RbqlParsingError('Queries without context-based input table must contain "FROM" statement')
 
-    if WITH in rb_actions:
-        input_iterator.handle_query_modifier(rb_actions[WITH])
+    query_modifiers = rb_actions.get(WITH, [])
+    for modifier in query_modifiers:
+        input_iterator.handle_query_modifier(modifier)
     input_variables_map = get_variables_map(query_text, 'a', input_iterator.get_header())
 
     if ORDER_BY in rb_actions and UPDATE in rb_actions:
@@ -1489,6 +2881,11 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
             raise RbqlParsingError(invalid_keyword_in_aggregate_query_error_msg) # UT JSON
         query_context.aggregation_key_expression = '({},)'.format(combine_string_literals(rb_actions[GROUP_BY]['text'], string_literals))
         query_context.aggregation_stage = 1
+        query_context.aggregation_input_sorted = SORTED_INPUT_MODIFIER in query_modifiers
+    elif SORTED_INPUT_MODIFIER in query_modifiers:
+        raise RbqlParsingError('"WITH ({})" query modifier can only be used in "GROUP BY" queries'.format(SORTED_INPUT_MODIFIER)) # UT JSON
+    if MERGE_JOIN_MODIFIER in query_modifiers and JOIN not in rb_actions:
+        raise RbqlParsingError('"WITH ({})" query modifier can only be used in "JOIN" queries'.format(MERGE_JOIN_MODIFIER)) # UT JSON
 
 
     input_header = input_iterator.get_header()
@@ -1501,8 +2898,8 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         join_record_iterator = tables_registry.get_iterator_by_table_id(rhs_table_id, 'b')
         if join_record_iterator is None:
             raise RbqlParsingError('Unable to find join table: "{}"'.format(rhs_table_id)) # UT JSON CSV
-        if WITH in rb_actions:
-            join_record_iterator.handle_query_modifier(rb_actions[WITH])
+        for modifier in query_modifiers:
+            join_record_iterator.handle_query_modifier(modifier)
         join_variables_map = get_variables_map(query_text, 'b', join_record_iterator.get_header())
         join_header = join_record_iterator.get_header()
         if input_header is None and join_header is not None:
@@ -1514,18 +2911,45 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         lhs_variables, rhs_indices = resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals)
         joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner}[rb_actions[JOIN]['join_subtype']]
         query_context.lhs_join_var_expression = lhs_variables[0] if len(lhs_variables) == 1 else '({})'.format(', '.join(lhs_variables))
-        query_context.join_map_impl = HashJoinMap(join_record_iterator, rhs_indices)
-        query_context.join_map_impl.build()
+        join_projection = plan_join_projection(format_expression, rb_actions, join_variables_map)
+        if join_projection is not None:
+            join_variables_map = project_join_variables(join_variables_map, join_projection)
+            query_context.join_star_fields_expression = 'None' # `star_fields` is not used in queries with projected join records
+        lhs_key_function = eval('lambda NR, record_a: {}'.format(query_context.lhs_join_var_expression), {'safe_join_get': safe_join_get})
+        # Pipeline stages with streaming input run in separate threads, so they can't use registry objects e.g. database connections.
+        streaming_input = isinstance(query_context.input_iterator, StreamingPipeIterator)
+        lookup_join_map = None
+        if MERGE_JOIN_MODIFIER not in query_modifiers and not streaming_input:
+            lookup_join_map = tables_registry.get_lookup_join_map(join_record_iterator, rhs_indices, join_projection)
+        join_map_type = MergeJoinMap if MERGE_JOIN_MODIFIER in query_modifiers else HashJoinMap
+        query_context.join_map_impl = lookup_join_map if lookup_join_map is not None else join_map_type(join_record_iterator, rhs_indices, join_projection)
         query_context.join_map = joiner_type(query_context.join_map_impl)
+        if lookup_join_map is not None:
+            query_context.input_iterator = LookupJoinInputIterator(query_context.input_iterator, lookup_join_map, lhs_key_function)
+        elif join_map_type is HashJoinMap and not streaming_input:
+            # The join map is built on the first read from the input, when it is known whether the input table is small.
+            query_context.input_iterator = JoinInputPrefetchIterator(query_context.input_iterator, query_context.join_map_impl, tables_registry, lhs_key_function)
+        else:
+            tables_registry.build_join_map(query_context.join_map_impl)
+            if join_map_type is HashJoinMap and query_context.join_map_impl.spill_files:
+                query_context.input_iterator = SpilledJoinInputIterator(query_context.input_iterator, query_context.join_map_impl, lhs_key_function)
 
-    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, join_variables_map), string_literals)
+    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map), string_literals)
+    if join_variables_map is not None:
+        query_context.join_variables_init_code = combine_string_literals(generate_join_init_statements(format_expression, join_variables_map), string_literals)
 
 
     if WHERE in rb_actions:
         where_expression = rb_actions[WHERE]['text']
         if re.search(r'[^><!=]=[^=]', where_expression) is not None:
             raise RbqlParsingError('Assignments "=" are not allowed in "WHERE" expressions. For equality test use "=="') # UT JSON
-        query_context.where_expression = combine_string_literals(where_expression, string_literals)
+        where_expression = resolve_in_table_operators(where_expression, tables_registry, query_modifiers, query_context)
+        if JOIN in rb_actions and SELECT in rb_actions:
+            input_where_expression, where_expression = split_join_where_expression(where_expression)
+            if input_where_expression is not None:
+                query_context.input_where_expression = combine_string_literals(input_where_expression, string_literals)
+        if where_expression is not None:
+            query_context.where_expression = combine_string_literals(where_expression, string_literals)
 
 
     if UPDATE in rb_actions:
@@ -1560,7 +2984,23 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
 
     if ORDER_BY in rb_actions:
         query_context.sort_key_expression = '({})'.format(combine_string_literals(rb_actions[ORDER_BY]['text'], string_literals))
-        query_context.writer = SortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'])
+        if query_context.top_count is not None and 'distinct' not in rb_actions[SELECT]:
+            query_context.writer = TopKSortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'], top_count=query_context.top_count)
+        else:
+            query_context.writer = SortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'])
+
+    if query_context.top_count is None:
+        # Without TOP/LIMIT the whole input is going to be consumed anyway, so reading ahead doesn't change the behavior.
+        query_context.input_batch_size = default_input_batch_size
+    elif isinstance(query_context.join_map_impl, HashJoinMap) and ORDER_BY not in rb_actions and GROUP_BY not in rb_actions:
+        # The main loop can stop after a few input records, so if the join table doesn't fit into memory the input is partitioned in growing batches instead of all at once.
+        query_context.join_map_impl.spilled_input_batch_size = max(query_context.top_count, spill_chunk_size)
+        if isinstance(query_context.input_iterator, JoinInputPrefetchIterator):
+            query_context.input_iterator.prefetch_size = min(query_context.top_count, join_input_prefetch_size)
+
+    if numpy_aggregation_enabled and query_context.aggregation_stage > 0 and not query_context.aggregation_input_sorted and JOIN not in rb_actions and WHERE not in rb_actions and EXCEPT not in rb_actions and 'distinct' not in rb_actions[SELECT]:
+        from . import rbql_numpy
+        query_context.vectorized_aggregation = rbql_numpy.plan_vectorized_aggregation(query_context.select_expression, query_context.aggregation_key_expression, input_variables_map, query_context.user_init_code)
 
 
 def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
@@ -1580,6 +3020,125 @@ def split_query_to_stages(query_text):
     return re.split(pattern, query_text, flags=re.IGNORECASE)
 
 
+class PartitionedQueryPlan(object):
+    # Describes how to run a query independently on multiple partitions of the input table and how to merge the partial results
+    def __init__(self, rb_actions):
+        self.query_modifiers = rb_actions.get(WITH, [])
+        self.is_select = SELECT in rb_actions
+        self.top_count = find_top(rb_actions) if self.is_select else None
+        self.distinct = self.is_select and 'distinct' in rb_actions[SELECT]
+        self.distinct_count = self.is_select and 'distinct_count' in rb_actions[SELECT]
+        self.sort_reverse = rb_actions[ORDER_BY]['reverse'] if ORDER_BY in rb_actions else None
+
+    def make_partition_writer(self, output_writer):
+        if self.sort_reverse is not None:
+            # Duplicates must be counted or removed only after the merge, so TOP can't be applied to partitions in this case.
+            if self.top_count is not None and not self.distinct:
+                return TopKSortedWriter(output_writer, self.sort_reverse, self.top_count, emit_sort_keys=True)
+            return PartitionSortedWriter(output_writer, self.sort_reverse)
+        writer = output_writer
+        if self.top_count is not None and not self.distinct_count:
+            writer = TopWriter(writer, self.top_count)
+        if self.distinct_count:
+            writer = UniqCountWriter(writer)
+        elif self.distinct:
+            writer = UniqWriter(writer)
+        return writer
+
+
+def array_agg_has_post_proc(format_expression):
+    for match in re.finditer(r'(?<![_a-zA-Z0-9.])ARRAY_AGG *\(', format_expression):
+        depth = 1
+        for c in format_expression[match.end():]:
+            if c in '([{':
+                depth += 1
+            elif c in ')]}':
+                depth -= 1
+                if depth == 0:
+                    break
+            elif c == ',' and depth == 1:
+                return True
+    return False
+
+
+def plan_partitioned_query(query_text):
+    # Returns (plan, None) if the query can be split into independent partition queries with a fixed input table or (None, reason) otherwise
+    if len(split_query_to_stages(query_text)) > 1:
+        return (None, 'multi-stage queries are not supported')
+    format_expression, _string_literals = separate_string_literals(cleanup_query(query_text))
+    format_expression = remove_redundant_input_table_name(format_expression)
+    statement_groups = default_statement_groups[:]
+    statement_groups.remove([FROM])
+    rb_actions = separate_actions(statement_groups, format_expression)
+    if array_agg_has_post_proc(format_expression):
+        return (None, 'ARRAY_AGG with a post-processing function is not supported')
+    if re.search(r'(?<![_a-zA-Z0-9])a?NR(?![_a-zA-Z0-9])', format_expression) is not None:
+        return (None, 'queries that use input record numbers (NR) are not supported')
+    if SORTED_INPUT_MODIFIER in rb_actions.get(WITH, []):
+        return (None, '"WITH ({})" query modifier is not supported'.format(SORTED_INPUT_MODIFIER))
+    return (PartitionedQueryPlan(rb_actions), None)
+
+
+def query_partition(query_text, partition_plan, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code):
+    # Returns partial state of the AggregateWriter for aggregate queries and None otherwise.
+    # Input iterator warnings are not reported here: line and record numbers in them can only be adjusted by the caller which knows the partition boundaries.
+    query_context = RBQLContext(input_iterator, output_writer, user_init_code)
+    # Partial aggregation state must stay in memory to be exported to the caller.
+    query_context.aggregation_memory_limit = None
+    shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
+    query_context.vectorized_aggregation = None
+    query_context.writer = partition_plan.make_partition_writer(output_writer)
+    compile_and_run(query_context, user_namespace=None)
+    aggregate_state = None
+    if isinstance(query_context.writer, AggregateWriter):
+        aggregate_state = query_context.writer.get_partial_state()
+        output_writer.finish()
+    else:
+        query_context.writer.finish()
+    if query_context.join_map_impl is not None:
+        query_context.join_map_impl.finish()
+        output_warnings.extend(query_context.join_map_impl.get_warnings())
+    for record_iterator in query_context.in_table_iterators:
+        output_warnings.extend(record_iterator.get_warnings())
+    output_warnings.extend(output_writer.get_warnings())
+    return aggregate_state
+
+
+def merge_partitioned_results(partition_plan, partition_record_streams, partition_aggregate_states, output_writer):
+    # Partition streams and aggregate states must be in the order of the corresponding partitions in the input table
+    writer = output_writer
+    if partition_plan.top_count is not None:
+        writer = TopWriter(writer, partition_plan.top_count)
+    aggregate_states = [state for state in partition_aggregate_states if state is not None]
+    if len(aggregate_states):
+        writer = AggregateWriter.from_partial_state(writer, aggregate_states[0])
+        for state in aggregate_states[1:]:
+            writer.merge_partial_state(state)
+        writer.finish()
+        return
+    if partition_plan.sort_reverse is not None:
+        if partition_plan.distinct_count:
+            writer = UniqCountWriter(writer)
+        elif partition_plan.distinct:
+            writer = UniqWriter(writer)
+        partition_record_streams = list(partition_record_streams)
+        if partition_plan.sort_reverse:
+            # Sorting is stable and the result is reversed after that, so in case of equal keys records from the later partitions must go first.
+            partition_record_streams.reverse()
+        sorted_entries = heapq.merge(*partition_record_streams, key=lambda x: x[0], reverse=partition_plan.sort_reverse)
+        records = (e[1] for e in sorted_entries)
+    else:
+        if partition_plan.distinct_count:
+            writer = UniqCountMergeWriter(writer)
+        elif partition_plan.distinct:
+            writer = UniqWriter(writer)
+        records = itertools.chain(*partition_record_streams)
+    for record in records:
+        if not writer.write(record):
+            break
+    writer.finish()
+
+
 def staged_query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace):
     query_context = RBQLContext(input_iterator, output_writer, user_init_code)
     shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
@@ -1587,25 +3146,100 @@ def staged_query(query_text, input_iterator, output_writer, output_warnings, joi
     query_context.writer.finish()
     output_warnings.extend(query_context.input_iterator.get_warnings())
     if query_context.join_map_impl is not None:
+        query_context.join_map_impl.finish()
         output_warnings.extend(query_context.join_map_impl.get_warnings())
+    for record_iterator in query_context.in_table_iterators:
+        output_warnings.extend(record_iterator.get_warnings())
     output_warnings.extend(output_writer.get_warnings())
 
 
-def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
-    query_stages = split_query_to_stages(query_text)
-    previous_pipe = None
+def query_pipeline(query_stages, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace):
+    # Stages are connected with bounded pipes and run concurrently, so only blocking operations like ORDER BY or GROUP BY keep whole tables in memory.
+    # All stages are parsed in the current thread beforehand (this also builds join maps) and the first stage runs in the current thread too, because user-provided input iterators and join registries might not be thread-safe.
+    stage_contexts = []
+    stage_writers = []
+    pipes = []
+    stage_iterator = input_iterator
     for i, query_stage_text in enumerate(query_stages):
-        output_pipe = TablePipe() if i + 1 < len(query_stages) else None
-        stage_iterator = input_iterator if previous_pipe is None else previous_pipe.get_iterator()
+        output_pipe = StreamingTablePipe() if i + 1 < len(query_stages) else None
         stage_writer = output_writer if output_pipe is None else output_pipe.get_writer()
-        staged_query(query_stage_text, stage_iterator, stage_writer, output_warnings, join_tables_registry, user_init_code, user_namespace)
-        previous_pipe = output_pipe
+        query_context = RBQLContext(stage_iterator, stage_writer, user_init_code)
+        if stage_contexts:
+            query_context.field_type = stage_contexts[0].field_type # Later stages consume the records produced from the input fields
+        shallow_parse_input_query(query_stage_text, stage_iterator, join_tables_registry, query_context)
+        stage_contexts.append(query_context)
+        stage_writers.append(stage_writer)
+        pipes.append(output_pipe)
+        stage_iterator = None if output_pipe is None else output_pipe.get_iterator()
+
+    stage_errors = [None] * len(query_stages)
+    def run_stage(stage_index):
+        query_context = stage_contexts[stage_index]
+        try:
+            compile_and_run(query_context, user_namespace)
+            query_context.writer.finish()
+        except BaseException as e:
+            # BaseException e.g. KeyboardInterrupt must abort the pipe too, otherwise the next stage would wait for records forever
+            stage_errors[stage_index] = e
+            if pipes[stage_index] is not None:
+                pipes[stage_index].abort()
+        finally:
+            if stage_index > 0:
+                # Let the previous stage know that no more records are needed e.g. because of LIMIT in this stage.
+                pipes[stage_index - 1].close_reader()
+
+    threads = [threading.Thread(target=run_stage, args=(i,)) for i in range(1, len(query_stages))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        run_stage(0)
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        # E.g. KeyboardInterrupt while waiting for the other stages: unblock them so that they can exit
+        for pipe in pipes:
+            if pipe is not None:
+                pipe.abort()
+                pipe.close_reader()
+        raise
+    for error in stage_errors:
+        # Errors of the downstream stages can be caused by the failure of an upstream stage, so the first error is the most relevant one.
+        if error is not None:
+            raise error
+
+    for query_context, stage_writer in zip(stage_contexts, stage_writers):
+        output_warnings.extend(query_context.input_iterator.get_warnings())
+        if query_context.join_map_impl is not None:
+            query_context.join_map_impl.finish()
+            output_warnings.extend(query_context.join_map_impl.get_warnings())
+        for record_iterator in query_context.in_table_iterators:
+            output_warnings.extend(record_iterator.get_warnings())
+        output_warnings.extend(stage_writer.get_warnings())
+
+
+def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
+    query_stages = split_query_to_stages(query_text)
+    if len(query_stages) == 1:
+        staged_query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace)
+    else:
+        query_pipeline(query_stages, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace)
 
 
 class RBQLInputIterator:
     def get_record(self):
         raise NotImplementedError('Unable to call the interface method')
 
+    def get_records(self, max_num_records):
+        # Reimplement if your class can fetch multiple records at once more efficiently. Must return an empty list when the input is exhausted.
+        result = []
+        for _i in range(max_num_records):
+            record = self.get_record()
+            if record is None:
+                break
+            result.append(record)
+        return result
+
     def handle_query_modifier(self, modifier_name):
         # Reimplement if you need to handle a boolean query modifier that can be used like this: `SELECT * WITH (modifiername)`
         pass
@@ -1616,6 +3250,173 @@ class RBQLInputIterator:
     def get_header(self):
         return None # Reimplement if your class can provide input header
 
+    def get_field_type(self):
+        return str # Reimplement if your class produces records with fields of another type e.g. `bytes`
+
+
+class PrefetchedInputIterator(RBQLInputIterator):
+    # Returns the prefetched records first and then the rest of the input
+    def __init__(self, prefetched_records, input_iterator):
+        self.prefetched_records = prefetched_records
+        self.input_iterator = input_iterator
+
+    def get_record(self):
+        if self.prefetched_records:
+            return self.prefetched_records.pop()
+        return self.input_iterator.get_record()
+
+    def get_records(self, num_records):
+        if self.prefetched_records:
+            result = self.prefetched_records[-num_records:]
+            del self.prefetched_records[-num_records:]
+            result.reverse()
+            return result
+        return self.input_iterator.get_records(num_records)
+
+    def get_header(self):
+        return self.input_iterator.get_header()
+
+    def get_warnings(self):
+        return self.input_iterator.get_warnings()
+
+
+class JoinInputPrefetchIterator(RBQLInputIterator):
+    # Builds the join map on the first read from the input.
+    # If the whole input table fits into `join_input_prefetch_size` records, the small input table effectively becomes the build side: only the join records with matching keys are kept in memory while the join table is streamed.
+    # The input is still processed in the original order, so the results are exactly the same as with the full join map.
+    def __init__(self, input_iterator, join_map, tables_registry, lhs_key_function):
+        self.input_iterator = input_iterator
+        self.join_map = join_map
+        self.tables_registry = tables_registry
+        self.lhs_key_function = lhs_key_function
+        self.source_iterator = None
+        self.prefetch_size = join_input_prefetch_size # Queries with TOP/LIMIT can stop after a few input records, so they don't prefetch more than they can output
+
+    def build_join_map(self):
+        prefetched_records = []
+        while len(prefetched_records) < self.prefetch_size:
+            records = self.input_iterator.get_records(self.prefetch_size - len(prefetched_records))
+            if not records:
+                break
+            prefetched_records.extend(records)
+        if len(prefetched_records) < self.prefetch_size:
+            input_keys = set()
+            for nr, record_a in enumerate(prefetched_records, 1):
+                try:
+                    input_keys.add(self.lhs_key_function(nr, record_a))
+                except (InternalBadFieldError, TypeError):
+                    pass # The main loop will report the error for this record
+            self.join_map.key_filter = input_keys
+        self.tables_registry.build_join_map(self.join_map)
+        prefetched_records.reverse()
+        source_iterator = PrefetchedInputIterator(prefetched_records, self.input_iterator)
+        if self.join_map.spill_files:
+            source_iterator = SpilledJoinInputIterator(source_iterator, self.join_map, self.lhs_key_function)
+        return source_iterator
+
+    def get_source_iterator(self):
+        if self.source_iterator is None:
+            self.source_iterator = self.build_join_map()
+        return self.source_iterator
+
+    def get_record(self):
+        return self.get_source_iterator().get_record()
+
+    def get_records(self, num_records):
+        return self.get_source_iterator().get_records(num_records)
+
+    def get_header(self):
+        return self.input_iterator.get_header()
+
+    def get_warnings(self):
+        return self.input_iterator.get_warnings()
+
+
+class LookupJoinInputIterator(RBQLInputIterator):
+    # Looks up the join keys of each batch of input records before the batch is processed by the main loop.
+    def __init__(self, input_iterator, join_map, lhs_key_function):
+        self.input_iterator = input_iterator
+        self.join_map = join_map
+        self.lhs_key_function = lhs_key_function
+        self.NR = 0
+        self.pending_records = []
+
+    def read_batch(self, num_records):
+        records = self.input_iterator.get_records(num_records)
+        keys = set()
+        for record_a in records:
+            self.NR += 1
+            try:
+                keys.add(self.lhs_key_function(self.NR, record_a))
+            except (InternalBadFieldError, TypeError):
+                pass # The main loop will report the error for this record
+        self.join_map.prepare_batch(keys)
+        return records
+
+    def get_record(self):
+        # The main loop processes each record before requesting the next one, so records can be served one by one from a looked up batch.
+        if not self.pending_records:
+            self.pending_records = self.read_batch(join_lookup_batch_size)
+            self.pending_records.reverse()
+        return self.pending_records.pop() if self.pending_records else None
+
+    def get_records(self, num_records):
+        if self.pending_records:
+            result = self.pending_records[::-1]
+            self.pending_records = []
+            return result
+        return self.read_batch(num_records)
+
+    def get_header(self):
+        return self.input_iterator.get_header()
+
+    def get_warnings(self):
+        return self.input_iterator.get_warnings()
+
+
+class SpilledJoinInputIterator(RBQLInputIterator):
+    # Input iterator for queries with a join table that didn't fit into memory: the input is partitioned on the first read, see `HashJoinMap.join_spilled_partitions`
+    def __init__(self, input_iterator, join_map, lhs_key_function):
+        self.input_iterator = input_iterator
+        self.join_map = join_map
+        self.lhs_key_function = lhs_key_function
+        self.records = None
+
+    def get_batch_stream(self):
+        # Returns the records of the current input batch or None. Reads never cross the batch boundary, because matches of the next batch replace the current ones.
+        if self.records is None:
+            records_file = self.join_map.join_spilled_partitions(self.input_iterator, self.lhs_key_function)
+            if records_file is None:
+                return None
+            self.records = iterate_spill_file(records_file)
+        return self.records
+
+    def get_record(self):
+        while True:
+            records = self.get_batch_stream()
+            if records is None:
+                return None
+            record = next(records, None)
+            if record is not None:
+                return record
+            self.records = None
+
+    def get_records(self, num_records):
+        while True:
+            records = self.get_batch_stream()
+            if records is None:
+                return []
+            result = list(itertools.islice(records, num_records))
+            if result:
+                return result
+            self.records = None
+
+    def get_header(self):
+        return self.input_iterator.get_header()
+
+    def get_warnings(self):
+        return self.input_iterator.get_warnings()
+
 
 class RBQLOutputWriter:
     def write(self, fields):
@@ -1637,6 +3438,12 @@ class RBQLTableRegistry:
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         raise NotImplementedError('Unable to call the interface method')
 
+    def build_join_map(self, join_map):
+        join_map.build() # Reimplement if your class can restore a prebuilt join map faster e.g. from a cache
+
+    def get_lookup_join_map(self, record_iterator, key_indices, projection):
+        return None # Reimplement to return a LookupJoinMap if join records can be looked up directly in the join table e.g. with a database index
+
     def finish(self):
         pass # Reimplement if your class needs to do something on finish e.g. cleanup
 
@@ -1681,6 +3488,15 @@ class TableIterator(RBQLInputIterator):
             self.fields_info[num_fields] = self.NR
         return record
 
+    def get_records(self, max_num_records):
+        records = self.table[self.NR:self.NR + max_num_records]
+        for record in records:
+            self.NR += 1
+            num_fields = len(record)
+            if num_fields not in self.fields_info:
+                self.fields_info[num_fields] = self.NR
+        return records
+
     def get_warnings(self):
         if len(self.fields_info) > 1:
             return [make_inconsistent_num_fields_warning('input', self.fields_info)]
@@ -1708,24 +3524,135 @@ class TableWriter(RBQLOutputWriter):
         self.finished = True
 
 
-class TablePipe:
-    # Each concrete class with Pipe interface like this one should know how to pass data and header from the reader to the iterator, so they can share some internal info
+class StreamingPipeWriter(RBQLOutputWriter):
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.chunk = []
+
+    def write(self, fields):
+        self.chunk.append(fields)
+        if len(self.chunk) >= pipe_chunk_size:
+            chunk = self.chunk
+            self.chunk = []
+            return self.pipe.put_chunk(chunk)
+        return True
+
+    def set_header(self, header):
+        self.pipe.header = header
+
+    def finish(self):
+        if self.chunk:
+            self.pipe.put_chunk(self.chunk)
+            self.chunk = []
+        self.pipe.finish_writing()
+
+
+class StreamingPipeIterator(RBQLInputIterator):
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.chunk = []
+        self.chunk_pos = 0
+        self.NR = 0
+        self.fields_info = dict()
+
+    def get_record(self):
+        if self.chunk_pos >= len(self.chunk):
+            self.chunk = self.pipe.get_chunk()
+            self.chunk_pos = 0
+            if self.chunk is None:
+                self.chunk = []
+                return None
+        record = self.chunk[self.chunk_pos]
+        self.chunk_pos += 1
+        self.NR += 1
+        num_fields = len(record)
+        if num_fields not in self.fields_info:
+            self.fields_info[num_fields] = self.NR
+        return record
+
+    def get_records(self, max_num_records):
+        if self.chunk_pos >= len(self.chunk):
+            self.chunk = self.pipe.get_chunk()
+            self.chunk_pos = 0
+            if self.chunk is None:
+                self.chunk = []
+                return []
+        records = self.chunk[self.chunk_pos:self.chunk_pos + max_num_records]
+        self.chunk_pos += len(records)
+        for record in records:
+            self.NR += 1
+            num_fields = len(record)
+            if num_fields not in self.fields_info:
+                self.fields_info[num_fields] = self.NR
+        return records
+
+    def get_warnings(self):
+        if len(self.fields_info) > 1:
+            return [make_inconsistent_num_fields_warning('input', self.fields_info)]
+        return []
+
+    def get_header(self):
+        return self.pipe.header
+
+
+class StreamingTablePipe:
+    # Thread-safe pipe with a bounded buffer: the writer blocks when the buffer is full and the iterator blocks when it is empty.
     def __init__(self):
-        self.table = []
-        self.writer = TableWriter(self.table)
-        self.iterator = None
+        self.header = None
+        self.chunks = deque()
+        self.condition = threading.Condition()
+        self.writer_finished = False
+        self.writer_aborted = False
+        self.reader_closed = False
+        self.writer = StreamingPipeWriter(self)
+        self.iterator = StreamingPipeIterator(self)
 
     def get_writer(self):
         return self.writer
 
     def get_iterator(self):
-        if not self.writer.finished:
-            # We don't have to check it in other pipes if implemented but this one is not thread safe.
-            raise RbqlIOHandlingError("Trying to read from non-thread-safe table pipe while not finishing writing yet")
-        if self.iterator is None:
-            self.iterator = TableIterator(self.table, self.writer.header)
         return self.iterator
 
+    def put_chunk(self, chunk):
+        # Returns False if the reader doesn't need any more records.
+        with self.condition:
+            while len(self.chunks) >= pipe_max_buffered_chunks and not self.reader_closed:
+                self.condition.wait()
+            if self.reader_closed:
+                return False
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+            return True
+
+    def get_chunk(self):
+        # Returns None if there are no more records.
+        with self.condition:
+            while not self.chunks and not self.writer_finished:
+                self.condition.wait()
+            if self.writer_aborted:
+                raise InternalPipeAbortedError()
+            if not self.chunks:
+                return None
+            chunk = self.chunks.popleft()
+            self.condition.notify_all()
+            return chunk
+
+    def finish_writing(self):
+        with self.condition:
+            self.writer_finished = True
+            self.condition.notify_all()
+
+    def abort(self):
+        with self.condition:
+            self.writer_finished = True
+            self.writer_aborted = True
+            self.condition.notify_all()
+
+    def close_reader(self):
+        with self.condition:
+            self.reader_closed = True
+            self.chunks.clear()
+            self.condition.notify_all()
 
 
 ListTableInfo = namedtuple('ListTableInfo', ['table_id', 'table', 'column_names'])
@@ -1760,3 +3687,8 @@ def set_debug_mode(new_value=True):
     global debug_mode
     debug_mode = new_value
 
+
+def set_memory_limit(new_value):
+    global memory_limit
+    memory_limit = new_value
+
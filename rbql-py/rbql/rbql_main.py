@@ -2,6 +2,7 @@
 
 import sys
 import os
+import re
 import argparse
 
 from . import csv_utils
@@ -40,6 +41,13 @@ def get_default_policy(delim):
         return 'simple'
 
 
+def parse_memory_size(size_str):
+    match = re.match('^([0-9]+)([KMG]?)B?$', size_str.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid memory size: "{}", use e.g. "500M" or "2G"'.format(size_str))
+    return int(match.group(1)) * {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[match.group(2)]
+
+
 def show_error(error_type, error_msg, is_interactive):
     if is_interactive:
         if os.name == 'nt': # Windows does not support terminal colors
@@ -69,7 +77,7 @@ def run_with_python_csv(args, is_interactive):
     with_headers = args.with_headers
     input_path = args.input
     output_path = args.output
-    csv_encoding = args.encoding
+    csv_encoding = 'bytes' if args.bytes_mode else args.encoding
     args.output_delim, args.output_policy = (delim, policy) if args.out_format == 'input' else rbql_csv.interpret_named_csv_format(args.out_format)
     out_delim, out_policy = args.output_delim, args.output_policy
 
@@ -78,7 +86,7 @@ def run_with_python_csv(args, is_interactive):
     warnings = []
     error_type, error_msg = None, None
     try:
-        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex)
+        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex, parallel=args.parallel, join_cache_dir=args.join_cache_dir, join_sqlite_db_path=args.join_sqlite_db)
     except Exception as e:
         if args.debug_mode:
             raise
@@ -106,7 +114,7 @@ def run_with_python_sqlite(args, is_interactive):
         db_connection = sqlite3.connect(args.database)
         if args.debug_mode:
             rbql_engine.set_debug_mode()
-        rbql_sqlite.query_sqlite_to_csv(args.query, db_connection, args.input, args.output, args.output_delim, args.output_policy, args.encoding, warnings, user_init_code, args.color)
+        rbql_sqlite.query_sqlite_to_csv(args.query, db_connection, args.input, args.output, args.output_delim, args.output_policy, args.encoding, warnings, user_init_code, args.color, join_sqlite_db_path=args.join_sqlite_db)
     except Exception as e:
         if args.debug_mode:
             raise
@@ -379,14 +387,22 @@ def csv_main():
     parser.add_argument('--query', help='query string in rbql. Run in interactive mode if empty')
     parser.add_argument('--out-format', help='output format', default='input', choices=out_format_names)
     parser.add_argument('--encoding', help='manually set csv encoding', default=rbql_csv.default_csv_encoding, choices=['latin-1', 'utf-8'])
+    parser.add_argument('--bytes-mode', action='store_true', help='read and write fields as raw bytes without decoding and encoding them. Fields in queries are "bytes" values, use AS_FIELD("text") or b"text" to compare them with literals')
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
     parser.add_argument('--strip-spaces', action='store_true', help='strip leading and trailing whitespace chars from each input field')
     parser.add_argument('--color', action='store_true', help='colorize columns in output in non-interactive mode')
+    parser.add_argument('--parallel', metavar='N', type=int, help='split input file into parts and process them in N worker processes. Some queries e.g. queries with NR are always processed in a single process')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=parse_memory_size, help='approximate memory limit for buffered query results and join tables e.g. for ORDER BY and JOIN, e.g. "500M" or "2G". When exceeded the results are spilled to temporary files')
+    parser.add_argument('--join-cache-dir', metavar='DIR', help='save join tables indexed by the join key to DIR, so that subsequent JOIN queries with the same unchanged join table and key can load the index instead of parsing the table. Cache files are pickled: RBQL signs them with a private key stored in DIR and only loads signed files owned by the current user, but DIR should not be writable by other users')
+    parser.add_argument('--join-sqlite-db', metavar='PATH', help='read JOIN tables from sqlite database at PATH and look up join records by key, which is fast if the join key column is indexed. Input table must have a header')
     parser.add_argument('--version', action='store_true', help='print RBQL version and exit')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
     args = parser.parse_args()
 
+    if args.memory_limit is not None:
+        rbql_engine.set_memory_limit(args.memory_limit)
+
     if args.version:
         print(_version.__version__)
         return
@@ -399,6 +415,10 @@ def csv_main():
         show_error('generic', '"--output" is not compatible with "--color" option', is_interactive=False)
         sys.exit(1)
 
+    if args.bytes_mode and args.color:
+        show_error('generic', '"--bytes-mode" is not compatible with "--color" option', is_interactive=False)
+        sys.exit(1)
+
     if args.policy == 'monocolumn':
         args.delim = ''
 
@@ -460,10 +480,14 @@ def json_main():
     parser.add_argument('--input', metavar='FILE', help='read csv table from FILE instead of stdin. Required in interactive mode')
     parser.add_argument('--query', help='query string in rbql. Run in interactive mode if empty')
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=parse_memory_size, help='approximate memory limit for buffered query results and join tables e.g. for ORDER BY and JOIN, e.g. "500M" or "2G". When exceeded the results are spilled to temporary files')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
     args = parser.parse_args()
 
+    if args.memory_limit is not None:
+        rbql_engine.set_memory_limit(args.memory_limit)
+
     if not run_with_python_json(args):
         sys.exit(1)
 
@@ -492,6 +516,7 @@ def sqlite_main():
     parser.add_argument('--out-format', help='output format', default='csv', choices=['csv', 'tsv'])
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
     parser.add_argument('--color', action='store_true', help='colorize columns in output in non-interactive mode. Do NOT use if redirecting output to a file')
+    parser.add_argument('--join-sqlite-db', metavar='PATH', help='read JOIN tables from sqlite database at PATH instead of the input database and look up join records by key, which is fast if the join key column is indexed')
     parser.add_argument('--version', action='store_true', help='print RBQL version and exit')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
@@ -0,0 +1,260 @@
+import re
+
+from . import rbql_engine
+
+
+# Vectorized execution of simple numeric GROUP BY queries like `SELECT a1, SUM(float(a3)), AVG(float(a4)) GROUP BY a1`.
+# The results must be exactly the same as in the generic row-by-row execution, so only queries where this can be guaranteed are vectorized, everything else falls back to the generic main loop.
+
+# Number of records to convert to numpy arrays at once.
+vectorized_batch_size = 10000
+
+vectorized_aggregate_functions = ['COUNT', 'SUM', 'AVG', 'MIN', 'MAX', 'VARIANCE']
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def split_top_level_items(expression):
+    result = []
+    depth = 0
+    item_start = 0
+    for i, c in enumerate(expression):
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            result.append(expression[item_start:i].strip())
+            item_start = i + 1
+    result.append(expression[item_start:].strip())
+    return result
+
+
+def get_aggregate_function_name(alias):
+    # Only the aliases that are defined in the generated main loop are accepted, e.g. `SUM`, `Sum` and `sum`.
+    for function_name in vectorized_aggregate_functions:
+        if alias in [function_name, function_name.lower(), function_name.capitalize()]:
+            return function_name
+    return None
+
+
+def get_variable_index(variable_text, input_variables_map):
+    variable_info = input_variables_map.get(variable_text.strip())
+    return None if variable_info is None else variable_info.index
+
+
+class VectorizedAggregationPlan(object):
+    def __init__(self, key_indices, output_items):
+        self.key_indices = key_indices
+        # Each output item is either ('KEY', key_position) or (aggregate_function_name, value_position) or ('COUNT', None)
+        self.output_items = output_items
+        self.value_indices = []
+
+
+def plan_vectorized_aggregation(select_expression, aggregation_key_expression, input_variables_map, user_init_code):
+    # Returns None if the query can't be vectorized
+    if import_numpy() is None:
+        return None
+    redefined_names_rgx = r'(?<![_a-zA-Z0-9.])(?:float|{})(?![_a-zA-Z0-9])'.format('|'.join(vectorized_aggregate_functions))
+    if re.search(redefined_names_rgx, user_init_code, flags=re.IGNORECASE) is not None:
+        return None
+    if not select_expression.startswith('[') or not select_expression.endswith(']'):
+        return None
+    if not aggregation_key_expression.startswith('(') or not aggregation_key_expression.endswith(',)'):
+        return None
+    key_indices = []
+    for key_variable in split_top_level_items(aggregation_key_expression[1:-2]):
+        key_index = get_variable_index(key_variable, input_variables_map)
+        if key_index is None:
+            return None
+        key_indices.append(key_index)
+    plan = VectorizedAggregationPlan(key_indices, [])
+    for select_item in split_top_level_items(select_expression[1:-1]):
+        variable_index = get_variable_index(select_item, input_variables_map)
+        if variable_index is not None:
+            if variable_index not in key_indices:
+                return None # Non-key columns must be verified to be constant within each group
+            plan.output_items.append(('KEY', key_indices.index(variable_index)))
+            continue
+        match = re.match(r'^([a-zA-Z]+) *\( *(.*?) *\)$', select_item)
+        if match is None:
+            return None
+        function_name = get_aggregate_function_name(match.group(1))
+        if function_name is None:
+            return None
+        argument = match.group(2)
+        if function_name == 'COUNT' and (argument == '1' or get_variable_index(argument, input_variables_map) is not None):
+            plan.output_items.append(('COUNT', None))
+            continue
+        float_match = re.match(r'^float *\((.*)\)$', argument)
+        if float_match is None:
+            return None
+        value_index = get_variable_index(float_match.group(1), input_variables_map)
+        if value_index is None:
+            return None
+        plan.output_items.append((function_name, len(plan.value_indices)))
+        plan.value_indices.append(value_index)
+    return plan
+
+
+def get_column(records, index):
+    try:
+        return [record[index] for record in records]
+    except IndexError:
+        return [rbql_engine.safe_get(record, index) for record in records]
+
+
+def raise_conversion_error(plan, records, first_record_num):
+    # Reproduce the error of the generic execution: the first failed record and the first failed value or square of VARIANCE in the select expression order
+    for i, record in enumerate(records):
+        for function_name, value_position in plan.output_items:
+            if value_position is None or function_name == 'KEY':
+                continue
+            try:
+                value = float(rbql_engine.safe_get(record, plan.value_indices[value_position]))
+                if function_name == 'VARIANCE':
+                    value ** 2
+            except Exception as e:
+                if rbql_engine.debug_mode:
+                    raise
+                raise rbql_engine.RbqlRuntimeError('At record ' + str(first_record_num + i) + ', Details: ' + str(e))
+    assert False
+
+
+class VectorizedAggregator(object):
+    def __init__(self, plan):
+        self.np = import_numpy()
+        self.plan = plan
+        self.group_ids = dict()
+        np = self.np
+        # Per-group arrays have spare capacity which is doubled when exceeded, so that each batch only touches the groups of its own records
+        self.capacity = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = [np.zeros(0) for _ in plan.value_indices]
+        self.sums_of_squares = [np.zeros(0) for _ in plan.value_indices]
+        self.mins = [np.zeros(0) for _ in plan.value_indices]
+        self.maxs = [np.zeros(0) for _ in plan.value_indices]
+        self.first_is_nan = [np.zeros(0, dtype=bool) for _ in plan.value_indices]
+        self.needs_squares = [False] * len(plan.value_indices)
+        self.needs_min_max = [False] * len(plan.value_indices)
+        for function_name, value_position in plan.output_items:
+            if function_name == 'VARIANCE':
+                self.needs_squares[value_position] = True
+            if function_name in ['MIN', 'MAX']:
+                self.needs_min_max[value_position] = True
+
+    def grow(self, values, capacity, fill_value):
+        np = self.np
+        result = np.full(capacity, fill_value, dtype=values.dtype)
+        result[:len(values)] = values
+        return result
+
+    def ensure_capacity(self, num_groups):
+        if num_groups <= self.capacity:
+            return
+        capacity = max(num_groups, 2 * self.capacity)
+        np = self.np
+        self.counts = self.grow(self.counts, capacity, 0)
+        for i in range(len(self.plan.value_indices)):
+            self.sums[i] = self.grow(self.sums[i], capacity, 0.0)
+            if self.needs_squares[i]:
+                self.sums_of_squares[i] = self.grow(self.sums_of_squares[i], capacity, 0.0)
+            if self.needs_min_max[i]:
+                self.mins[i] = self.grow(self.mins[i], capacity, np.inf)
+                self.maxs[i] = self.grow(self.maxs[i], capacity, -np.inf)
+                self.first_is_nan[i] = self.grow(self.first_is_nan[i], capacity, False)
+        self.capacity = capacity
+
+    def accumulate_sums(self, sums, group_ids, values, num_old_groups, new_group_first_positions, rest_positions):
+        # Sums of the new groups start with their first values exactly as in the generic execution, the rest of the values are added one by one in the input order
+        if new_group_first_positions is not None:
+            sums[num_old_groups:num_old_groups + len(new_group_first_positions)] = values[new_group_first_positions]
+        self.np.add.at(sums, group_ids[rest_positions], values[rest_positions])
+
+    def process_batch(self, records, first_record_num):
+        np = self.np
+        plan = self.plan
+        if len(plan.key_indices) == 1:
+            keys = get_column(records, plan.key_indices[0])
+        else:
+            keys = list(zip(*[get_column(records, key_index) for key_index in plan.key_indices]))
+        group_ids_map = self.group_ids
+        num_old_groups = len(group_ids_map)
+        group_ids = np.fromiter((group_ids_map.setdefault(key, len(group_ids_map)) for key in keys), dtype=np.int64, count=len(keys))
+        num_groups = len(group_ids_map)
+        try:
+            float_columns = [list(map(float, get_column(records, value_index))) for value_index in plan.value_indices]
+            # Python's `val ** 2` and numpy's `values * values` can differ in the last bit, so the squares are computed exactly as in the generic execution
+            square_columns = [np.fromiter((v ** 2 for v in float_values), dtype=np.float64, count=len(float_values)) if self.needs_squares[i] else None for i, float_values in enumerate(float_columns)]
+        except (ValueError, TypeError, OverflowError):
+            raise_conversion_error(plan, records, first_record_num)
+        self.ensure_capacity(num_groups)
+        # The generic execution silently produces inf and nan on overflow, so numpy must not warn about it either
+        with np.errstate(over='ignore', invalid='ignore'):
+            self.accumulate_batch(group_ids, num_old_groups, num_groups, float_columns, square_columns)
+
+    def accumulate_batch(self, group_ids, num_old_groups, num_groups, float_columns, square_columns):
+        np = self.np
+        np.add.at(self.counts, group_ids, 1)
+        new_group_first_positions = None
+        rest_positions = np.ones(len(group_ids), dtype=bool)
+        if num_groups > num_old_groups:
+            unique_ids, first_positions = np.unique(group_ids, return_index=True)
+            new_group_first_positions = first_positions[unique_ids >= num_old_groups]
+            rest_positions[new_group_first_positions] = False
+        for i, float_values in enumerate(float_columns):
+            values = np.array(float_values, dtype=np.float64)
+            self.accumulate_sums(self.sums[i], group_ids, values, num_old_groups, new_group_first_positions, rest_positions)
+            if self.needs_squares[i]:
+                self.accumulate_sums(self.sums_of_squares[i], group_ids, square_columns[i], num_old_groups, new_group_first_positions, rest_positions)
+            if self.needs_min_max[i]:
+                # The generic MIN/MAX keep NaN if it was the first value of the group and ignore NaN values otherwise, `fmin` and `fmax` ignore NaN values.
+                if new_group_first_positions is not None:
+                    self.first_is_nan[i][num_old_groups:num_groups] = np.isnan(values[new_group_first_positions])
+                np.fmin.at(self.mins[i], group_ids, values)
+                np.fmax.at(self.maxs[i], group_ids, values)
+
+    def get_final(self, group_id, key, function_name, value_position):
+        if function_name == 'KEY':
+            return key[value_position]
+        count = int(self.counts[group_id])
+        if function_name == 'COUNT':
+            return count
+        if function_name in ['MIN', 'MAX']:
+            if self.first_is_nan[value_position][group_id]:
+                return float('nan')
+            return float((self.mins if function_name == 'MIN' else self.maxs)[value_position][group_id])
+        final_sum = float(self.sums[value_position][group_id])
+        if function_name == 'SUM':
+            return 0 + final_sum # The generic SUM starts with 0, this matters only for the sign of zero sums
+        if function_name == 'AVG':
+            return final_sum / count
+        assert function_name == 'VARIANCE'
+        return float(self.sums_of_squares[value_position][group_id]) / count - (final_sum / count) ** 2
+
+    def write_results(self, writer):
+        single_column_key = len(self.plan.key_indices) == 1
+        for key in sorted(list(self.group_ids.keys())):
+            group_id = self.group_ids[key]
+            key_tuple = (key,) if single_column_key else key
+            out_fields = [self.get_final(group_id, key_tuple, function_name, value_position) for function_name, value_position in self.plan.output_items]
+            if not writer.write(out_fields):
+                break
+
+
+def run_vectorized_aggregation(plan, input_iterator, writer):
+    aggregator = VectorizedAggregator(plan)
+    num_processed = 0
+    while True:
+        records = input_iterator.get_records(vectorized_batch_size)
+        if not records:
+            break
+        aggregator.process_batch(records, num_processed + 1)
+        num_processed += len(records)
+    aggregator.write_results(writer)
@@ -1,3 +1,5 @@
+import itertools
+
 from . import rbql_engine
 
 
@@ -26,6 +28,11 @@ class DataframeIterator(rbql_engine.RBQLInputIterator):
         # Convert to list because `record` has `Pandas` type.
         return list(record)
 
+    def get_records(self, max_num_records):
+        records = [list(record) for record in itertools.islice(self.table_itertuples, max_num_records)]
+        self.NR += len(records)
+        return records
+
     def get_warnings(self):
         return []
 
@@ -40,6 +40,9 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         # We need to convert tuple to list here because otherwise we won't be able to concatinate lists in expressions with star `*` operator
         return list(record_tuple)
 
+    def get_records(self, max_num_records):
+        return [list(record_tuple) for record_tuple in self.cursor.fetchmany(max_num_records)]
+
     def get_all_records(self, num_rows=None):
         # TODO consider to use TOP in the sqlite query when num_rows is not None
         if num_rows is None:
@@ -56,18 +59,97 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         return []
 
 
+# Max number of key values in a single lookup query, sqlite before 3.32 limits the number of query parameters to 999
+join_lookup_query_max_keys = 500
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def has_rowid(db_connection, table_name):
+    # Views and "WITHOUT ROWID" tables don't have usable rowids: views can return NULL rowids, WITHOUT ROWID tables fail the query
+    import sqlite3
+    for schema_table in ['sqlite_master', 'sqlite_temp_master']:
+        if db_connection.execute('SELECT 1 FROM {} WHERE type == \'view\' AND name == ?'.format(schema_table), (table_name,)).fetchone() is not None:
+            return False
+    try:
+        db_connection.execute('SELECT rowid FROM {} LIMIT 0'.format(quote_identifier(table_name)))
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+class SqliteJoinMap(rbql_engine.LookupJoinMap):
+    # Index nested-loop join: join records are looked up with `WHERE key IN (...)` queries for each batch of input records instead of loading the whole join table into memory.
+    # Join record numbers (bNR) are sqlite rowids.
+    def __init__(self, db_connection, record_iterator, key_indices, projection=None):
+        rbql_engine.LookupJoinMap.__init__(self, record_iterator, key_indices, projection)
+        self.db_connection = db_connection
+        self.table_name = record_iterator.table_name
+        column_names = record_iterator.get_header()
+        self.max_record_len = len(column_names)
+        self.key_columns = []
+        for ki in key_indices:
+            if ki >= len(column_names):
+                raise rbql_engine.RbqlRuntimeError('No field with index {} at record {} in "B" table'.format(ki + 1, 1))
+            self.key_columns.append('rowid' if ki == -1 else quote_identifier(column_names[ki]))
+
+
+    def lookup_keys(self, keys):
+        # Sqlite comparison rules are different from python e.g. with type affinity '1' can be equal to 1, so the fetched records are filtered by python key comparison.
+        if not keys:
+            return dict()
+        single_key = self.key_index is not None
+        keys = list(keys)
+        join_records = []
+        cursor = self.db_connection.cursor()
+        max_keys_per_query = max(1, join_lookup_query_max_keys // len(self.key_columns))
+        for i in range(0, len(keys), max_keys_per_query):
+            keys_chunk = keys[i:i + max_keys_per_query]
+            query_params = keys_chunk if single_key else [value for key in keys_chunk for value in key]
+            if single_key:
+                condition = '{} IN ({})'.format(self.key_columns[0], ', '.join('?' * len(keys_chunk)))
+            else:
+                key_condition = '({})'.format(' AND '.join('{} = ?'.format(key_column) for key_column in self.key_columns))
+                condition = ' OR '.join([key_condition] * len(keys_chunk))
+            cursor.execute('SELECT rowid, * FROM {} WHERE {}'.format(quote_identifier(self.table_name), condition), query_params)
+            join_records += cursor.fetchall()
+        join_records.sort(key=lambda row: row[0])
+        result = dict()
+        keys = set(keys)
+        for row in join_records:
+            nr = row[0]
+            fields = list(row[1:])
+            key = self.polymorphic_get_key(nr, fields)
+            if key in keys:
+                result.setdefault(key, []).append(self.polymorphic_make_join_record(nr, len(fields), fields))
+        return result
+
+
 class SqliteDbRegistry(rbql_engine.RBQLTableRegistry):
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, lookup_joins=False):
         self.db_connection = db_connection
+        # Use indexed lookups in the join table instead of loading it into memory
+        self.lookup_joins = lookup_joins
 
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         self.record_iterator = SqliteRecordIterator(self.db_connection, table_id, single_char_alias)
         return self.record_iterator
 
+    def get_lookup_join_map(self, record_iterator, key_indices, projection):
+        if not self.lookup_joins:
+            return None
+        if not has_rowid(self.db_connection, record_iterator.table_name):
+            return None # Join records are identified by rowid, so other tables are joined with the regular hash join
+        return SqliteJoinMap(self.db_connection, record_iterator, key_indices, projection)
+
 
-def query_sqlite_to_csv(query_text, db_connection, input_table_name, output_path, output_delim, output_policy, output_csv_encoding, output_warnings, user_init_code='', colorize_output=False):
+def query_sqlite_to_csv(query_text, db_connection, input_table_name, output_path, output_delim, output_policy, output_csv_encoding, output_warnings, user_init_code='', colorize_output=False, join_sqlite_db_path=None):
+    # With `join_sqlite_db_path` JOIN tables are read from that database instead of the input one and matching records are looked up by key
     output_stream, close_output_on_finish = (None, False)
     join_tables_registry = None
+    join_db_connection = None
     try:
         output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
 
@@ -81,12 +163,21 @@ def query_sqlite_to_csv(query_text, db_connection, input_table_name, output_path
         if user_init_code == '' and os.path.exists(default_init_source_path):
             user_init_code = rbql_csv.read_user_init_code(default_init_source_path)
 
-        join_tables_registry = SqliteDbRegistry(db_connection)
+        if join_sqlite_db_path is None:
+            join_tables_registry = SqliteDbRegistry(db_connection)
+        else:
+            if not os.path.isfile(join_sqlite_db_path):
+                raise rbql_engine.RbqlIOHandlingError('Unable to find sqlite database "{}"'.format(join_sqlite_db_path))
+            import sqlite3
+            join_db_connection = sqlite3.connect(join_sqlite_db_path)
+            join_tables_registry = SqliteDbRegistry(join_db_connection, lookup_joins=True)
         input_iterator = SqliteRecordIterator(db_connection, input_table_name)
         output_writer = rbql_csv.CSVWriter(output_stream, close_output_on_finish, output_csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
         rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code)
     finally:
         if close_output_on_finish:
             output_stream.close()
+        if join_db_connection is not None:
+            join_db_connection.close()
 
 
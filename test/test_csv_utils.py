@@ -14,7 +14,9 @@ import io
 import subprocess
 import json
 import shutil
+import pickle
 import copy
+import threading
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Use insert instead of append to make sure that we are using local rbql here.
@@ -290,13 +292,6 @@ def make_random_csv_records_naive():
     return result
 
 
-def normalize_newlines_in_fields(table):
-    for row in table:
-        for c in range(len(row)):
-            row[c] = row[c].replace('\r\n', '\n')
-            row[c] = row[c].replace('\r', '\n')
-
-
 def randomly_replace_columns_dictionary_style(query):
     adjusted_query = query
     for prefix in ['a', 'b']:
@@ -426,6 +421,28 @@ class TestSplitMethods(unittest.TestCase):
                 self.assertEqual(expected_fields, test_fields)
 
 
+    def test_csv_module_splitter_differential(self):
+        # Records from the test csv files and their random mutations must be split exactly the same way as by `split_quoted_str`
+        csv_files_dir = os.path.join(script_dir, 'csv_files')
+        records = []
+        for file_name in sorted(os.listdir(csv_files_dir)):
+            with open(os.path.join(csv_files_dir, file_name), 'rb') as f:
+                data = f.read().decode('latin-1')
+            stream = io.StringIO(data)
+            records += rbql_csv.CSVRecordIterator(stream, None, delim=None, policy=None, line_mode=True)._get_all_rows()
+            stream = io.StringIO(data)
+            records += rbql_csv.CSVRecordIterator(stream, None, delim=None, policy='quoted_rfc', line_mode=True)._get_all_rows()
+        mutation_tokens = ['"', '""', ' ', ',', '\t', ';', '|', '\r\n', '\n', '"a""b"', '\x00']
+        for record in records[:]:
+            for _ in range(3):
+                pos = random.randint(0, len(record))
+                records.append(record[:pos] + random.choice(mutation_tokens) + record[pos:])
+        for delim in [',', '\t', ';', '|', ' ']:
+            splitter = csv_utils.CSVModuleSplitter(delim)
+            for record in records:
+                self.assertEqual(csv_utils.split_quoted_str(record, delim), splitter.split(record), 'record: {}, delim: {}'.format(repr(record), repr(delim)))
+
+
 
 class TestLineSplit(unittest.TestCase):
     def test_split_lines_custom(self):
@@ -459,7 +476,87 @@ class TestLineSplit(unittest.TestCase):
             expected_res = src.splitlines()
             self.assertEqual(expected_res, test_res)
 
+    def test_line_numbers_across_blocks(self):
+        src = '\ufeffa,b\r\n1,"x\r\ny"\r2,z\n\n3,w'
+        for chunk_size in [1, 2, 3, 5, None]:
+            stream = io.BytesIO(src.encode('utf-8'))
+            record_iterator = rbql_csv.CSVRecordIterator(stream, 'utf-8', ',', 'quoted_rfc', chunk_size=chunk_size)
+            records = record_iterator.get_all_records()
+            self.assertEqual([['a', 'b'], ['1', 'x\r\ny'], ['2', 'z'], [''], ['3', 'w']], records)
+            self.assertEqual(6, record_iterator.NL)
+            self.assertTrue(record_iterator.utf8_bom_removed)
+
+    def test_mapped_iterator(self):
+        src = '\ufeffa,b\r\n#Д,"\r1,"x""y"\r\n\n2,"z"q\nЖ,w'
+        tmp_path = os.path.join(tempfile.gettempdir(), 'rbql_mapped_iterator_test.csv')
+        with open(tmp_path, 'wb') as f:
+            f.write(src.encode('utf-8'))
+        for comment_prefix in [None, '#']:
+            for chunk_size in [1, 2, 3, 5, None]:
+                stream = io.BytesIO(src.encode('utf-8'))
+                expected_iterator = rbql_csv.CSVRecordIterator(stream, 'utf-8', ',', 'quoted', comment_prefix=comment_prefix)
+                expected_records = expected_iterator.get_all_records()
+                with open(tmp_path, 'rb') as f:
+                    mapping = rbql_csv.map_input_file(f)
+                    record_iterator = rbql_csv.MappedCSVRecordIterator(mapping, 'utf-8', ',', 'quoted', comment_prefix=comment_prefix, chunk_size=chunk_size)
+                    records = record_iterator.get_all_records()
+                    mapping.close()
+                self.assertEqual(expected_records, records)
+                self.assertEqual(expected_iterator.NL, record_iterator.NL)
+                self.assertTrue(record_iterator.utf8_bom_removed)
+                defective_line = 2 if comment_prefix is None else 5
+                self.assertEqual(defective_line, record_iterator.first_defective_line)
+                self.assertEqual(src.encode('utf-8').find(b'#' if comment_prefix is None else b'2,'), record_iterator.first_defective_offset)
+                self.assertIn('(byte offset {})'.format(record_iterator.first_defective_offset), '\n'.join(record_iterator.get_warnings()))
+        os.remove(tmp_path)
+        self.assertIsNone(rbql_csv.map_input_file(io.BytesIO(b'a,b')))
+
+    def test_query_csv_mapped_input(self):
+        # Only the mapped iterator knows byte offsets of input lines, so the offset in the warning shows which iterator was used
+        src = b'#comment\n1,"x"y\n2,z\n'
+        tmp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(tmp_dir, 'input.csv')
+        with open(input_path, 'wb') as f:
+            f.write(src)
+        for comment_prefix, comment_regex, expected_warning in [('#', None, 'E.g. at line 2 (byte offset 9)'), ('#', '^2,', 'E.g. at line 2 (byte offset 9)'), (None, '^#', 'E.g. at line 2')]:
+            warnings = []
+            output_path = os.path.join(tmp_dir, 'output.csv')
+            rbql_csv.query_csv('SELECT a1, a2 WHERE a1 != "3"', input_path, ',', 'quoted', output_path, ',', 'quoted', 'utf-8', warnings, False, comment_prefix=comment_prefix, comment_regex=comment_regex)
+            self.assertEqual(1, len(warnings))
+            self.assertTrue(warnings[0].endswith(expected_warning), warnings[0])
+            with open(output_path, 'rb') as f:
+                expected_output = b'1,"""x""y"\n' if comment_regex == '^2,' else b'1,"""x""y"\n2,z\n'
+                self.assertEqual(expected_output, f.read())
+        shutil.rmtree(tmp_dir)
+
 class TestRecordIterator(unittest.TestCase):
+    def test_pipe_input(self):
+        # Records must be returned as soon as their lines are written to a pipe, without waiting for a full input block or the end of the input
+        for encoding, policy in [('utf-8', 'quoted'), ('utf-8', 'quoted_rfc'), ('latin-1', 'simple'), ('bytes', 'quoted')]:
+            read_fd, write_fd = os.pipe()
+            input_stream = os.fdopen(read_fd, 'rb')
+            writer = os.fdopen(write_fd, 'wb')
+            records = []
+            def read_records():
+                record_iterator = rbql_csv.make_record_iterator(input_stream, encoding, ',', policy)
+                records.append(record_iterator.get_record())
+                records.append(record_iterator.get_record())
+            reader_thread = threading.Thread(target=read_records)
+            reader_thread.daemon = True
+            reader_thread.start()
+            writer.write(b'a,\xd0')
+            writer.flush()
+            writer.write(b'\x96\n1,2\n')
+            writer.flush()
+            reader_thread.join(10)
+            is_blocked = reader_thread.is_alive()
+            writer.close()
+            reader_thread.join()
+            input_stream.close()
+            self.assertFalse(is_blocked, encoding)
+            expected_records = [[b'a', b'\xd0\x96'], [b'1', b'2']] if encoding == 'bytes' else [['a', b'\xd0\x96'.decode(encoding)], ['1', '2']]
+            self.assertEqual(expected_records, records)
+
     def test_iterator(self):
         for _test_num in range(100):
             table = generate_random_decoded_binary_table(10, 10, ['\r', '\n'])
@@ -506,7 +603,6 @@ class TestRecordIterator(unittest.TestCase):
             delim = random.choice(delims)
             policy = 'quoted_rfc'
             csv_data = table_to_csv_string_random(table, delim, policy)
-            normalize_newlines_in_fields(table) # XXX normalizing '\r' -> '\n' because record iterator doesn't preserve original separators
             stream, encoding = string_to_randomly_encoded_stream(csv_data)
 
             record_iterator = rbql_csv.CSVRecordIterator(stream, encoding, delim=delim, policy=policy)
@@ -528,7 +624,6 @@ class TestRecordIterator(unittest.TestCase):
             delim = random.choice(delims)
             policy = 'quoted_rfc'
             csv_data = table_to_csv_string_random(table, delim, policy, comment_prefix=comment_prefix)
-            normalize_newlines_in_fields(table) # XXX normalizing '\r' -> '\n' because record iterator doesn't preserve original separators
             stream, encoding = string_to_randomly_encoded_stream(csv_data)
 
             record_iterator = rbql_csv.CSVRecordIterator(stream, encoding, delim=delim, policy=policy, comment_prefix=comment_prefix)
@@ -866,9 +961,236 @@ class TestRBQLSimple(unittest.TestCase):
             self._do_test_random_headers()
 
 
+class TestParallelQuery(unittest.TestCase):
+    def _run_query(self, query, input_path, with_headers, parallel):
+        output_stream, output_path = tempfile.mkstemp()
+        os.close(output_stream)
+        warnings = []
+        rbql_csv.query_csv(query, input_path, ',', 'quoted', output_path, ',', 'quoted', 'utf-8', warnings, with_headers, comment_prefix='#', parallel=parallel)
+        with open(output_path, 'rb') as f:
+            output_data = f.read()
+        os.remove(output_path)
+        return (output_data, warnings)
+
+
+    def _do_test_random_table(self, tmp_tests_dir):
+        with_headers = random.choice([True, False])
+        num_rows = random.randint(1, 300)
+        table = [['name', 'value', 'key']]
+        for r in range(num_rows):
+            record = [random.choice(['abc', 'b,c', '"q"', 'xyz']), str(random.randint(0, 30)), random.choice(['x', 'y', 'z'])]
+            if not with_headers and random.randint(0, 50) == 0:
+                # Records with extra fields would break UPDATE queries in tables with header.
+                record.append('extra')
+            table.append(record)
+        input_path = os.path.join(tmp_tests_dir, 'input.csv')
+        with open(input_path, 'wb') as f:
+            f.write(table_to_csv_string_random(table, ',', 'quoted', comment_prefix='#').encode('utf-8'))
+        queries = ['SELECT * WHERE a3 != "y"', 'SELECT a1, a2 ORDER BY a2', 'SELECT TOP 7 a3, a1 ORDER BY a3 DESC', 'SELECT DISTINCT a1, a3 LIMIT 5', 'SELECT DISTINCT COUNT a3 ORDER BY a3 WITH (noheader)', 'SELECT DISTINCT COUNT a1 WITH (noheader)', 'UPDATE SET a2 = a2 + "0"', 'SELECT a1, a3 ORDER BY a1 WITH (header)', 'SELECT a3, COUNT(*), MIN(a2), MAX(a2), SUM(a2), AVG(a2), VARIANCE(a2), MEDIAN(a2), ARRAY_AGG(a1), ANY_VALUE(a1), APPROX_COUNT_DISTINCT(a1) GROUP BY a3 WITH (header)', 'SELECT TOP 2 a1, a3, SUM(a2) WHERE a1 != "xyz" GROUP BY a1, a3 WITH (header)']
+        for query in queries:
+            expected_output, expected_warnings = self._run_query(query, input_path, with_headers, None)
+            actual_output, actual_warnings = self._run_query(query, input_path, with_headers, 3)
+            self.assertEqual(expected_output, actual_output, 'Query: {}'.format(query))
+            if query.find('LIMIT') == -1:
+                # Workers don't stop reading at the same record as the single process does, so input warnings can be different for LIMIT queries.
+                self.assertEqual(expected_warnings, actual_warnings, 'Query: {}'.format(query))
+
+
+    def test_random_tables(self):
+        default_partition_size = rbql_csv.parallel_min_partition_size
+        rbql_csv.parallel_min_partition_size = 16
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_parallel_tests_')
+        try:
+            for i in range(10):
+                self._do_test_random_table(tmp_tests_dir)
+        finally:
+            rbql_csv.parallel_min_partition_size = default_partition_size
+            shutil.rmtree(tmp_tests_dir)
+
+
+    def test_fallback_warnings(self):
+        input_path = os.path.join(script_dir, 'csv_files', 'movies.tsv')
+        for query, reason in [('SELECT NR, a1', 'queries that use input record numbers (NR) are not supported'), ('SELECT a2, ARRAY_AGG(a1, lambda v: sorted(v)) GROUP BY a2', 'ARRAY_AGG with a post-processing function is not supported'), ('SELECT a1 | SELECT a1', 'multi-stage queries are not supported')]:
+            warnings = []
+            rbql_csv.query_csv(query, input_path, '\t', 'simple', os.devnull, '\t', 'simple', 'utf-8', warnings, False, parallel=2)
+            self.assertEqual(['Parallel mode was disabled: ' + reason], warnings)
+
+
+class TestBytesMode(unittest.TestCase):
+    def _run_query(self, query, input_path, csv_encoding, with_headers, parallel=None):
+        output_stream, output_path = tempfile.mkstemp()
+        os.close(output_stream)
+        warnings = []
+        rbql_csv.query_csv(query, input_path, ',', 'quoted', output_path, ',', 'quoted', csv_encoding, warnings, with_headers, comment_prefix='#', parallel=parallel)
+        with open(output_path, 'rb') as f:
+            output_data = f.read()
+        os.remove(output_path)
+        return (output_data, warnings)
+
+
+    def test_same_output_as_latin_1(self):
+        # Bytes mode must produce exactly the same output as latin-1 mode which decodes and encodes every byte
+        default_partition_size = rbql_csv.parallel_min_partition_size
+        rbql_csv.parallel_min_partition_size = 16
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_bytes_mode_tests_')
+        try:
+            for _test_num in range(10):
+                table = [['name', 'value', 'key']]
+                for _r in range(random.randint(1, 100)):
+                    table.append([make_random_decoded_binary_csv_entry(0, 6, ['\r', '\n', '#']), str(random.randint(0, 30)), random.choice(['x', 'y', '\xff'])])
+                input_path = os.path.join(tmp_tests_dir, 'input.csv')
+                with open(input_path, 'wb') as f:
+                    f.write(table_to_csv_string_random(table, ',', 'quoted', comment_prefix='#').encode('latin-1'))
+                join_path = os.path.join(tmp_tests_dir, 'join.csv')
+                with open(join_path, 'wb') as f:
+                    f.write('x,10\n\xff,20\n'.encode('latin-1'))
+                queries = ['SELECT * WHERE a3 != AS_FIELD("y")', 'SELECT a1, int(a2) * 2 WHERE like(a1, "%a%") or a2 == as_field(5)', 'SELECT a3, COUNT(*), MAX(a2), SUM(int(a2)), ARRAY_AGG(a1) GROUP BY a3', 'SELECT a1, b2 JOIN {} ON a3 == b1 ORDER BY a1 DESC'.format(join_path), 'SELECT a1, a3 WHERE a3 IN TABLE {}'.format(join_path), 'UPDATE SET a2 = a1 WHERE a3 == as_field("x")']
+                for query in queries:
+                    expected_output, expected_warnings = self._run_query(query, input_path, 'latin-1', True)
+                    actual_output, actual_warnings = self._run_query(query, input_path, 'bytes', True)
+                    self.assertEqual(expected_output, actual_output, 'Query: {}'.format(query))
+                    self.assertEqual(expected_warnings, actual_warnings, 'Query: {}'.format(query))
+                    if query.startswith('SELECT a3, COUNT'):
+                        actual_output, _actual_warnings = self._run_query(query, input_path, 'bytes', True, parallel=3)
+                        self.assertEqual(expected_output, actual_output, 'Query: {}'.format(query))
+        finally:
+            rbql_csv.parallel_min_partition_size = default_partition_size
+            shutil.rmtree(tmp_tests_dir)
+
+
+    def test_bytes_fields(self):
+        stream = io.BytesIO(b'\xef\xbb\xbfname,value\r\n#comment\r\n"a,\xff",1\r\nb,2')
+        record_iterator = rbql_csv.BytesCSVRecordIterator(stream, ',', 'quoted', has_header=True, comment_prefix='#', chunk_size=3)
+        self.assertEqual(['name', 'value'], record_iterator.get_header())
+        self.assertEqual([[b'a,\xff', b'1'], [b'b', b'2']], record_iterator.get_all_records())
+        self.assertEqual(bytes, record_iterator.get_field_type())
+        self.assertTrue(record_iterator.utf8_bom_removed)
+        output_stream = io.BytesIO()
+        writer = rbql_csv.BytesCSVWriter(output_stream, False, ',', 'quoted')
+        writer._write_all([['name', 'value'], [b'a,\xff', 1], [None, [b'x', 2.5]]])
+        self.assertEqual(b'name,value\n"a,\xff",1\n,x|2.5\n', output_stream.getvalue())
+        self.assertEqual(['None values in output were replaced by empty strings'], writer.get_warnings())
+
+
+    def test_batched_output(self):
+        class CountingStream(io.BytesIO):
+            def __init__(self):
+                io.BytesIO.__init__(self)
+                self.num_writes = 0
+            def write(self, data):
+                self.num_writes += 1
+                return io.BytesIO.write(self, data)
+
+        table = [[b'x' * (i % 50), i] for i in range(100000)]
+        expected_output_stream = io.BytesIO()
+        rbql_csv.CSVWriter(expected_output_stream, False, 'latin-1', ',', 'quoted')._write_all([[f.decode('latin-1'), i] for f, i in table])
+        output_stream = CountingStream()
+        rbql_csv.BytesCSVWriter(output_stream, False, ',', 'quoted')._write_all(table)
+        self.assertEqual(expected_output_stream.getvalue(), output_stream.getvalue())
+        self.assertEqual(len(table) // rbql_csv.output_batch_size, output_stream.num_writes)
+
+
+class TestJoinCache(unittest.TestCase):
+    def _run_query(self, query, input_path, join_cache_dir):
+        output_stream, output_path = tempfile.mkstemp()
+        os.close(output_stream)
+        warnings = []
+        rbql_csv.query_csv(query, input_path, ',', 'quoted', output_path, ',', 'quoted', 'utf-8', warnings, False, join_cache_dir=join_cache_dir)
+        with open(output_path, 'rb') as f:
+            output_data = f.read()
+        os.remove(output_path)
+        return (output_data, warnings)
+
+
+    def _get_cache_files(self, join_cache_dir):
+        if not os.path.exists(join_cache_dir):
+            return []
+        return [file_name for file_name in os.listdir(join_cache_dir) if file_name.endswith(rbql_csv.join_cache_file_suffix)]
+
+
+    def test_join_cache(self):
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_join_cache_tests_')
+        join_cache_dir = os.path.join(tmp_tests_dir, 'cache')
+        default_cache_max_size = rbql_csv.join_cache_max_size
+        default_build = rbql_engine.HashJoinMap.build
+        try:
+            input_path = os.path.join(tmp_tests_dir, 'input.csv')
+            with open(input_path, 'w') as f:
+                f.write('1,car\n2,plane\n3,boat\n')
+            join_table_path = os.path.join(tmp_tests_dir, 'lookup.csv')
+            with open(join_table_path, 'w') as f:
+                f.write('car,4\nplane,2,wings\n')
+            query = 'SELECT a1, b2 LEFT JOIN lookup.csv ON a2 == b1'
+            expected_output, expected_warnings = self._run_query(query, input_path, None)
+            self.assertEqual(b'1,4\n2,2\n3,\n', expected_output)
+
+            output, warnings = self._run_query(query, input_path, join_cache_dir)
+            self.assertEqual((expected_output, expected_warnings), (output, warnings))
+            self.assertEqual(1, len(self._get_cache_files(join_cache_dir)))
+
+            def failing_build(join_map):
+                raise RuntimeError('Join map must be loaded from cache')
+            rbql_engine.HashJoinMap.build = failing_build
+            output, warnings = self._run_query(query, input_path, join_cache_dir)
+            self.assertEqual((expected_output, expected_warnings), (output, warnings))
+            with self.assertRaises(RuntimeError):
+                self._run_query('SELECT a1, b1 LEFT JOIN lookup.csv ON a2 == b2', input_path, join_cache_dir)
+            rbql_engine.HashJoinMap.build = default_build
+
+            # Changed join table must invalidate the cache
+            with open(join_table_path, 'w') as f:
+                f.write('car,40\nboat,1\n')
+            output, warnings = self._run_query(query, input_path, join_cache_dir)
+            self.assertEqual(b'1,40\n2,\n3,1\n', output)
+            self.assertEqual(2, len(self._get_cache_files(join_cache_dir)))
+
+            rbql_csv.join_cache_max_size = 1
+            with open(join_table_path, 'w') as f:
+                f.write('car,400\n')
+            output, warnings = self._run_query(query, input_path, join_cache_dir)
+            self.assertEqual(b'1,400\n2,\n3,\n', output)
+            self.assertEqual(0, len(self._get_cache_files(join_cache_dir)))
+        finally:
+            rbql_engine.HashJoinMap.build = default_build
+            rbql_csv.join_cache_max_size = default_cache_max_size
+            shutil.rmtree(tmp_tests_dir)
+
+
+    def test_join_cache_signature(self):
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_join_cache_tests_')
+        join_cache_dir = os.path.join(tmp_tests_dir, 'cache')
+        try:
+            input_path = os.path.join(tmp_tests_dir, 'input.csv')
+            with open(input_path, 'w') as f:
+                f.write('1,car\n2,plane\n')
+            with open(os.path.join(tmp_tests_dir, 'lookup.csv'), 'w') as f:
+                f.write('car,4\nplane,2\n')
+            query = 'SELECT a1, b2 JOIN lookup.csv ON a2 == b1'
+            self.assertEqual(b'1,4\n2,2\n', self._run_query(query, input_path, join_cache_dir)[0])
+            cache_path = os.path.join(join_cache_dir, self._get_cache_files(join_cache_dir)[0])
+            with open(cache_path, 'rb') as f:
+                signature = f.read(32)
+                state = pickle.load(f)
+            self.assertEqual({'car': [(None, None, ('car', '4'))], 'plane': [(None, None, ('plane', '2'))]}, state[1])
+            # Unsigned or tampered cache files are ignored
+            for cache_data in [pickle.dumps((2, {'car': [(None, None, ('car', 'fake'))]}, [])), signature + pickle.dumps((2, {'car': [(None, None, ('car', 'fake'))]}, []))]:
+                with open(cache_path, 'wb') as f:
+                    f.write(cache_data)
+                self.assertEqual(b'1,4\n2,2\n', self._run_query(query, input_path, join_cache_dir)[0])
+            self.assertEqual(None, rbql_csv.get_join_cache_key(os.path.join(tmp_tests_dir, 'missing'), create=False))
+            if hasattr(os, 'getuid'):
+                # Cache is not used at all if other users can read the key
+                key_path = os.path.join(join_cache_dir, rbql_csv.join_cache_key_file_name)
+                os.chmod(key_path, 0o644)
+                self.assertEqual(None, rbql_csv.get_join_cache_key(join_cache_dir, create=True))
+                self.assertEqual(None, rbql_csv.load_join_cache(join_cache_dir, cache_path))
+        finally:
+            shutil.rmtree(tmp_tests_dir)
+
+
 class TestRBQLWithCSV(unittest.TestCase):
     # TODO add test with whitespace strip in join table.
-    def process_test_case(self, tmp_tests_dir, test_case):
+    def process_test_case(self, tmp_tests_dir, test_case, parallel=None):
         test_name = test_case['test_name']
         minimal_minor_python_version = int(test_case.get('minimal_python_version', '3.0').split('.')[1])
         if python_minor_version < minimal_minor_python_version:
@@ -913,7 +1235,7 @@ class TestRBQLWithCSV(unittest.TestCase):
         warnings = []
         error_type, error_msg = None, None
         try:
-            rbql_csv.query_csv(query, input_table_path, delim, policy, actual_output_table_path, out_delim, out_policy, encoding, warnings, with_headers, comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+            rbql_csv.query_csv(query, input_table_path, delim, policy, actual_output_table_path, out_delim, out_policy, encoding, warnings, with_headers, comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex, parallel=parallel)
         except Exception as e:
             if debug_mode:
                 raise
@@ -926,6 +1248,7 @@ class TestRBQLWithCSV(unittest.TestCase):
             actual_md5 = calc_file_md5(actual_output_table_path)
             self.assertTrue(expected_md5 == actual_md5, 'md5 missmatch in test "{}". Expected table: {}, Actual table: {}'.format(test_name, expected_output_table_path, actual_output_table_path))
 
+        warnings = [w for w in warnings if not w.startswith('Parallel mode was disabled')]
         warnings = sorted(normalize_warnings(warnings))
         expected_warnings = sorted(expected_warnings)
         self.assertEqual(expected_warnings, warnings, 'Inside json test: "{}". Expected warnings: {}, Actual warnings: {}'.format(test_name, expected_warnings, warnings))
@@ -933,6 +1256,20 @@ class TestRBQLWithCSV(unittest.TestCase):
 
 
     def test_json_scenarios(self):
+        self.run_json_scenarios()
+
+
+    def test_json_scenarios_parallel(self):
+        # Use tiny partitions to make sure that test tables are actually split.
+        default_partition_size = rbql_csv.parallel_min_partition_size
+        rbql_csv.parallel_min_partition_size = 64
+        try:
+            self.run_json_scenarios(parallel=3)
+        finally:
+            rbql_csv.parallel_min_partition_size = default_partition_size
+
+
+    def run_json_scenarios(self, parallel=None):
         tests_file = os.path.join(script_dir, 'csv_unit_tests.json')
         tmp_dir = tempfile.gettempdir()
         tmp_tests_dir = 'rbql_csv_unit_tests_dir_{}_{}'.format(time.time(), random.randint(1, 100000000)).replace('.', '_')
@@ -944,7 +1281,7 @@ class TestRBQLWithCSV(unittest.TestCase):
             if len(filtered_tests):
                 tests = filtered_tests
             for test in tests:
-                self.process_test_case(tmp_tests_dir, test)
+                self.process_test_case(tmp_tests_dir, test, parallel)
         shutil.rmtree(tmp_tests_dir)
 
 
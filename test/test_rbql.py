@@ -7,6 +7,12 @@ import os
 import sys
 import json
 import random
+import pickle
+import bisect
+import threading
+import time
+import re
+import contextlib
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 # Use insert instead of append to make sure that we are using local rbql here.
@@ -36,6 +42,29 @@ def normalize_warnings(warnings):
     return result
 
 
+@contextlib.contextmanager
+def engine_settings(**settings):
+    # Temporarily overrides module globals of rbql_engine, e.g. a tiny `memory_limit` to test the spilling code paths
+    default_settings = dict((name, getattr(rbql_engine, name)) for name in settings)
+    for name, value in settings.items():
+        setattr(rbql_engine, name, value)
+    try:
+        yield
+    finally:
+        for name, value in default_settings.items():
+            setattr(rbql_engine, name, value)
+
+
+def run_query_table(query, input_table, join_table=None, warnings=None):
+    # Returns either the output table or the error message, so that results of failing queries can be compared too
+    output_table = []
+    try:
+        rbql.query_table(query, input_table, output_table, warnings if warnings is not None else [], join_table)
+    except rbql_engine.RbqlRuntimeError as e:
+        return str(e)
+    return output_table
+
+
 def prepare_and_parse_select_expression_to_column_infos(select_part):
     select_expression, string_literals = rbql_engine.separate_string_literals(select_part)
     select_expression_for_ast = rbql_engine.translate_select_expression(select_expression)[1]
@@ -147,6 +176,10 @@ class TestRBQLQueryParsing(unittest.TestCase):
         test_res = rbql_engine.separate_actions(rbql_engine.default_statement_groups, query)
         assert test_res == expected_res
 
+        query = 'select a1, count(*) group by a1 with (header, sorted)'
+        expected_res = {'SELECT': {'text': 'a1, count(*)'}, 'GROUP BY': {'text': 'a1'}, 'WITH': ['header', 'sorted']}
+        self.assertEqual(expected_res, rbql_engine.separate_actions(rbql_engine.default_statement_groups, query))
+
 
     def test_except_parsing(self):
         except_part = '  a1,a2,a3, a4,a5, a[6] ,   a7  ,a8'
@@ -438,6 +471,642 @@ class TestTableRun(unittest.TestCase):
         self.assertEqual(expected_output_table, output_table)
 
 
+    def test_table_run_batched(self):
+        input_table = [[str(i), 'even' if i % 2 == 0 else 'odd'] for i in range(2 * rbql_engine.default_input_batch_size + 7)]
+        input_table[1500].append('extra')
+        query = 'select NR, a1 where a2 == "odd" and int(a1) % 3 == 0'
+        expected_output_table = [[i + 1, str(i)] for i in range(len(input_table)) if i % 2 == 1 and i % 3 == 0]
+        output_table = []
+        warnings = []
+        rbql.query_table(query, input_table, output_table, warnings)
+        self.assertEqual(expected_output_table, output_table)
+        self.assertEqual(['Number of fields in "input" table is not consistent: e.g. record 1 -> 2 fields, record 1501 -> 3 fields'], warnings)
+
+        output_table = []
+        warnings = []
+        with self.assertRaises(Exception) as cm:
+            rbql.query_table('select int(a1) // (1500 - NR)', input_table, output_table, warnings)
+        self.assertEqual('At record 1500, Details: integer division or modulo by zero', str(cm.exception))
+
+
+    def test_default_get_records(self):
+        class DummyIterator(rbql_engine.RBQLInputIterator):
+            def __init__(self, num_records):
+                self.num_records = num_records
+            def get_record(self):
+                if self.num_records == 0:
+                    return None
+                self.num_records -= 1
+                return [self.num_records]
+        record_iterator = DummyIterator(5)
+        self.assertEqual([[4], [3]], record_iterator.get_records(2))
+        self.assertEqual([[2], [1], [0]], record_iterator.get_records(10))
+        self.assertEqual([], record_iterator.get_records(10))
+
+
+
+class TestTopKSortedWriter(unittest.TestCase):
+    def test_random_entries(self):
+        for _test_num in range(50):
+            entries = [((random.randint(0, 10), random.choice(['a', 'b'])), [i]) for i in range(random.randint(0, 100))]
+            top_count = random.randint(0, 20)
+            for reverse_sort in [False, True]:
+                expected_table = []
+                expected_writer = rbql_engine.SortedWriter(rbql_engine.TopWriter(rbql_engine.TableWriter(expected_table), top_count), reverse_sort)
+                actual_table = []
+                actual_writer = rbql_engine.TopKSortedWriter(rbql_engine.TableWriter(actual_table), reverse_sort, top_count)
+                for sort_key, record in entries:
+                    expected_writer.write(sort_key, record)
+                    actual_writer.write(sort_key, record)
+                expected_writer.finish()
+                actual_writer.finish()
+                self.assertEqual(expected_table, actual_table)
+
+
+    def test_order_by_limit_query(self):
+        input_table = [[random.randint(0, 20), str(i)] for i in range(200)]
+        for order in ['', ' desc']:
+            full_output_table = []
+            warnings = []
+            rbql.query_table('select a1, a2 order by a1' + order, input_table, full_output_table, warnings)
+            output_table = []
+            rbql.query_table('select a1, a2 order by a1{} limit 15'.format(order), input_table, output_table, warnings)
+            self.assertEqual(full_output_table[:15], output_table)
+
+
+
+class TestSortedWriterSpill(unittest.TestCase):
+    def test_spilled_order_by(self):
+        input_table = [[random.randint(0, 30), random.choice(['a', 'b', 'c']), str(i)] for i in range(500)]
+        queries = ['select * order by a1', 'select * order by a1, a2 desc', 'select distinct a1, a2 order by a2 desc limit 20', 'select distinct count a2 order by a2']
+        for query in queries:
+            expected_output_table = run_query_table(query, input_table)
+            with engine_settings(memory_limit=3000):
+                output_table = run_query_table(query, input_table)
+            self.assertEqual(expected_output_table, output_table, query)
+
+
+    def test_spilled_runs(self):
+        output_table = []
+        with engine_settings(memory_limit=1000):
+            writer = rbql_engine.SortedWriter(rbql_engine.TopWriter(rbql_engine.TableWriter(output_table), 3), reverse_sort=True)
+            for i in range(100):
+                writer.write((i % 10,), [i])
+            self.assertTrue(len(writer.sorted_runs) > 1)
+            writer.finish()
+        self.assertEqual([[99], [89], [79]], output_table)
+
+
+    def test_multi_pass_merge(self):
+        input_table = [[random.randint(0, 30), random.choice(['a', 'b', 'c']), str(i)] for i in range(2000)]
+        for query in ['select * order by a1', 'select * order by a1 desc', 'select a1, a3 order by a2, a1 desc limit 300']:
+            expected_output_table = run_query_table(query, input_table)
+            with engine_settings(memory_limit=1000, spill_merge_fan_in=3):
+                output_table = run_query_table(query, input_table)
+            self.assertEqual(expected_output_table, output_table, query)
+        with engine_settings(memory_limit=1000, spill_merge_fan_in=3):
+            writer = rbql_engine.SortedWriter(rbql_engine.TableWriter([]), reverse_sort=False)
+            for i in range(1000):
+                writer.write((i % 10,), [i])
+                self.assertTrue(len(writer.sorted_runs) < 3 * max(writer.sorted_run_levels + [0]) + 3)
+            self.assertTrue(max(writer.sorted_run_levels) > 1)
+            writer.finish()
+
+
+
+class TestAggregatorsMerge(unittest.TestCase):
+    def _make_random_values(self, num_values):
+        result = []
+        for _i in range(num_values):
+            key = (random.choice(['a', 'b', 'c']),)
+            value = random.choice(['3', '-7', '10', '0']) if random.randint(0, 10) else random.choice(['2.5', '-0.25'])
+            result.append((key, value))
+        return result
+
+
+    def _aggregate_in_parts(self, aggregator_type, values):
+        merged = aggregator_type()
+        begin = 0
+        while begin < len(values):
+            end = begin + random.randint(0, 20)
+            part_aggregator = aggregator_type()
+            for key, value in values[begin:end]:
+                part_aggregator.increment(key, value)
+            if random.randint(0, 1):
+                merged.merge(part_aggregator)
+            else:
+                merged.merge_partial_state(pickle.loads(pickle.dumps(part_aggregator.get_partial_state())))
+            begin = end
+        return merged
+
+
+    def test_aggregators_merge(self):
+        aggregator_types = [rbql_engine.AnyValueAggregator, rbql_engine.MinAggregator, rbql_engine.MaxAggregator, rbql_engine.SumAggregator, rbql_engine.AvgAggregator, rbql_engine.VarianceAggregator, rbql_engine.MedianAggregator, rbql_engine.CountAggregator, rbql_engine.ArrayAggAggregator, rbql_engine.ApproxCountDistinctAggregator]
+        for _test_num in range(20):
+            values = self._make_random_values(random.randint(0, 100))
+            for aggregator_type in aggregator_types:
+                expected = aggregator_type()
+                for key, value in values:
+                    expected.increment(key, value)
+                actual = self._aggregate_in_parts(aggregator_type, values)
+                self.assertEqual(sorted(expected.stats.keys()), sorted(actual.stats.keys()))
+                for key in expected.stats.keys():
+                    expected_value = expected.get_final(key)
+                    actual_value = actual.get_final(key)
+                    self.assertEqual(expected_value, actual_value)
+                    self.assertEqual(type(expected_value), type(actual_value), str(aggregator_type))
+
+
+    def test_const_group_verifier_merge(self):
+        verifier = rbql_engine.ConstGroupVerifier(1)
+        verifier.increment(('a',), 'x')
+        other = rbql_engine.ConstGroupVerifier(1)
+        other.increment(('b',), 'y')
+        restored = rbql_engine.ConstGroupVerifier.from_partial_state(pickle.loads(pickle.dumps(other.get_partial_state())))
+        verifier.merge(restored)
+        self.assertEqual('y', verifier.get_final(('b',)))
+        conflicting = rbql_engine.ConstGroupVerifier(1)
+        conflicting.increment(('a',), 'z')
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            verifier.merge(conflicting)
+        self.assertEqual('Invalid aggregate expression: non-constant values in output column 2. E.g. "x" and "z"', str(cm.exception))
+
+
+    def test_aggregate_writer_merge(self):
+        input_table = [[random.choice(['a', 'b', 'c']), str(random.randint(0, 100))] for _i in range(300)]
+        query = 'select a1, count(*), min(a2), max(a2), sum(a2), avg(a2), variance(a2), median(a2), array_agg(a2) group by a1'
+        expected_output_table = []
+        warnings = []
+        rbql.query_table(query, input_table, expected_output_table, warnings)
+        merged_writer = None
+        output_table = []
+        for begin in range(0, len(input_table), 70):
+            query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table[begin:begin + 70]), rbql_engine.TableWriter(output_table), user_init_code='')
+            rbql_engine.shallow_parse_input_query(query, query_context.input_iterator, None, query_context)
+            rbql_engine.compile_and_run(query_context, user_namespace=None)
+            partial_state = pickle.loads(pickle.dumps(query_context.writer.get_partial_state()))
+            if merged_writer is None:
+                merged_writer = rbql_engine.AggregateWriter.from_partial_state(rbql_engine.TableWriter(output_table), partial_state)
+            else:
+                merged_writer.merge_partial_state(partial_state)
+        merged_writer.finish()
+        self.assertEqual(expected_output_table, output_table)
+
+
+
+class TestAggregateWriterSpill(unittest.TestCase):
+    def test_spilled_group_by(self):
+        input_table = [[str(random.randint(0, 300)), random.choice(['a', 'b']), str(random.randint(-50, 50))] for _i in range(2000)]
+        queries = ['select a1, a2, count(*), min(a3), max(a3), sum(a3), avg(a3), variance(a3), median(a3), array_agg(a3) group by a1, a2', 'select a2, count(*) group by a2', 'select top 5 a1, sum(a3) group by a1']
+        for query in queries:
+            expected_output_table = run_query_table(query, input_table)
+            with engine_settings(memory_limit=5000):
+                output_table = run_query_table(query, input_table)
+            self.assertEqual(expected_output_table, output_table, query)
+
+
+    def test_spilled_partitions(self):
+        output_table = []
+        writer = rbql_engine.AggregateWriter(rbql_engine.TableWriter(output_table), memory_limit=1000)
+        writer.aggregators = [rbql_engine.ConstGroupVerifier(0), rbql_engine.SumAggregator()]
+        for i in range(500):
+            key = i % 100
+            writer.aggregators[0].increment(key, key)
+            writer.aggregators[1].increment(key, i)
+            writer.add_key(key, [key, i])
+        self.assertTrue(len(writer.spill_files) > 0)
+        writer.finish()
+        self.assertEqual([[k, sum(range(k, 500, 100))] for k in range(100)], output_table)
+
+
+    def test_spilled_const_group_error(self):
+        writer = rbql_engine.AggregateWriter(rbql_engine.TableWriter([]), memory_limit=100)
+        writer.aggregators = [rbql_engine.ConstGroupVerifier(0)]
+        for value in ['x', 'y']:
+            writer.aggregators[0].increment('k', value)
+            writer.add_key('k', [value])
+        self.assertEqual(rbql_engine.aggregation_spill_partitions, len(writer.spill_files))
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            writer.finish()
+        self.assertEqual('Invalid aggregate expression: non-constant values in output column 1. E.g. "x" and "y"', str(cm.exception))
+
+
+class TestExactPercentiles(unittest.TestCase):
+    def test_select_kth_smallest(self):
+        for _test_num in range(50):
+            values = [random.randint(-20, 20) for _i in range(random.randint(1, 300))] + [random.random() for _i in range(random.randint(0, 50))]
+            sorted_values = sorted(values)
+            k = random.randint(0, len(values) - 1)
+            self.assertEqual(sorted_values[k], rbql_engine.select_kth_smallest(values, k))
+
+
+    def test_numeric_values(self):
+        values = rbql_engine.NumericValues()
+        for v in [3, 2.5, 2 ** 70, -1]:
+            values.append(v)
+        other = rbql_engine.NumericValues()
+        other.append(7)
+        values.extend(pickle.loads(pickle.dumps(other)), convert_to_float=True)
+        self.assertEqual(5, len(values))
+        self.assertEqual([-1, 2.5, 3, 7.0, 2 ** 70], sorted(values.to_list()))
+        self.assertEqual(float, type(sorted(values.to_list())[3]))
+        self.assertEqual([3, 2.5, 2 ** 70, -1, 7.0], values.to_list())
+
+
+    def test_median_of_equal_mixed_values(self):
+        # Numeric input values are not converted, so equal int and float values can go in any order
+        for input_values in [[1, 1.0], [1.0, 1], [2, 1.0, 1, 0] * 10, [1.0] * 20 + [1] * 21, [1] * 20 + [1.0] * 21]:
+            expected = sorted(input_values)
+            m = len(expected) // 2
+            expected_median = expected[m] if len(expected) % 2 else expected[m - 1]
+            output_table = []
+            rbql.query_table('select MEDIAN(a1)', [[v] for v in input_values], output_table, [])
+            self.assertEqual(expected_median, output_table[0][0])
+            self.assertEqual(type(expected_median), type(output_table[0][0]), input_values)
+
+
+    def test_percentile_and_quantiles(self):
+        for _test_num in range(20):
+            values = [str(random.randint(-100, 100)) for _i in range(random.randint(1, 200))]
+            num_values = sorted([int(v) for v in values])
+            percentile = random.choice([0, 10, 25, 50, 90, 99.5, 100])
+            percentile_aggregator = rbql_engine.PercentileAggregator(percentile)
+            quantiles_aggregator = rbql_engine.QuantilesAggregator(4)
+            for v in values:
+                percentile_aggregator.increment('k', v)
+                quantiles_aggregator.increment('k', v)
+            rank = percentile / 100.0 * (len(num_values) - 1)
+            lower = num_values[int(rank)]
+            upper = num_values[min(int(rank) + 1, len(num_values) - 1)]
+            expected = lower if rank == int(rank) or lower == upper else lower + (upper - lower) * (rank - int(rank))
+            self.assertEqual(expected, percentile_aggregator.get_final('k'))
+            restored = rbql_engine.PercentileAggregator.from_partial_state(pickle.loads(pickle.dumps(percentile_aggregator.get_partial_state())))
+            self.assertEqual(expected, restored.get_final('k'))
+            quantiles = quantiles_aggregator.get_final('k')
+            self.assertEqual(5, len(quantiles))
+            self.assertEqual(num_values[0], quantiles[0])
+            self.assertEqual(num_values[-1], quantiles[-1])
+            median_aggregator = rbql_engine.MedianAggregator()
+            for v in values:
+                median_aggregator.increment('k', v)
+            self.assertEqual(median_aggregator.get_final('k'), quantiles[2])
+
+
+
+class TestApproxAggregators(unittest.TestCase):
+    def test_approx_count_distinct(self):
+        for num_distinct in [1, 100, 5000, 50000]:
+            aggregator = rbql_engine.ApproxCountDistinctAggregator()
+            for i in range(num_distinct * 2):
+                aggregator.increment('k', str(i % num_distinct))
+            estimate = aggregator.get_final('k')
+            if num_distinct <= rbql_engine.hll_sparse_limit:
+                self.assertEqual(num_distinct, estimate)
+            else:
+                self.assertTrue(abs(estimate - num_distinct) < num_distinct * 0.05, (estimate, num_distinct))
+
+
+    def test_approx_count_distinct_merge(self):
+        parts = [rbql_engine.ApproxCountDistinctAggregator() for _i in range(3)]
+        for i in range(30000):
+            parts[i % 3].increment('k', 'value_{}'.format(i % 20000))
+            parts[i % 2].increment('small', i % 10)
+        merged = rbql_engine.ApproxCountDistinctAggregator()
+        for part in parts:
+            merged.merge_partial_state(pickle.loads(pickle.dumps(part.get_partial_state())))
+        self.assertTrue(abs(merged.get_final('k') - 20000) < 1000)
+        self.assertEqual(10, merged.get_final('small'))
+
+
+    def test_approx_percentile(self):
+        values = [random.random() * 1000 for _i in range(20000)]
+        sorted_values = sorted(values)
+        for percentile in [0, 1, 25, 50, 99, 100]:
+            aggregator = rbql_engine.ApproxPercentileAggregator(percentile)
+            for v in values:
+                aggregator.increment('k', str(v))
+            estimate = aggregator.get_final('k')
+            rank = bisect.bisect_left(sorted_values, estimate)
+            self.assertTrue(abs(rank - percentile / 100.0 * len(values)) < len(values) * 0.01, (percentile, rank))
+
+
+    def test_approx_percentile_small_groups_are_exact(self):
+        for _test_num in range(20):
+            values = [str(random.randint(-100, 100)) for _i in range(random.randint(1, 50))]
+            median = rbql_engine.MedianAggregator()
+            approx = rbql_engine.ApproxPercentileAggregator(50)
+            for v in values:
+                median.increment('k', v)
+                approx.increment('k', v)
+            self.assertEqual(float(median.get_final('k')), approx.get_final('k'))
+
+
+    def test_approx_percentile_merge(self):
+        values = [random.gauss(0, 100) for _i in range(30000)]
+        merged = None
+        for begin in range(0, len(values), 7000):
+            part = rbql_engine.ApproxPercentileAggregator(90)
+            for v in values[begin:begin + 7000]:
+                part.increment('k', v)
+            state = pickle.loads(pickle.dumps(part.get_partial_state()))
+            if merged is None:
+                merged = rbql_engine.ApproxPercentileAggregator.from_partial_state(state)
+            else:
+                merged.merge_partial_state(state)
+        rank = bisect.bisect_left(sorted(values), merged.get_final('k'))
+        self.assertTrue(abs(rank - 0.9 * len(values)) < len(values) * 0.01, rank)
+
+
+
+class CountingIterator(rbql_engine.RBQLInputIterator):
+    def __init__(self, num_records):
+        self.num_records = num_records
+        self.NR = 0
+
+    def get_record(self):
+        if self.NR >= self.num_records:
+            return None
+        self.NR += 1
+        return [str(self.NR), 'value{}'.format(self.NR % 7)]
+
+
+class TestQueryPipeline(unittest.TestCase):
+    def test_limit_stops_upstream_stages(self):
+        input_iterator = CountingIterator(10 ** 7)
+        output_table = []
+        warnings = []
+        rbql_engine.query('select a1, a2 | select a2, a1 | select top 3 a2', input_iterator, rbql_engine.TableWriter(output_table), warnings)
+        self.assertEqual([['1'], ['2'], ['3']], output_table)
+        self.assertTrue(input_iterator.NR < 10 ** 6)
+
+
+    def test_blocking_stages(self):
+        input_table = [[str(i), 'value{}'.format(i % 7)] for i in range(20000)]
+        output_table = []
+        warnings = []
+        rbql.query_table('select a2, count(*) group by a2 | select a1, a2 order by a1 desc | select top 2 *', input_table, output_table, warnings)
+        self.assertEqual([['value6', 2857], ['value5', 2857]], output_table)
+
+
+    def test_upstream_error(self):
+        input_table = [[str(i)] for i in range(20000)] + [['bad']]
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            rbql.query_table('select int(a1) | select a1 * 2', input_table, [], [])
+        self.assertEqual("At record 20001, Details: invalid literal for int() with base 10: 'bad'", str(cm.exception))
+
+
+    def test_downstream_error(self):
+        input_iterator = CountingIterator(10 ** 6)
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            rbql_engine.query('select a1 | select a1 + 1', input_iterator, rbql_engine.TableWriter([]), [])
+        self.assertTrue(str(cm.exception).startswith('At record 1, Details:'))
+        self.assertTrue(input_iterator.NR < 10 ** 6)
+
+
+    def test_interrupted_stage(self):
+        class InterruptedIterator(CountingIterator):
+            def get_record(self):
+                if self.NR >= 5000:
+                    raise KeyboardInterrupt()
+                return CountingIterator.get_record(self)
+
+        num_threads_before = threading.active_count()
+        with self.assertRaises(KeyboardInterrupt):
+            rbql_engine.query('select a1 | select a1 | select a1', InterruptedIterator(10 ** 6), rbql_engine.TableWriter([]), [])
+        # The downstream stage threads must not stay blocked on the pipes
+        for _i in range(100):
+            if threading.active_count() == num_threads_before:
+                break
+            time.sleep(0.05)
+        self.assertEqual(num_threads_before, threading.active_count())
+
+
+class TestJoinProjection(unittest.TestCase):
+    def _plan(self, query_text):
+        rb_actions = rbql_engine.separate_actions(rbql_engine.default_statement_groups, query_text)
+        join_variables_map = rbql_engine.get_variables_map(query_text, 'b', None)
+        return rbql_engine.plan_join_projection(query_text, rb_actions, join_variables_map)
+
+
+    def test_plan_join_projection(self):
+        self.assertEqual(rbql_engine.JoinProjection([1, 4], False, False), self._plan('select a1, b5, b[2] join B on a1 == b5'))
+        self.assertEqual(rbql_engine.JoinProjection([0], True, True), self._plan('select bNR, bNF, a2 left join B on a1 == b1'))
+        self.assertEqual(None, self._plan('select a1, b.* join B on a1 == b1'))
+        self.assertEqual(None, self._plan('select * join B on a1 == b1'))
+
+
+    def test_projected_join_map(self):
+        join_table = [['car', 'red', 'x' * 10, '4'], ['plane', 'white'], ['car', 'blue', 'y', '6']]
+        join_map = rbql_engine.HashJoinMap(rbql_engine.TableIterator(join_table), [0], rbql_engine.JoinProjection([1, 3], False, True))
+        join_map.build()
+        self.assertEqual([(None, 4, ('red', '4')), (None, 4, ('blue', '6'))], join_map.get_join_records('car'))
+        self.assertEqual([(None, 2, ('white', None))], join_map.get_join_records('plane'))
+        output_table = []
+        rbql.query_table('select a1, b2, b4, bNF join B on a1 == b1', [['car'], ['plane']], output_table, [], join_table)
+        self.assertEqual([['car', 'red', '4', 4], ['car', 'blue', '6', 4], ['plane', 'white', None, 2]], output_table)
+
+
+class TestJoinWherePushdown(unittest.TestCase):
+    def test_split_join_where_expression(self):
+        split = rbql_engine.split_join_where_expression
+        self.assertEqual(('a1 == "x"', None), split('a1 == "x"'))
+        self.assertEqual((None, 'b1 == "x"'), split('b1 == "x"'))
+        self.assertEqual(('a1 == "x" and int(a.age) > 10', 'b.name != a2 and a3 != "y"'), split('a1 == "x" and int(a.age) > 10 and b.name != a2 and a3 != "y"'))
+        self.assertEqual(('(a1 == "x" and a2 == "y")', 'bNR > 2'), split('(a1 == "x" and a2 == "y") and bNR > 2'))
+        self.assertEqual(('a1 in [a2, a3]', 'len(b[3]) > 0'), split('a1 in [a2, a3] and len(b[3]) > 0'))
+        self.assertEqual((None, 'a1 == "x" or b1 == "y" and a2 == "z"'), split('a1 == "x" or b1 == "y" and a2 == "z"'))
+        self.assertEqual((None, 'a1 if b1 else a2 and a3'), split('a1 if b1 else a2 and a3'))
+        self.assertEqual(('not a1 and a2.startswith("and")', None), split('not a1 and a2.startswith("and")'))
+
+
+    def test_input_where_evaluated_once(self):
+        input_table = [['1', 'x'], ['2', 'y'], ['3', 'x'], ['4', 'z']]
+        join_table = [['x', str(i)] for i in range(5)] + [['y', '10'], ['z', '20']]
+        user_init_code = 'num_calls = [0]\ndef is_odd(v):\n    num_calls[0] += 1\n    return int(v) % 2 == 1\n'
+        output_table = []
+        rbql.query_table('select a1, b2, num_calls[0] join B on a2 == b1 where is_odd(a1) and int(b2) < 3', input_table, output_table, [], join_table, user_init_code=user_init_code)
+        self.assertEqual([['1', '0', 1], ['1', '1', 1], ['1', '2', 1], ['3', '0', 3], ['3', '1', 3], ['3', '2', 3]], output_table)
+
+
+class TestJoinSpill(unittest.TestCase):
+    def test_spilled_join_map(self):
+        join_table = [[str(i % 50), 'value{}'.format(i)] for i in range(300)]
+        with engine_settings(memory_limit=2000):
+            join_map = rbql_engine.HashJoinMap(rbql_engine.TableIterator(join_table), [0])
+            join_map.build()
+        self.assertEqual(rbql_engine.join_spill_partitions, len(join_map.spill_files))
+        self.assertEqual(0, len(join_map.hash_map))
+        join_map.finish()
+
+
+    def test_spilled_join_queries(self):
+        input_table = [[str(random.randint(0, 60)), random.choice(['a', 'b', 'c']), str(i)] for i in range(400)]
+        join_table = [[str(random.randint(0, 50)), 'value{}'.format(i), str(i % 3)] for i in range(300)]
+        unique_join_table = [[str(i), 'value{}'.format(i)] for i in range(61)]
+        queries = [
+            ('select a3, b2, bNR join B on a1 == b1', join_table),
+            ('select * left join B on a1 == b1 where a2 != "b"', join_table),
+            ('select top 20 a3, b.* left join B on a1 == b1', join_table),
+            ('select a2, b3, array_agg(b2) join B on a1 == b1 group by a2, b3', join_table),
+            ('select a3, b2 join B on a2 == b3 and a1 == b1 order by b2', join_table),
+            ('select NR, b2 join B on NR == b3', join_table),
+            ('select a1, b2 strict left join B on a1 == b1', unique_join_table),
+            ('select a1, b2 strict left join B on a1 == b1', join_table),
+            ('update set a2 = b2 strict left join B on a1 == b1', unique_join_table),
+        ]
+        for query, join_table in queries:
+            expected_result = run_query_table(query, input_table, join_table)
+            with engine_settings(memory_limit=2000):
+                result = run_query_table(query, input_table, join_table)
+            self.assertEqual(expected_result, result, query)
+
+
+    def test_spilled_join_with_limit(self):
+        join_table = [[str(i % 500), 'value{}'.format(i)] for i in range(3000)]
+        query = 'select top 5 a1, b2 join B on a1 == b1 where NR > 3'
+        expected_output_table = []
+        rbql_engine.query(query, CountingIterator(1000), rbql_engine.TableWriter(expected_output_table), [], rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)]))
+        input_iterator = CountingIterator(10 ** 6)
+        output_table = []
+        warnings = []
+        with engine_settings(memory_limit=2000):
+            rbql_engine.query(query, input_iterator, rbql_engine.TableWriter(output_table), warnings, rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)]))
+        self.assertEqual(expected_output_table, output_table)
+        self.assertTrue(input_iterator.NR < 10 ** 5)
+        self.assertEqual(1, len(warnings))
+
+
+    def test_bloom_filter(self):
+        bloom_filter = rbql_engine.BloomFilter(1000, 10)
+        for i in range(1000):
+            bloom_filter.add(str(i))
+        bloom_filter.add(('a', 1))
+        self.assertTrue(all(bloom_filter.contains(str(i)) for i in range(1000)))
+        self.assertTrue(bloom_filter.contains(('a', 1)))
+        num_false_positives = len([i for i in range(1000, 11000) if bloom_filter.contains(str(i))])
+        self.assertTrue(num_false_positives < 300)
+
+
+    def test_spilled_join_statistics(self):
+        input_table = [[str(i), 'x'] for i in range(1000)]
+        join_table = [[str(i * 10), 'value{}'.format(i)] for i in range(100)]
+        query = 'select a1, b2 join B on a1 == b1'
+        expected_result = run_query_table(query, input_table, join_table)
+        for bits_per_key in [10, 0]:
+            warnings = []
+            with engine_settings(memory_limit=2000, join_bloom_filter_bits_per_key=bits_per_key):
+                output_table = run_query_table(query, input_table, join_table, warnings)
+            self.assertEqual(expected_result, output_table)
+            self.assertEqual(1, len(warnings))
+            num_rejected = int(re.search(r'(\d+) of 1000 input records', warnings[0]).group(1))
+            self.assertTrue(warnings[0].find('100 join records') != -1)
+            if bits_per_key:
+                self.assertTrue(num_rejected > 800)
+            else:
+                self.assertEqual(0, num_rejected)
+
+
+
+class TestInTable(unittest.TestCase):
+    def test_sorted_key_set(self):
+        input_table = [[str(i), 'x'] for i in range(100)]
+        join_table = [[str(i % 30)] for i in range(200)] + [['95']]
+        for query, expected_num_records in [('select a1 where a1 IN TABLE B', 31), ('select a1 where a1 NOT IN TABLE B and NR > 10', 69)]:
+            expected_output = run_query_table(query, input_table, join_table)
+            with engine_settings(in_table_max_hashed_keys=10):
+                output_table = run_query_table(query, input_table, join_table)
+            self.assertEqual(expected_num_records, len(output_table))
+            self.assertEqual(expected_output, output_table)
+        key_set = rbql_engine.SortedKeySet(['1', '3', '5'])
+        self.assertTrue('3' in key_set)
+        self.assertFalse('4' in key_set)
+        self.assertFalse(3 in key_set)
+
+    def test_python_in_operator(self):
+        input_table = [['1', 'x'], ['2', 'y'], ['3', 'z']]
+        join_table = [['2']]
+        user_init_code = 'table = ["1", "3"]'
+        for query, expected_output in [('select a1 where a1 in table', [['1'], ['3']]), ('select a1 where a1 not in table or a2 == "z"', [['2'], ['3']]), ('select a1 where a1 IN TABLE B', [['2']])]:
+            output_table = []
+            rbql.query_table(query, input_table, output_table, [], join_table, user_init_code=user_init_code)
+            self.assertEqual(expected_output, output_table, query)
+
+    def test_missing_key_field(self):
+        output_table = []
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            rbql.query_table('select a1 where a1 IN TABLE B', [['1']], output_table, [], [['1'], []])
+        self.assertTrue(str(cm.exception).find('the key is the first column of the table') != -1)
+
+
+
+class TestJoinBuildSide(unittest.TestCase):
+    def test_small_input_key_filter(self):
+        join_map = rbql_engine.HashJoinMap(rbql_engine.TableIterator([['a', '1'], ['b', '2', 'x'], ['a', '3']]), [0])
+        join_map.key_filter = set(['a', 'c'])
+        join_map.build()
+        self.assertEqual({'a': [(1, 2, ['a', '1']), (3, 2, ['a', '3'])]}, dict(join_map.hash_map))
+        self.assertEqual(3, join_map.max_record_len)
+
+
+    def test_small_and_large_input(self):
+        input_table = [[str(random.randint(0, 60)), random.choice(['a', 'b', 'c']), str(i)] for i in range(200)]
+        join_table = [[str(random.randint(0, 50)), 'value{}'.format(i), str(i % 3)] for i in range(300)]
+        unique_join_table = [[str(i), 'value{}'.format(i)] for i in range(61)]
+        queries = [
+            ('select a3, b2, bNR join B on a1 == b1', join_table),
+            ('select * left join B on a1 == b1 where a2 != "b"', join_table),
+            ('select NR, b2 join B on NR == b3', join_table),
+            ('select a1, b2 strict left join B on a1 == b1', unique_join_table),
+            ('select a1, b2 strict left join B on a1 == b1', join_table),
+            ('select a1, b2 join B on a1 == b1 | select a2, count(*) group by a2', join_table),
+        ]
+        for query, join_table in queries:
+            expected_warnings = []
+            expected_result = run_query_table(query, input_table, join_table, expected_warnings)
+            warnings = []
+            with engine_settings(join_input_prefetch_size=10):
+                result = run_query_table(query, input_table, join_table, warnings)
+            self.assertEqual(expected_result, result, query)
+            self.assertEqual(expected_warnings, warnings, query)
+
+
+    def test_prefetch_with_limit(self):
+        join_table = [[str(i % 500), 'value{}'.format(i)] for i in range(3000)]
+        for query, max_input_records in [('select top 5 a1, b2 join B on a1 == b1', 10), ('select a1, b2 join B on a1 == b1 limit 20', 30)]:
+            expected_output_table = []
+            rbql_engine.query(query, CountingIterator(100), rbql_engine.TableWriter(expected_output_table), [], rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)]))
+            input_iterator = CountingIterator(10 ** 6)
+            output_table = []
+            rbql_engine.query(query, input_iterator, rbql_engine.TableWriter(output_table), [], rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)]))
+            self.assertEqual(expected_output_table, output_table)
+            self.assertTrue(input_iterator.NR <= max_input_records, input_iterator.NR)
+
+
+class TestMergeJoin(unittest.TestCase):
+    def test_left_join_null_record_len(self):
+        input_table = [['1', 'apple'], ['2', 'banana'], ['3', 'cherry'], ['4', 'kiwi']]
+        join_table = [['apple', 'red'], ['cherry', 'dark', 'red'], ['kiwi', 'green', 'fuzzy', 'small']]
+        warnings = []
+        output_table = run_query_table('select a1, b.* left join B on a2 == b1 with (mergejoin)', input_table, join_table, warnings)
+        self.assertEqual([['1', 'apple', 'red'], ['2', None, None, None], ['3', 'cherry', 'dark', 'red'], ['4', 'kiwi', 'green', 'fuzzy', 'small']], output_table)
+        self.assertEqual(2, len(warnings))
+        self.assertTrue(warnings[1].startswith('Join table "B" has records with more than 3 fields after the first input record without matches'))
+        join_map = rbql_engine.MergeJoinMap(rbql_engine.TableIterator(join_table), [0])
+        join_map.build()
+        self.assertEqual([], join_map.get_join_records('banana'))
+        self.assertEqual(3, join_map.get_null_record_len())
+        self.assertEqual([(3, 4, ['kiwi', 'green', 'fuzzy', 'small'])], join_map.get_join_records('kiwi'))
+        self.assertEqual(3, join_map.get_null_record_len())
+
+
+    def test_unsorted_key_error(self):
+        input_table = [['b', '1'], ['a', '2']]
+        join_table = [['a', '2'], ['b', '1']]
+        error = run_query_table('select a1, b2 join B on a1 == b1 and a2 == b2 with (mergejoin)', input_table, join_table)
+        self.assertTrue(error.endswith('E.g. key "a, 2" goes after "b, 1"'), error)
+        error = run_query_table('select a1, count(*) group by a1, a2 with (sorted)', input_table)
+        self.assertTrue(error.endswith('E.g. key "a, 2" goes after "b, 1"'), error)
+
 
 class TestJsonTables(unittest.TestCase):
 
@@ -0,0 +1,113 @@
+import unittest
+import os
+import sys
+import random
+import math
+import warnings
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# Use insert instead of append to make sure that we are using local rbql here.
+sys.path.insert(0, os.path.join(os.path.dirname(script_dir), 'rbql-py'))
+
+import rbql
+from rbql import rbql_engine
+from rbql import rbql_numpy
+
+
+numpy_is_available = rbql_numpy.import_numpy() is not None
+
+
+def run_query(query, input_table, numpy_aggregation_enabled, input_column_names=None):
+    old_value = rbql_engine.numpy_aggregation_enabled
+    rbql_engine.numpy_aggregation_enabled = numpy_aggregation_enabled
+    try:
+        output_table = []
+        warnings = []
+        try:
+            rbql.query_table(query, input_table, output_table, warnings, input_column_names=input_column_names)
+        except Exception as e:
+            return ('error', type(e).__name__, str(e))
+        return (output_table, warnings)
+    finally:
+        rbql_engine.numpy_aggregation_enabled = old_value
+
+
+def make_query_context(query, input_table, input_column_names=None):
+    query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table, input_column_names), rbql_engine.TableWriter([]), user_init_code='')
+    rbql_engine.shallow_parse_input_query(query, query_context.input_iterator, None, query_context)
+    return query_context
+
+
+def normalize_nan(table):
+    # NaN != NaN, so replace them to compare the tables
+    if isinstance(table, tuple):
+        return table
+    return [['NaN' if isinstance(v, float) and math.isnan(v) else v for v in record] for record in table]
+
+
+@unittest.skipIf(not numpy_is_available, 'numpy is not installed')
+class TestNumpyAggregation(unittest.TestCase):
+    def test_query_planning(self):
+        vectorized_queries = ['select a1, sum(float(a3)), AVG(float(a2)) group by a1', 'select top 3 a2, a1, COUNT(*), Min(float(a3)), max(float(a3)), variance(float(a3)) group by a1, a2', 'select a.name, sum(float(a.value)) group by a.name']
+        for query in vectorized_queries:
+            self.assertTrue(make_query_context(query, [['x', '1', '2']], ['name', 'value', 'other']).vectorized_aggregation is not None, query)
+        generic_queries = ['select a1, sum(a3) group by a1', 'select a1, a2, sum(float(a3)) group by a1', 'select a1, sum(float(a3)) where a2 != "x" group by a1', 'select a1, median(float(a3)) group by a1', 'select a1, sum(float(a3) * 2) group by a1', 'select a1, count(*) group by a1 with (sorted)', 'select a1, sum(float(a3))']
+        for query in generic_queries:
+            self.assertTrue(make_query_context(query, [['x', '1', '2']]).vectorized_aggregation is None, query)
+
+
+    def test_random_tables(self):
+        queries = ['select a1, sum(float(a3)), avg(float(a3)), COUNT(*), min(float(a3)), max(float(a3)), variance(float(a3)) group by a1', 'select a2, a1, Sum(float(a2)), count(a3) group by a1, a2', 'select top 3 a1, MAX(float(a2)) group by a1', 'select a1, min(float(a4)) group by a1']
+        for _test_num in range(30):
+            num_records = random.randint(0, 30000)
+            values = ['1', '-2.5', '0.1', '1e10', '3', 'nan', '-0.3']
+            input_table = [[random.choice(['x', 'y', 'z', str(random.randint(0, 1000))]), str(random.randint(-5, 5)), random.choice(values) if random.randint(0, 20) else str(random.random())] for _i in range(num_records)]
+            for record in input_table:
+                if random.randint(0, 100) == 0:
+                    record.append('bad_value')
+                elif random.randint(0, 100) == 0:
+                    record.append('5')
+            for query in queries:
+                expected = run_query(query, input_table, numpy_aggregation_enabled=False)
+                actual = run_query(query, input_table, numpy_aggregation_enabled=True)
+                if isinstance(expected, tuple) and len(expected) == 2:
+                    expected = (normalize_nan(expected[0]), expected[1])
+                    actual = (normalize_nan(actual[0]), actual[1])
+                self.assertEqual(expected, actual, query)
+
+
+    def test_conversion_error(self):
+        input_table = [['x', '1'], ['y', '2'], ['x', 'abc']]
+        expected_error = ('error', 'RbqlRuntimeError', 'At record 3, Details: could not convert string to float: \'abc\'')
+        self.assertEqual(expected_error, run_query('select a1, sum(float(a2)) group by a1', input_table, numpy_aggregation_enabled=True))
+        self.assertEqual(expected_error, run_query('select a1, sum(float(a2)) group by a1', input_table, numpy_aggregation_enabled=False))
+
+
+    def test_overflow(self):
+        input_table = [['x', '1'], ['y', '2'], ['x', '1e100'], ['x', '1e308'], ['y', '1e308']]
+        # Squares of VARIANCE overflow with an error, sums silently overflow to inf without any warnings
+        for query in ['select a1, sum(float(a2)), variance(float(a2)) group by a1', 'select a1, sum(float(a2)), avg(float(a2)), max(float(a2)) group by a1']:
+            expected = run_query(query, input_table, numpy_aggregation_enabled=False)
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                self.assertEqual(expected, run_query(query, input_table, numpy_aggregation_enabled=True), query)
+        self.assertEqual(('error', 'RbqlRuntimeError', 'At record 4, Details: (34, \'Numerical result out of range\')'), run_query('select a1, variance(float(a2)) group by a1', input_table, numpy_aggregation_enabled=True))
+
+
+    def test_exact_floating_point_results(self):
+        # `x * x` and `x ** 2` differ in the last bit for this value, and the sign of zero depends on the initial value of the sum
+        for query, input_table in [('select a1, variance(float(a2)) group by a1', [['g', '0.8869223325614064'], ['g', '0.1']]), ('select a1, sum(float(a2)), avg(float(a2)), variance(float(a2)) group by a1', [['g', '-0.0'], ['h', '1'], ['g', '-0.0']])]:
+            expected = run_query(query, input_table, numpy_aggregation_enabled=False)
+            actual = run_query(query, input_table, numpy_aggregation_enabled=True)
+            self.assertEqual(repr(expected), repr(actual), query)
+
+
+    def test_many_groups_across_batches(self):
+        default_batch_size = rbql_numpy.vectorized_batch_size
+        rbql_numpy.vectorized_batch_size = 7
+        try:
+            input_table = [[str(i % 50 if i < 100 else i), str(random.random())] for i in range(300)]
+            query = 'select a1, count(*), sum(float(a2)), min(float(a2)), max(float(a2)), variance(float(a2)) group by a1'
+            self.assertEqual(run_query(query, input_table, numpy_aggregation_enabled=False), run_query(query, input_table, numpy_aggregation_enabled=True))
+        finally:
+            rbql_numpy.vectorized_batch_size = default_batch_size
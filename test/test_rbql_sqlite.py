@@ -15,6 +15,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(script_dir), 'rbql-py'))
 import rbql
 from rbql import rbql_engine
 from rbql import rbql_sqlite
+from rbql import rbql_csv
 
 def calc_file_md5(fname):
     # TODO put into a common test_common.py module
@@ -111,3 +112,106 @@ class TestSqliteJsonScenarios(unittest.TestCase):
             for test in tests:
                 self.process_test_case(tmp_tests_dir, test)
         shutil.rmtree(tmp_tests_dir)
+
+
+
+class TestSqliteLookupJoin(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='rbql_sqlite_join_test_')
+        self.db_path = os.path.join(self.tmp_dir, 'join.db')
+        self.db_connection = sqlite3.connect(self.db_path)
+        self.db_connection.execute('CREATE TABLE countries (code TEXT, region TEXT, name TEXT, population INTEGER)')
+        rows = [('us', 'am', 'United States', 330), ('fr', 'eu', 'France', 67), ('de', 'eu', 'Germany', 83), ('us', 'na', 'USA duplicate', 1), ('1', 'xx', 'Numeric code', 0), ('ca', 'am', 'Canada', 38)]
+        rows += [('c{}'.format(i), 'r{}'.format(i % 7), 'Country {}'.format(i), i) for i in range(3000)]
+        self.db_connection.executemany('INSERT INTO countries VALUES (?, ?, ?, ?)', rows)
+        self.db_connection.execute('CREATE INDEX countries_code ON countries (code)')
+        self.db_connection.commit()
+        self.input_table = [['us', 'am'], ['fr', 'eu'], ['jp', 'as'], ['de', 'eu'], ['ca', 'am'], ['us', 'na']] + [['c{}'.format(i * 3), 'r{}'.format(i % 5)] for i in range(1500)]
+
+    def tearDown(self):
+        self.db_connection.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_query(self, query_text, lookup_joins):
+        output_table = []
+        warnings = []
+        input_iterator = rbql_engine.TableIterator(self.input_table, column_names=['code', 'region'])
+        registry = rbql_sqlite.SqliteDbRegistry(self.db_connection, lookup_joins=lookup_joins)
+        rbql_engine.query(query_text, input_iterator, rbql_engine.TableWriter(output_table), warnings, registry)
+        return output_table, warnings
+
+    def test_lookup_join_matches_hash_join(self):
+        queries = [
+            'SELECT a.code, b.name, b.population INNER JOIN countries ON a.code == b.code',
+            'SELECT a.code, b.name LEFT JOIN countries ON a.code == b.code WHERE b.population is None or b.population > 50',
+            'SELECT NR, bNR, a.code, b.name, bNF JOIN countries ON a.code == b.code',
+            'SELECT * JOIN countries ON a.code == b.code and a.region == b.region',
+            'SELECT a.code, COUNT(*) JOIN countries ON a1 == b1 GROUP BY a.code',
+            'SELECT TOP 10 a.code, b.name JOIN countries ON a.code == b.code ORDER BY b.name DESC',
+        ]
+        for query_text in queries:
+            expected_table, expected_warnings = self.run_query(query_text, lookup_joins=False)
+            actual_table, actual_warnings = self.run_query(query_text, lookup_joins=True)
+            self.assertEqual(expected_table, actual_table, query_text)
+            self.assertEqual(expected_warnings, actual_warnings, query_text)
+        self.assertTrue(len(self.run_query(queries[0], lookup_joins=True)[0]) > 500)
+
+    def test_lookup_join_key_types(self):
+        # Sqlite would match '1' with the integer column, the regular join doesn't
+        self.input_table = [['67', 'eu'], ['1', 'xx']]
+        query_text = 'SELECT a1, b.name JOIN countries ON a1 == b.population'
+        self.assertEqual(self.run_query(query_text, lookup_joins=False), self.run_query(query_text, lookup_joins=True))
+        self.assertEqual([], self.run_query(query_text, lookup_joins=True)[0])
+
+    def test_multi_column_key_query_params(self):
+        if not hasattr(self.db_connection, 'setlimit'):
+            return
+        # Max number of query parameters in sqlite builds before 3.32
+        self.db_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        query_text = 'SELECT a.code, b.name JOIN countries ON a.code == b.code and a.region == b.region'
+        self.input_table = [['c{}'.format(i), 'r{}'.format(i % 7)] for i in range(2000)]
+        expected_table = self.run_query(query_text, lookup_joins=False)
+        self.assertEqual(2000, len(expected_table[0]))
+        self.assertEqual(expected_table, self.run_query(query_text, lookup_joins=True))
+
+    def test_tables_without_rowid(self):
+        self.db_connection.execute('CREATE VIEW eu_countries AS SELECT code, name FROM countries WHERE region == "eu"')
+        self.db_connection.execute('CREATE TABLE currencies (code TEXT PRIMARY KEY, currency TEXT) WITHOUT ROWID')
+        self.db_connection.executemany('INSERT INTO currencies VALUES (?, ?)', [('fr', 'EUR'), ('us', 'USD'), ('de', 'EUR')])
+        self.db_connection.commit()
+        for query_text in ['SELECT a.code, b.name, bNR JOIN eu_countries ON a.code == b.code', 'SELECT a.code, b.currency LEFT JOIN currencies ON a.code == b.code']:
+            expected_table = self.run_query(query_text, lookup_joins=False)
+            self.assertTrue(len(expected_table[0]) > 0)
+            self.assertEqual(expected_table, self.run_query(query_text, lookup_joins=True), query_text)
+
+    def test_strict_left_join_error(self):
+        self.input_table = [['us', 'am'], ['fr', 'eu']]
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            self.run_query('SELECT a.code, b.name STRICT LEFT JOIN countries ON a.code == b.code', lookup_joins=True)
+        self.assertTrue(str(cm.exception).find('must have exactly one match') != -1)
+
+    def test_query_csv_with_sqlite_join(self):
+        input_path = os.path.join(self.tmp_dir, 'input.csv')
+        output_path = os.path.join(self.tmp_dir, 'output.csv')
+        with open(input_path, 'w') as f:
+            f.write('code,region\nde,eu\njp,as\nfr,eu\n')
+        warnings = []
+        rbql_csv.query_csv('SELECT a.code, b.name LEFT JOIN countries ON a.code == b.code', input_path, ',', 'quoted', output_path, ',', 'quoted', 'utf-8', warnings, with_headers=True, join_sqlite_db_path=self.db_path)
+        with open(output_path) as f:
+            self.assertEqual('code,name\nde,Germany\njp,\nfr,France\n', f.read())
+        self.assertEqual(['null values in output were replaced'], normalize_warnings(warnings))
+
+    def test_query_sqlite_with_sqlite_join(self):
+        input_db_path = os.path.join(self.tmp_dir, 'input.db')
+        output_path = os.path.join(self.tmp_dir, 'output.csv')
+        input_db_connection = sqlite3.connect(input_db_path)
+        input_db_connection.execute('CREATE TABLE visits (code TEXT, num_days INTEGER)')
+        input_db_connection.executemany('INSERT INTO visits VALUES (?, ?)', [('de', 3), ('jp', 5), ('fr', 7)])
+        input_db_connection.commit()
+        warnings = []
+        try:
+            rbql_sqlite.query_sqlite_to_csv('SELECT a.code, a.num_days, b.name LEFT JOIN countries ON a.code == b.code', input_db_connection, 'visits', output_path, ',', 'quoted', 'utf-8', warnings, join_sqlite_db_path=self.db_path)
+        finally:
+            input_db_connection.close()
+        with open(output_path) as f:
+            self.assertEqual('code,num_days,name\nde,3,Germany\njp,5,\nfr,7,France\n', f.read())
@@ -105,6 +105,9 @@ if [ $run_unit_tests == "yes" ]; then
         python3 -m unittest test.test_rbql_sqlite
         die_if_error $?
 
+        python3 -m unittest test.test_rbql_numpy
+        die_if_error $?
+
         if [ "$run_pandas_tests" == "yes" ]; then
             python3 -m unittest test.test_rbql_pandas
             die_if_error $?